@@ -0,0 +1,107 @@
+import cv2
+import numpy as np
+
+
+def region_focus_scores(frame, grid=(4, 4), width=320):
+    """
+    低分辨率分区清晰度：预览帧缩小到 width 宽，按 grid (行, 列) 分区，
+    每个分区取拉普拉斯平方均值（近似拉普拉斯方差），返回 grid 形状的float数组
+    """
+    h, w = frame.shape[:2]
+    scale = width / w
+    small = cv2.resize(frame, (width, max(grid[0], int(h * scale))), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+    laplacian = cv2.Laplacian(gray, cv2.CV_32F)
+    cv2.multiply(laplacian, laplacian, dst=laplacian)
+    rows, cols = grid
+    gh = laplacian.shape[0] // rows
+    gw = laplacian.shape[1] // cols
+    blocks = laplacian[:gh * rows, :gw * cols].reshape(rows, gh, cols, gw)
+    return blocks.mean(axis=(1, 3))
+
+
+class AdaptiveZSweep:
+    """
+    自适应Z范围
+
+    从当前位置出发先向上、再向下逐步采样各分区清晰度，
+    某个方向上只要还有分区在变清晰（峰值在最前沿）或尚未明显越过峰值，就继续延伸；
+    所有有纹理的分区都越过峰值后换向/结束。
+    最后只在至少一个分区接近其峰值的位置拍摄，跳过多余切片
+    """
+
+    def __init__(self, step, max_slices=31, min_slices=3, drop_ratio=0.85, min_contrast=1.25, min_rise=0.1):
+        """
+        参数:
+            step: 采样间隔（电机步数）
+            max_slices: 单方向最多采样数与最终拍摄层数上限
+            min_slices: 最少拍摄层数
+            drop_ratio: 前沿清晰度低于峰值的该比例时认为已越过峰值
+            min_contrast: 峰值/最低值小于该比例的分区视为无纹理，不参与判断
+            min_rise: 峰值在前沿的分区，需比最低值高出该比例才算仍在变清晰（排除噪声）
+        """
+        self.step = step
+        self.max_slices = max_slices
+        self.min_slices = min_slices
+        self.drop_ratio = drop_ratio
+        self.min_contrast = min_contrast
+        self.min_rise = min_rise
+        self.samples = {}  # 相对Z位置 -> 分区清晰度
+        self.direction = 1
+        self.frontier = {1: 0, -1: 0}
+
+    def _matrix(self):
+        positions = sorted(self.samples)
+        scores = np.stack([self.samples[z].ravel() for z in positions])  # (位置数, 分区数)
+        return positions, scores
+
+    def _informative(self, scores):
+        return scores.max(axis=0) >= self.min_contrast * (scores.min(axis=0) + 1e-6)
+
+    def _should_extend(self, direction):
+        positions, scores = self._matrix()
+        frontier_scores = scores[positions.index(self.frontier[direction])]
+        peak = scores.max(axis=0)
+        at_frontier = frontier_scores >= peak
+        still_rising = at_frontier & (peak > (1 + self.min_rise) * scores.min(axis=0))
+        not_dropped = self._informative(scores) & (frontier_scores > self.drop_ratio * peak)
+        return bool(np.any(still_rising | not_dropped))
+
+    def add(self, z, scores):
+        """记录一个采样位置（相对位置）的分区清晰度"""
+        self.samples[z] = np.asarray(scores, dtype=np.float32)
+
+    def next_position(self):
+        """下一个采样的相对位置，返回None表示扫描结束"""
+        if not self.samples:
+            return 0
+        while self.direction in (1, -1):
+            direction = self.direction
+            sampled = abs(self.frontier[direction]) // self.step
+            # 每个方向至少采样一步，之后按焦点曲线决定是否继续
+            if sampled == 0 or (sampled < self.max_slices and self._should_extend(direction)):
+                self.frontier[direction] += direction * self.step
+                return self.frontier[direction]
+            self.direction = -1 if direction == 1 else 0
+        return None
+
+    def capture_positions(self):
+        """
+        拍摄位置（相对位置，升序）：至少一个有纹理分区的清晰度不低于其峰值 drop_ratio 的位置，
+        不足 min_slices 时向两侧补齐；没有纹理时退化为 [-step, 0, step]
+        """
+        positions, scores = self._matrix()
+        informative = self._informative(scores)
+        if not informative.any():
+            return [-self.step, 0, self.step]
+        near_peak = scores[:, informative] >= self.drop_ratio * scores[:, informative].max(axis=0)
+        selected = [z for z, sharp in zip(positions, near_peak.any(axis=1)) if sharp]
+        while len(selected) < self.min_slices:
+            low, high = selected[0] - self.step, selected[-1] + self.step
+            # 优先补齐已采样且整体更清晰的一侧
+            if high in self.samples and (low not in self.samples
+                                         or self.samples[high].sum() >= self.samples[low].sum()):
+                selected.append(high)
+            else:
+                selected.insert(0, low)
+        return selected[:self.max_slices]
@@ -133,9 +133,25 @@ from flask_socketio import SocketIO, emit, send
 import json
 import numpy as np
 import base64
+import uuid
 import io
-from utils import stitch_images, focus_stack, count_cells
+from utils import stitch_images, count_cells, FOCUS_STACK_ENGINES
 from vllm_inference import vllm_chat_stream
+from thumbnail_cache import ThumbnailCache
+from storage_manager import StorageManager, RecordingSpaceMonitor
+from raw_capture import RawBatchWriter, RAW_SUFFIX
+from frame_averager import FrameAverager
+from flat_field import FlatFieldCorrector
+from focus_stack_low_power import StreamingFocusStack
+from adaptive_zstack import AdaptiveZSweep, region_focus_scores
+from volume_store import ZarrVolumeWriter
+from scan_pipeline import ScanPipeline
+from stitching.stitching_error import StitchingError
+from scan_planner import ScanManifest, order_tiles, pixel_size_um, planned_travel
+from focus_map import FocusSurface, select_anchors, refine_focus
+from height_map import (z_steps_to_um, height_from_focus, save_height_tiff16, save_height_mosaic, save_ply_points,
+                        save_ply_mesh)
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ConfigManager:
@@ -162,8 +178,14 @@ class ConfigManager:
         self.cam1_motion_threshold = 0.5
         self.cam1_motion_cooldown = 2.0
         
-        # 定期清理缓存文件
-        self.cleanup_interval = 3600  # 每小时清理一次（秒）
+        # SAVE_DIR存储配额
+        self.storage_quota_gb = 8  # SAVE_DIR最大占用（GB）
+        self.storage_reserve_mb = 500  # 磁盘必须保留的空闲空间（MB）
+        self.storage_policy = 'lru'  # 淘汰策略：lru / age
+        self.min_recording_mb = 200  # 开始录像前至少需要的可用空间（MB）
+        self.keep_raw = False  # 景深堆叠/拼接扫描时是否同时保存RAW
+        self.stage_axis_signs = [1, 1]  # 电机X/Y正方向移动时视野沿图像x/y轴的移动方向（±1），由 calibrate_stage_axes 标定
+        self.flat_field = False  # 拍照和视频帧是否做平场/暗场校正
     
     def load_settings(self):
         """加载设置文件"""
@@ -176,12 +198,13 @@ class ConfigManager:
                 cam0.b_gain = settings['b_value']
                 led_0.set_led_power(int(settings.get('led_value_0', 10)))
                 led_1.set_led_power(int(settings.get('led_value_1', 10)))
-                # 读取校准的步数值，如果不存在则使用默认值1500
-                cam0.pixel_size = settings.get('pixel_size', 0.09)
-                print(f"Loaded pixel_size: {cam0.pixel_size}")
                 # 读取显微镜倍率，如果不存在则使用默认值40
                 cam0.mag_scale = settings.get('magnification', 40)
                 print(f"Loaded magnification: {cam0.mag_scale}")
+                # 读取标定的像素尺寸（当前倍率下，拍照分辨率），未标定时由倍率和标称视野推算
+                cam0.pixel_size = settings.get('pixel_size', pixel_size_um(cam0.mag_scale, cam0.image_size[0]))
+                print(f"Loaded pixel_size: {cam0.pixel_size}")
+                self.stage_axis_signs = settings.get('stage_axis_signs', self.stage_axis_signs)
                 # 读取景深堆叠Z Level参数，如果不存在则使用默认值5
                 self.z_level = settings.get('z_level', 5)
                 print(f"Loaded z_level: {self.z_level}")
@@ -194,6 +217,12 @@ class ConfigManager:
                 # 读取Y轴步进控制步长，如果不存在则使用默认值50
                 self.y_step_size = settings.get('y_step_size', 50)
                 print(f"Loaded y_step_size: {self.y_step_size}")
+                # 读取存储配额参数
+                self.storage_quota_gb = settings.get('storage_quota_gb', self.storage_quota_gb)
+                self.storage_reserve_mb = settings.get('storage_reserve_mb', self.storage_reserve_mb)
+                self.storage_policy = settings.get('storage_policy', self.storage_policy)
+                self.apply_storage_settings()
+                self.flat_field = settings.get('flat_field', self.flat_field)
             return settings
         except FileNotFoundError:
             print("Settings file not found. Using default settings.")
@@ -212,10 +241,16 @@ class ConfigManager:
                 'xy_steps_per_mm': motor_x.steps_per_mm,
                 'z_steps_per_mm': motor_z.steps_per_mm,
                 'magnification': cam0.mag_scale,  # 保存显微镜倍率
+                'pixel_size': cam0.pixel_size,  # 保存当前倍率下的像素尺寸
+                'stage_axis_signs': self.stage_axis_signs,  # 保存平台轴方向标定
                 'z_level': self.z_level,  # 保存景深堆叠Z Level参数
                 'z_step_size': self.z_step_size,  # 保存Z轴步进控制步长
                 'x_step_size': self.x_step_size,  # 保存X轴步进控制步长
                 'y_step_size': self.y_step_size,  # 保存Y轴步进控制步长
+                'storage_quota_gb': self.storage_quota_gb,  # 保存存储配额
+                'storage_reserve_mb': self.storage_reserve_mb,
+                'storage_policy': self.storage_policy,
+                'flat_field': self.flat_field,  # 保存平场校正开关
             }
             with open('/home/admin/Documents/microscopy/settings.json', 'w') as f:
                 json.dump(settings, f)
@@ -224,6 +259,27 @@ class ConfigManager:
             print(f"Error saving settings: {e}")
             return False
 
+    def load_storage_settings(self):
+        """启动时只读取存储配额参数（不改动相机和LED），在首次按配额清理之前调用"""
+        try:
+            with open('/home/admin/Documents/microscopy/settings.json', 'r') as f:
+                settings = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.storage_quota_gb = settings.get('storage_quota_gb', self.storage_quota_gb)
+        self.storage_reserve_mb = settings.get('storage_reserve_mb', self.storage_reserve_mb)
+        self.storage_policy = settings.get('storage_policy', self.storage_policy)
+        self.apply_storage_settings(enforce=False)
+
+    def apply_storage_settings(self, enforce=True):
+        """将配额参数同步到存储管理器，并立即按新配额淘汰"""
+        storage.quota_bytes = int(self.storage_quota_gb * 1024**3)
+        storage.reserve_bytes = int(self.storage_reserve_mb * 1024**2)
+        if self.storage_policy in StorageManager.EVICTION_POLICIES:
+            storage.policy = self.storage_policy
+        if enforce:
+            storage.enforce_quota()
+
 
 # 创建全局配置管理器实例
 config = ConfigManager()
@@ -266,6 +322,8 @@ cam1.apply_perspective = False
 motor_x = Motor("X")
 motor_y = Motor("Y")
 motor_z = Motor("Z")
+# 电机位置在每次启动时归零（没有回零开关），扫描清单记录会话号，跨会话续扫前先重新定位
+STAGE_SESSION = uuid.uuid4().hex
 led_0 = Led(0)
 led_1 = Led(1)
 adc = Adc()
@@ -275,6 +333,70 @@ SAVE_DIR = '/home/admin/Documents/microscopy/static'
 if not os.path.exists(SAVE_DIR):
     os.makedirs(SAVE_DIR)
 
+# 缩略图/预览图缓存，新文件由后台线程生成
+thumbnail_cache = ThumbnailCache(SAVE_DIR)
+# SAVE_DIR配额管理，原图被淘汰时同时清理其缩略图
+storage = StorageManager(
+    SAVE_DIR,
+    quota_bytes=int(config.storage_quota_gb * 1024**3),
+    reserve_bytes=int(config.storage_reserve_mb * 1024**2),
+    policy=config.storage_policy,
+    on_evict=thumbnail_cache.invalidate,
+)
+
+
+def save_capture(filename, data):
+    """保存已编码的图片到SAVE_DIR，登记存储占用，并提交后台缩略图生成任务"""
+    file_path = os.path.join(SAVE_DIR, filename)
+    with open(file_path, 'wb') as f:
+        f.write(data)
+    storage.register(filename)
+    thumbnail_cache.submit(filename)
+    return file_path
+
+
+# 平场/暗场参考不放在SAVE_DIR中，避免被配额淘汰
+flat_field = FlatFieldCorrector('/home/admin/Documents/microscopy/flat_field')
+
+# 通用拼接的标定按倍率保存，重复拍摄相同网格时只做曝光补偿和融合；同样不放在SAVE_DIR中
+STITCH_CALIBRATION_DIR = '/home/admin/Documents/microscopy/stitch_calibration'
+
+
+def flat_field_key():
+    """当前倍率和LED功率对应的参考图分组"""
+    return flat_field.key(cam0.mag_scale, (led_0.led_cycle, led_1.led_cycle))
+
+
+def correct_frame(rgb):
+    """开启平场校正时原地校正cam0的拍照/视频帧，没有当前设置的参考图时不处理"""
+    if config.flat_field:
+        flat_field.apply(rgb, flat_field_key(), cam0.field_region())
+    return rgb
+
+
+cam0.frame_correction = correct_frame
+
+
+# RAW后台写盘，写完后登记存储占用
+raw_writer = RawBatchWriter(
+    on_saved=lambda path: storage.register(os.path.relpath(path, SAVE_DIR).replace(os.sep, '/'))
+)
+
+
+def capture_still(raw_name=None):
+    """
+    cam0全分辨率拍照并应用白平衡增益
+    raw_name 不为空时同一请求内同时取回RAW，交给后台线程写入 SAVE_DIR/raw_name，不额外增加采集时间
+    """
+    if raw_name:
+        rgb, bayer, raw_metadata = cam0.capture_raw_config()
+        raw_writer.submit(os.path.join(SAVE_DIR, raw_name), bayer, raw_metadata)
+    else:
+        rgb = cam0.capture_config()
+    rgb[:,:,0] = rgb[:,:,0] * cam0.r_gain
+    rgb[:,:,2] = rgb[:,:,2] * cam0.b_gain
+    return correct_frame(rgb)
+
 
 queues_dict = {
     'rgb': multiprocessing.Queue(),
@@ -354,6 +476,9 @@ def record_video():
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     current_video_filename = os.path.join(SAVE_DIR, f'{timestamp}.avi')
     config.video_writer = cv2.VideoWriter(current_video_filename, fourcc, imx477_dict["frame_rate"], cam0.video_size, isColor=True)
+    # 按实际写入速率估算剩余可录时长，空间将满时提前结束录像，保证文件完整
+    write_rate = 1 / config.recording_interval if config.recording_interval > 0 else imx477_dict["frame_rate"]
+    space_monitor = RecordingSpaceMonitor(storage, write_rate)
     i, max_frame = 0, 20000
     while config.is_recording or not queues_dict['rgb'].empty():
         rgb = queues_dict['rgb'].get()
@@ -366,7 +491,16 @@ def record_video():
         else:
             config.is_recording = False
         i += 1
+        if i % 20 == 0:
+            space_state = space_monitor.check(current_video_filename, i)
+            if space_state == 'warn':
+                send_log_message(f'存储空间即将不足，剩余约 {space_monitor.warn_seconds} 秒录像空间', 'warning')
+            elif space_state == 'stop':
+                send_log_message('存储空间不足，录像已自动停止', 'error')
+                config.is_recording = False
+                break
     config.video_writer.release()
+    storage.register(os.path.basename(current_video_filename))
 
 
 def record_video_cam1():
@@ -376,6 +510,8 @@ def record_video_cam1():
     timestamp = time.strftime("%Y%m%d-%H%M%S")
     config.current_video_filename_cam1 = os.path.join(SAVE_DIR, f'cam1_{timestamp}.avi')
     config.video_writer_cam1 = cv2.VideoWriter(config.current_video_filename_cam1, fourcc, 10, cam1.video_size, isColor=True)
+    space_monitor = RecordingSpaceMonitor(storage, 10)
+    frames_written = 0
     
     send_log_message('辅助摄像头录制已开始', 'info')
     # 只选择图像视野中心1/4区域进行运动检测
@@ -455,6 +591,16 @@ def record_video_cam1():
             
             # 更新前一帧
             config.cam1_previous_frame = gray.copy()
+
+            frames_written += 1
+            if frames_written % 20 == 0:
+                space_state = space_monitor.check(config.current_video_filename_cam1, frames_written)
+                if space_state == 'warn':
+                    send_log_message('存储空间即将不足，辅助摄像头录像即将停止', 'warning')
+                elif space_state == 'stop':
+                    send_log_message('存储空间不足，辅助摄像头录像已自动停止', 'error')
+                    config.is_recording_cam1 = False
+                    break
             
         except Exception as e:
             print(f"Cam1 recording error: {e}")
@@ -464,6 +610,7 @@ def record_video_cam1():
     if config.video_writer_cam1 is not None:
         config.video_writer_cam1.release()
         config.video_writer_cam1 = None
+    storage.register(os.path.basename(config.current_video_filename_cam1))
     
     send_log_message('辅助摄像头录制已停止', 'info')
 
@@ -611,6 +758,7 @@ def handle_capture():
     # 使用Pillow进行编码
     img_byte_arr = io.BytesIO()
     pil_image.save(img_byte_arr, format='jpeg')
+    save_capture(f'{timestamp}.jpeg', img_byte_arr.getvalue())
     file_data = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
     emit('capture_response', {
         'success': True,
@@ -621,6 +769,161 @@ def handle_capture():
     cam0.preview_config()
 
 
+@socketio.on('capture_raw')
+def handle_capture_raw():
+    """RAW拍照：保存12-bit Bayer数据（.raw12.npz）和对应的JPEG"""
+    try:
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        raw_name = f'{timestamp}{RAW_SUFFIX}'
+        rgb = capture_still(raw_name=raw_name)
+        img_byte_arr = io.BytesIO()
+        Image.fromarray(rgb).save(img_byte_arr, format='jpeg')
+        save_capture(f'{timestamp}.jpeg', img_byte_arr.getvalue())
+        raw_writer.wait()
+        send_log_message(f'RAW拍照成功: {raw_name}', 'success')
+        emit('capture_raw_response', {
+            'success': True,
+            'filename': f'{timestamp}.jpeg',
+            'raw_filename': raw_name,
+            'data': base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+        })
+    except Exception as e:
+        print(f"RAW capture error: {e}")
+        send_log_message(f'RAW拍照失败: {str(e)}', 'error')
+        emit('capture_raw_response', {'success': False, 'error': str(e)})
+    finally:
+        cam0.preview_config()
+
+
+@socketio.on('capture_low_noise')
+def handle_capture_low_noise(data=None):
+    """
+    低噪声拍照：直接从正在运行的视频流中取N帧做均值/中值合成，不切换到拍照模式
+    data: {'frames': 帧数, 'method': 'mean'|'median', 'register': 是否配准, 'upsample': 是否放大到拍照分辨率}
+    """
+    data = data or {}
+    try:
+        n_frames = max(1, min(64, int(data.get('frames', 8))))
+        averager = FrameAverager(
+            n_frames,
+            method=data.get('method', 'mean'),
+            register=bool(data.get('register', False)),
+        )
+        send_log_message(f'低噪声拍照: 合成 {n_frames} 帧...', 'info')
+        # 丢弃队列中可能存在的旧帧
+        while not queues_dict['rgb'].empty():
+            try:
+                queues_dict['rgb'].get_nowait()
+            except Exception:
+                break
+        while not averager.add(queues_dict['rgb'].get(timeout=5.0)):
+            pass
+        output_size = cam0.image_size if data.get('upsample', False) else None
+        rgb = averager.result(output_size)
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        filename = f'lownoise_{timestamp}.jpeg'
+        img_byte_arr = io.BytesIO()
+        Image.fromarray(rgb).save(img_byte_arr, format='jpeg')
+        save_capture(filename, img_byte_arr.getvalue())
+        send_log_message(f'低噪声拍照成功: {filename}', 'success')
+        emit('capture_response', {
+            'success': True,
+            'filename': filename,
+            'data': base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+        })
+    except Exception as e:
+        print(f"Low noise capture error: {e}")
+        send_log_message(f'低噪声拍照失败: {str(e)}', 'error')
+        emit('capture_response', {'success': False, 'error': str(e)})
+
+
+@socketio.on('capture_flat_field')
+def handle_capture_flat_field(data=None):
+    """
+    采集当前倍率和LED设置下的平场/暗场参考：从视频流取N帧做均值
+    data: {'type': 'flat'|'dark', 'frames': 帧数}
+    flat: 移开样品或对准空白区域后采集；dark: 自动关闭LED采集，结束后恢复
+    参考图按全画幅保存，数字变焦或传感器ROI时拒绝采集
+    """
+    data = data or {}
+    kind = data.get('type', 'flat')
+    key = flat_field_key()  # 暗场也记在当前LED设置下
+    enabled, config.flat_field = config.flat_field, False  # 参考图必须来自未校正的帧
+    leds = (led_0.led_cycle, led_1.led_cycle)
+    try:
+        if kind not in FlatFieldCorrector.KINDS:
+            raise ValueError(f'未知的参考类型: {kind}')
+        if cam0.field_region() is not None:
+            raise ValueError('当前为数字变焦或ROI画面，请恢复全画幅后再采集参考图')
+        n_frames = max(1, min(64, int(data.get('frames', 16))))
+        if kind == 'dark':
+            led_0.set_led_power(0)
+            led_1.set_led_power(0)
+        time.sleep(0.5)  # 等待LED和自动曝光稳定
+        send_log_message(f'采集{"暗场" if kind == "dark" else "平场"}参考 {key}: 平均 {n_frames} 帧...', 'info')
+        while not queues_dict['rgb'].empty():
+            try:
+                queues_dict['rgb'].get_nowait()
+            except Exception:
+                break
+        averager = FrameAverager(n_frames)
+        while not averager.add(queues_dict['rgb'].get(timeout=5.0)):
+            pass
+        flat_field.save_reference(key, kind, averager.average(), frames=n_frames,
+                                  exposure_time=cam0.exposure_time, analogue_gain=cam0.analogue_gain)
+        send_log_message(f'参考图已保存: {key}/{kind}', 'success')
+        emit('flat_field_response', {'success': True, 'key': key, 'type': kind,
+                                     'ready': flat_field.has_reference(key)})
+    except Exception as e:
+        print(f"Flat field capture error: {e}")
+        send_log_message(f'参考图采集失败: {str(e)}', 'error')
+        emit('flat_field_response', {'success': False, 'error': str(e)})
+    finally:
+        if kind == 'dark':
+            led_0.set_led_power(leds[0])
+            led_1.set_led_power(leds[1])
+        config.flat_field = enabled
+
+
+@socketio.on('set_flat_field')
+def handle_set_flat_field(data):
+    """开关平场校正，返回当前设置是否已有参考图和全部已保存的参考"""
+    try:
+        config.flat_field = bool(data.get('value', False))
+        key = flat_field_key()
+        if config.flat_field and not flat_field.has_reference(key):
+            send_log_message(f'当前倍率/LED设置 {key} 没有平场参考，采集前不做校正', 'warning')
+        emit('flat_field_set', {'status': 'success', 'value': config.flat_field, 'key': key,
+                                'ready': flat_field.has_reference(key), 'references': flat_field.references()})
+    except Exception as e:
+        emit('flat_field_set', {'status': 'error', 'message': str(e)})
+
+
+@socketio.on('delete_flat_field')
+def handle_delete_flat_field(data):
+    """删除一组平场/暗场参考，data: {'key': 分组名（见 set_flat_field 返回的 references）}"""
+    try:
+        key = data.get('key')
+        if key not in flat_field.references():
+            raise ValueError(f'没有平场参考: {key}')
+        flat_field.delete(key)
+        send_log_message(f'平场参考已删除: {key}', 'info')
+        emit('flat_field_deleted', {'status': 'success', 'key': key, 'references': flat_field.references()})
+    except Exception as e:
+        emit('flat_field_deleted', {'status': 'error', 'message': str(e)})
+
+
+@socketio.on('set_keep_raw')
+def handle_set_keep_raw(data):
+    """景深堆叠和拼接扫描时是否同时保存每一帧的RAW"""
+    try:
+        config.keep_raw = bool(data.get('value', False))
+        emit('keep_raw_set', {'status': 'success', 'value': config.keep_raw})
+    except Exception as e:
+        emit('keep_raw_set', {'status': 'error', 'message': str(e)})
+
+
 @socketio.on('capture_cam1')
 def handle_capture_cam1():
     try:
@@ -668,6 +971,11 @@ def handle_start_recording(data=None):
         if data and 'interval' in data:
             config.recording_interval = float(data['interval'])
         
+        # 空间不足时先按配额策略淘汰旧文件，仍不足则拒绝录像
+        if not storage.ensure_space(config.min_recording_mb * 1024**2):
+            emit('recording_status', {'recording': False, 'message': '存储空间不足，无法开始录像', 'error': True})
+            return
+        
         config.is_recording = True
         threading.Thread(target=record_video).start()
         
@@ -716,6 +1024,10 @@ def handle_start_recording_cam1():
             emit('recording_cam1_status', {'recording': False, 'message': '主摄像头正在录制中，请先停止主摄像头录制', 'error': True})
             return
         
+        if not storage.ensure_space(config.min_recording_mb * 1024**2):
+            emit('recording_cam1_status', {'recording': False, 'message': '存储空间不足，无法开始录像', 'error': True})
+            return
+        
         config.is_recording_cam1 = True
         threading.Thread(target=record_video_cam1).start()
         emit('recording_cam1_status', {'recording': True, 'message': '辅助摄像头录制已开始'})
@@ -746,85 +1058,174 @@ def handle_stop_recording_cam1():
         emit('recording_cam1_response', {'success': False, 'error': 'Cam1 recording is not in progress'})
 
 
+def camera_field_of_view_mm():
+    """cam0拍照视野 (宽, 高) mm，由当前倍率下的像素尺寸得到，拼接网格和扫描规划共用"""
+    return tuple(n * cam0.pixel_size / 1000 for n in cam0.image_size)
+
+
+def stitch_grid_moves():
+    """
+    3x3拼接网格的相对移动序列（电机步数），从当前位置出发先移到左上角
+    """
+    # 每张图片移动视野的80%，相邻tile保留20%重叠
+    fov_x, fov_y = camera_field_of_view_mm()
+    step_x_size = int(motor_x.steps_per_mm * 0.8 * fov_x)
+    step_y_size = int(motor_y.steps_per_mm * 0.8 * fov_y)
+    # 拍摄3x3网格的图片，从左上角开始
+    # 贪吃蛇形状运动：左上→右上→右中→右下→中下→中中→中上→左中→左上
+    # 每张图片移动步长，确保有足够重叠区域进行拼接
+    return [
+        (-step_x_size, -step_y_size),     # 左上
+        (step_x_size, 0),     # 中上
+        (step_x_size, 0),      # 右上
+        (0, step_y_size),      # 右中
+        (-step_x_size, 0),     # 中中
+        (-step_x_size, 0),      # 左中
+        (0, step_y_size),     # 左下
+        (step_x_size, 0),     # 中下
+        (step_x_size, 0),      # 右下
+    ]
+
+
+def stitch_pixels_per_step():
+    """
+    拼接用的平台步数 -> 图像像素换算 (x, y)，由像素尺寸标定值(μm/像素)得到；
+    符号为标定的平台轴方向（config.stage_axis_signs）
+    """
+    pixel_size = getattr(cam0, 'pixel_size', 0.09)
+    sign_x, sign_y = config.stage_axis_signs
+    return (sign_x * 1000.0 / (motor_x.steps_per_mm * pixel_size),
+            sign_y * 1000.0 / (motor_y.steps_per_mm * pixel_size))
+
+
+def preview_gray():
+    """当前预览帧的float32灰度图（先丢弃一帧，避免取到移动过程中的画面）"""
+    _ = queues_dict['rgb'].get(timeout=5.0)
+    gray = cv2.cvtColor(queues_dict['rgb'].get(timeout=5.0), cv2.COLOR_RGB2GRAY)
+    return gray.astype(np.float32)
+
+
+def measure_view_shift(motor, steps):
+    """
+    电机移动 steps 步前后各取一帧预览，相位相关测得的视野移动（拍照分辨率像素 (x, y)）及响应值；
+    结束后电机回到原位
+    """
+    before = preview_gray()
+    motor.move(steps)
+    time.sleep(0.2)
+    after = preview_gray()
+    motor.move(-steps)
+    time.sleep(0.2)
+    window = cv2.createHanningWindow(before.shape[::-1], cv2.CV_32F)
+    (sx, sy), response = cv2.phaseCorrelate(before, after, window)
+    scale = cam0.image_size[0] / before.shape[1]
+    # 画面内容移动 (sx, sy)，视野（tile位置）向相反方向移动
+    return -sx * scale, -sy * scale, response
+
+
+@socketio.on('calibrate_stage_axes')
+def handle_calibrate_stage_axes(data=None):
+    """
+    标定平台轴方向和像素尺寸：X、Y各移动约1/4视野，在预览流上测量视野移动方向和距离。
+    需要视野内有清晰的样品纹理；data 可选 {'pixel_size': 是否同时更新像素尺寸(默认是)}
+    """
+    data = data or {}
+    try:
+        signs, sizes = [], []
+        fov_x, fov_y = camera_field_of_view_mm()
+        for axis, (motor, fov) in enumerate(((motor_x, fov_x), (motor_y, fov_y))):
+            steps = max(1, int(motor.steps_per_mm * fov / 4))
+            shift = measure_view_shift(motor, steps)
+            if shift[2] < 0.1:
+                raise ValueError(f'{motor.direction}轴移动未能配准（响应 {shift[2]:.2f}），请移到有纹理的区域')
+            signs.append(1 if shift[axis] > 0 else -1)
+            sizes.append(1000.0 * steps / (motor.steps_per_mm * abs(shift[axis])))
+        config.stage_axis_signs = signs
+        if data.get('pixel_size', True):
+            cam0.pixel_size = float(np.mean(sizes))
+        config.save_settings()
+        send_log_message(f'平台轴方向: X {signs[0]:+d}, Y {signs[1]:+d}，像素尺寸 {cam0.pixel_size:.4f} μm', 'success')
+        emit('stage_axes_calibrated', {'success': True, 'signs': signs, 'pixel_size': cam0.pixel_size,
+                                       'measured_pixel_size': sizes})
+    except Exception as e:
+        print(f"Stage axis calibration error: {e}")
+        send_log_message(f'平台轴标定失败: {str(e)}', 'error')
+        emit('stage_axes_calibrated', {'success': False, 'error': str(e)})
+
+
 @socketio.on('stitch_images')
 def handle_stitch_images():
     try:
         # 发送开始拼接的状态
         emit('stitch_status', {'status': 'started', 'message': '开始图像拼接...'})
         
-        # 实现400%画幅拼接（2x2网格）
-        # 拍摄4张图片，每张图片移动一定距离
-        images = []
-        
+        # 3x3网格流水线扫描：移动到下一个位置的同时，已拍摄的tile在后台线程配准并融合
         # 保存当前位置
         original_x = motor_x.pos
         original_y = motor_y.pos
-        mag_scale = 20/cam0.mag_scale
-        # 计算移动步长（根据图像分辨率和视野计算）
-        # 假设图像视野为0.4mm x 0.3mm，需要50%重叠区域
-        # 每张图片移动0.2mm，确保有足够重叠
-        step_x_size = int(motor_x.steps_per_mm * 0.32*mag_scale)  # 0.32mm步长，确保30%重叠
-        step_y_size = int(motor_y.steps_per_mm * 0.24*mag_scale)  # 0.24mm步长，确保30%重叠
-        # 拍摄3x3网格的图片，从左上角开始
-        # 贪吃蛇形状运动：左上→右上→右中→右下→中下→中中→中上→左中→左上
-        # 每张图片移动步长，确保有足够重叠区域进行拼接
-        positions = [
-            (-step_x_size, -step_y_size),     # 左上
-            (step_x_size, 0),     # 中上
-            (step_x_size, 0),      # 右上
-            (0, step_y_size),      # 右中
-            (-step_x_size, 0),     # 中中
-            (-step_x_size, 0),      # 左中
-            (0, step_y_size),     # 左下
-            (step_x_size, 0),     # 中下
-            (step_x_size, 0),      # 右下
-        ]
-        
-        for i, (dx, dy) in enumerate(positions):
-            send_log_message(f'拍摄第 {i+1}/9 张拼接图片', 'info')
+        positions = stitch_grid_moves()
+        scan_timestamp = time.strftime("%Y%m%d-%H%M%S")
+        
+        def move(dx, dy):
             # 移动到指定位置
             if dx != 0:
                 motor_x.move(dx)
                 time.sleep(0.1)  # 等待移动完成，确保稳定
-            
             if dy != 0:
                 motor_y.move(dy)
                 time.sleep(0.1)  # 等待移动完成，确保稳定
-            
-            fast_focus(steps=50)
-            time.sleep(0.2)
-            # 拍摄图片
-            rgb = cam0.capture_config()
-            rgb[:,:,0] = rgb[:,:,0] * cam0.r_gain
-            rgb[:,:,2] = rgb[:,:,2] * cam0.b_gain
-
-            images.append(rgb)
+        
+        # 第一张tile完整对焦，之后按已对焦tile拟合的焦面预测Z，只做短程精测
+        surface = FocusSurface()
+        
+        def settle():
+            predictive_focus(surface)
             time.sleep(0.2)
-            # 恢复预览模式
-            cam0.preview_config()
         
-        # 恢复原始位置
-        motor_x.move(original_x - motor_x.pos)
-        time.sleep(0.1)
+        # 保留拍摄的tile，平移配准不可靠时改用通用拼接
+        tiles = []
         
-        motor_y.move(original_y - motor_y.pos)
-        time.sleep(0.1)
+        def capture(i):
+            send_log_message(f'拍摄第 {i+1}/{len(positions)} 张拼接图片', 'info')
+            raw_name = f'stitch_{scan_timestamp}/tile_{i:03d}{RAW_SUFFIX}' if config.keep_raw else None
+            tiles.append(capture_still(raw_name=raw_name))
+            return tiles[-1]
         
-        # 拼接图像
-        send_log_message('正在处理图像拼接...', 'info')
-        stitched_image = stitch_images(images, positions)
+        def on_tile(i, corner):
+            socketio.emit('stitch_status', {'status': 'progress', 'current': i+1, 'total': len(positions),
+                                            'message': f'已拼接 {i+1}/{len(positions)} 张'})
+        
+        pipeline = ScanPipeline(positions, move, capture, stitch_pixels_per_step(),
+                                settle=settle, after_capture=cam0.preview_config, on_tile=on_tile)
+        try:
+            stitched_image = pipeline.run()
+        finally:
+            raw_writer.wait()
+            # 恢复原始位置
+            motor_x.move(original_x - motor_x.pos)
+            time.sleep(0.1)
+            motor_y.move(original_y - motor_y.pos)
+            time.sleep(0.1)
+        print(f"拼接扫描耗时: {pipeline.timings}")
+        try:
+            pipeline.check_registration()
+        except StitchingError as e:
+            send_log_message(f'平移配准不可靠（{e}），改用特征匹配拼接', 'warning')
+            calibration_dir = os.path.join(STITCH_CALIBRATION_DIR, f'{int(cam0.mag_scale)}x')
+            stitched_image = stitch_images(tiles, positions, stitch_pixels_per_step(), calibration_dir=calibration_dir,
+                                           flat_field=config.flat_field, translation=False)
         
         if stitched_image is not None:
             stitched_image = cv2.cvtColor(stitched_image, cv2.COLOR_BGR2RGB)
             
             
-            # 生成拼接后的图像文件名（不保存到本地）
+            # 生成拼接后的图像文件名
             timestamp = time.strftime("%Y%m%d-%H%M%S")
             stitched_filename = f'stitched_{timestamp}.jpeg'
             
-            # 直接将拼接图像转换为base64，不保存到本地
-            # 使用cv2.imencode将图像编码为内存中的字节流
+            # 使用cv2.imencode将图像编码为内存中的字节流，保存一份并生成缩略图
             _, buffer = cv2.imencode('.jpeg', stitched_image)
+            save_capture(stitched_filename, buffer.tobytes())
             file_data = base64.b64encode(buffer).decode('utf-8')
             
             emit('stitch_response', {
@@ -846,61 +1247,394 @@ def handle_stitch_images():
         })
 
 
+@socketio.on('tile_scan')
+def handle_tile_scan(data=None):
+    """
+    任意区域拼接扫描（如整张盖玻片），结果写成DeepZoom金字塔 SAVE_DIR/scans/<scan_id>/mosaic.dzi
+    data:
+        {'bbox': [x0, y0, x1, y1]} 或 {'polygon': [[x, y], ...]}：平台坐标（mm，即电机位置/每毫米步数）
+        {'width_mm': w, 'height_mm': h}：以当前位置为中心的矩形（默认1mm x 1mm）
+        {'resume': scan_id}：继续中断的扫描，已拍摄的tile从文件读取，不再移动；
+            扫描在之前的启动中拍摄时，需先把视野移回最后完成的tile附近，据此重新定位（reanchor_scan）
+        可选 'overlap'（默认0.2）、'order'（auto/serpentine/raster/nearest）、'focus'（每个tile自动对焦，默认True）、
+        'focus_map'（默认True：先在 'focus_anchors' 个锚点（默认9）完整对焦并拟合焦面，各tile只在预测Z附近精测；
+        False 时每个tile完整对焦）、'focus_model'（auto/constant/plane/quadratic/tps）
+    """
+    data = data or {}
+    original_x, original_y = motor_x.pos, motor_y.pos
+    scans_root = os.path.join(SAVE_DIR, 'scans')
+    tile_saver = ThreadPoolExecutor(max_workers=1)
+    manifest = None
+    scan_prefix, scan_was_pinned, cover = None, False, None
+    try:
+        here = (motor_x.pos / motor_x.steps_per_mm, motor_y.pos / motor_y.steps_per_mm)
+        if data.get('resume'):
+            # 只接受已有的扫描目录名，不能借此访问或固定/删除其他路径
+            scan_id = data['resume']
+            if (not isinstance(scan_id, str) or '/' in scan_id or os.sep in scan_id or '..' in scan_id
+                    or not os.path.isdir(scans_root) or scan_id not in os.listdir(scans_root)):
+                raise ValueError(f'没有找到扫描: {scan_id}')
+            manifest = ScanManifest.load(os.path.join(scans_root, scan_id))
+            if manifest.scan_id != scan_id:
+                raise ValueError(f'扫描清单 {scan_id} 与目录不符: {manifest.scan_id}')
+        else:
+            if 'bbox' in data or 'polygon' in data:
+                region = {key: data[key] for key in ('bbox', 'polygon') if key in data}
+            else:
+                w, h = float(data.get('width_mm', 1.0)), float(data.get('height_mm', 1.0))
+                region = {'bbox': [here[0] - w/2, here[1] - h/2, here[0] + w/2, here[1] + h/2]}
+            manifest = ScanManifest.create(
+                scans_root, region, camera_field_of_view_mm(),
+                overlap=float(data.get('overlap', 0.2)), order=data.get('order', 'auto'), start=here,
+                backlash_mm=motor_x.backlash_margin / motor_x.steps_per_mm, magnification=cam0.mag_scale,
+                session=STAGE_SESSION,
+            )
+        # 扫描目录（tile、RAW、金字塔）作为一个存储单元，扫描期间固定，不会被配额淘汰掉一部分
+        scan_prefix = f'scans/{manifest.scan_id}'
+        storage.register_dir(scan_prefix)
+        scan_was_pinned = storage.is_pinned(scan_prefix)
+        storage.pin(scan_prefix)
+        # 续扫时文件已被删除的tile需要重拍
+        done = {i for i in manifest.done_indices()
+                if os.path.exists(os.path.join(SAVE_DIR, manifest.tiles[i]['file']))}
+        preview_filename = f'{scan_prefix}/mosaic_preview.jpeg'
+        if (manifest.is_complete() and len(done) == len(manifest.tiles)
+                and os.path.exists(os.path.join(SAVE_DIR, preview_filename))):
+            # 已完成的扫描不再重复拼接，直接返回已有结果
+            with open(os.path.join(SAVE_DIR, preview_filename), 'rb') as f:
+                preview_data = f.read()
+            emit('tile_scan_response', {
+                'success': True,
+                'scan_id': manifest.scan_id,
+                'dzi': f'{scan_prefix}/mosaic.dzi',
+                'filename': preview_filename,
+                'data': base64.b64encode(preview_data).decode('utf-8'),
+                **manifest.summary(),
+            })
+            return
+        if manifest.data.get('session') != STAGE_SESSION:
+            reanchor_scan(manifest, done)
+        total = len(manifest.tiles)
+        pending = [t for t in manifest.tiles if t['index'] not in done]
+        # 剩余tile的电机行程，便于前端预估扫描时间
+        travel = planned_travel(pending, stage_position_mm(), motor_x.backlash_margin / motor_x.steps_per_mm)
+        emit('tile_scan_status', {'status': 'started', **manifest.summary(), 'travel_mm': travel['travel_mm']})
+        send_log_message(f'拼接扫描 {manifest.scan_id}: 共 {total} 个tile，已完成 {len(done)} 个', 'info')
+        
+        focus = data.get('focus', True)
+        surface, focus_stats = None, {}
+        if focus and data.get('focus_map', True):
+            surface = FocusSurface(model=data.get('focus_model', 'auto'))
+            # 续扫时沿用之前的锚点和已拍摄tile的Z
+            anchor_points = manifest.data.get('focus_anchors', [])
+            surface.add_points(anchor_points + [(manifest.tiles[i]['x_mm'], manifest.tiles[i]['y_mm'], manifest.tiles[i]['z'])
+                                                for i in done if manifest.tiles[i]['z'] is not None])
+            anchor_count = int(data.get('focus_anchors', 9)) - len(surface)
+            if anchor_count > 0 and pending:
+                anchors = [pending[k] for k in select_anchors([(t['x_mm'], t['y_mm']) for t in pending], anchor_count)]
+                anchors = order_tiles(anchors, 'nearest', start=stage_position_mm(),
+                                      backlash_mm=motor_x.backlash_margin / motor_x.steps_per_mm)
+                anchor_points = anchor_points + focus_anchor_pass(surface, anchors)
+                manifest.update(focus_anchors=anchor_points)
+            if surface.ready:
+                send_log_message(f'焦面: {surface.fitted_model}，{len(surface)} 个对焦点，残差 {surface.residual_std:.1f} 步', 'info')
+        
+        # 各tile中心的绝对电机位置 -> 相对移动序列
+        moves, previous = [], (motor_x.pos, motor_y.pos)
+        for target in manifest.target_steps(motor_x.steps_per_mm, motor_y.steps_per_mm):
+            moves.append((target[0] - previous[0], target[1] - previous[1]))
+            previous = target
+        
+        def move(dx, dy):
+            if dx != 0:
+                motor_x.move(dx)
+                time.sleep(0.1)
+            if dy != 0:
+                motor_y.move(dy)
+                time.sleep(0.1)
+        
+        def settle():
+            if surface is not None:
+                predictive_focus(surface, stats=focus_stats)
+            elif focus:
+                fast_focus(steps=50)
+            time.sleep(0.2)
+        
+        def save_tile(i, bgr, z):
+            filename = f'{scan_prefix}/tile_{i:05d}.jpeg'
+            cv2.imwrite(os.path.join(SAVE_DIR, filename), bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            storage.register(filename)
+            manifest.mark_done(i, filename, z)
+        
+        def capture(i):
+            if i in done:
+                return cv2.imread(os.path.join(SAVE_DIR, manifest.tiles[i]['file']))
+            raw_name = f'{scan_prefix}/tile_{i:05d}{RAW_SUFFIX}' if config.keep_raw else None
+            bgr = cv2.cvtColor(capture_still(raw_name=raw_name), cv2.COLOR_RGB2BGR)
+            # JPEG编码和清单更新在后台进行，清单只在tile落盘后才标记完成
+            tile_saver.submit(save_tile, i, bgr, motor_z.pos)
+            return bgr
+        
+        def on_tile(i, corner):
+            socketio.emit('tile_scan_progress', {'scan_id': manifest.scan_id, 'current': i + 1, 'total': total})
+        
+        pipeline = ScanPipeline(moves, move, capture, stitch_pixels_per_step(), settle=settle,
+                                after_capture=cam0.preview_config, on_tile=on_tile, skip=done,
+                                dzi_path=os.path.join(SAVE_DIR, scan_prefix, 'mosaic.dzi'))
+        writer = pipeline.run()
+        tile_saver.shutdown(wait=True)
+        print(f"拼接扫描耗时: {pipeline.timings}，对焦: {focus_stats}")
+        try:
+            pipeline.check_registration()
+        except StitchingError as e:
+            # 金字塔已按平台先验写出，无法改用其他拼接方式，提示检查步数换算和轴方向（calibrate_stage_axes）
+            send_log_message(f'拼接配准不可靠，结果主要按平台位置拼接: {e}', 'warning')
+        
+        _, buffer = cv2.imencode('.jpeg', writer.preview())
+        save_capture(preview_filename, buffer.tobytes())
+        cover = preview_filename
+        emit('tile_scan_response', {
+            'success': True,
+            'scan_id': manifest.scan_id,
+            'dzi': f'{scan_prefix}/mosaic.dzi',
+            'filename': preview_filename,
+            'data': base64.b64encode(buffer).decode('utf-8'),
+            'focus': focus_stats,
+            **manifest.summary(),
+        })
+    
+    except Exception as e:
+        print(f"Tile scan error: {e}")
+        emit('tile_scan_response', {
+            'success': False,
+            'error': str(e),
+            # 可用 {'resume': scan_id} 继续
+            'scan_id': manifest.scan_id if manifest is not None else None,
+        })
+    finally:
+        tile_saver.shutdown(wait=True)
+        raw_writer.wait()
+        if scan_prefix is not None:
+            # 金字塔等文件写完后整体重新统计，预览图作为图库中的封面
+            storage.register_dir(scan_prefix, cover=cover)
+            storage.pin(scan_prefix, scan_was_pinned)
+        # 恢复原始位置
+        motor_x.move(original_x - motor_x.pos)
+        time.sleep(0.1)
+        motor_y.move(original_y - motor_y.pos)
+        time.sleep(0.1)
+        cam0.preview_config()
+
+
+def reanchor_scan(manifest, done, min_response=0.1):
+    """
+    跨会话续扫前重新定位：清单中的平台位置是上一次启动时的电机坐标，本次启动后电机位置已归零。
+    需要先把视野移回最后完成的tile附近（偏差小于半个视野），当前预览与该tile相位相关得到XY偏移，
+    在该处重新对焦得到Z偏移，清单中的位置随之平移并记录本次会话号；无法配准时拒绝续扫
+    """
+    if not done:
+        raise ValueError(f'扫描 {manifest.scan_id} 在之前的启动中开始且没有已完成的tile，无法确定平台位置，请重新开始扫描')
+    last = max(done)
+    tile = manifest.tiles[last]
+    current = preview_gray()
+    reference = cv2.imread(os.path.join(SAVE_DIR, tile['file']), cv2.IMREAD_GRAYSCALE)
+    reference = cv2.resize(reference, current.shape[::-1], interpolation=cv2.INTER_AREA).astype(np.float32)
+    window = cv2.createHanningWindow(current.shape[::-1], cv2.CV_32F)
+    (sx, sy), response = cv2.phaseCorrelate(reference, current, window)
+    if response < min_response:
+        raise ValueError(f'扫描 {manifest.scan_id} 在之前的启动中拍摄，电机位置已重置；'
+                         f'请把视野移到第 {last + 1} 个tile（最后完成的tile）附近后再续扫（配准响应 {response:.2f}）')
+    # 画面内容移动 (sx, sy)，视野相对该tile向相反方向移动；拍照分辨率像素 -> 电机步数
+    scale = cam0.image_size[0] / current.shape[1]
+    pixels_per_step = stitch_pixels_per_step()
+    view_x = -sx * scale / pixels_per_step[0]
+    view_y = -sy * scale / pixels_per_step[1]
+    target_x, target_y = manifest.target_steps(motor_x.steps_per_mm, motor_y.steps_per_mm)[last]
+    dx_mm = (motor_x.pos - target_x - view_x) / motor_x.steps_per_mm
+    dy_mm = (motor_y.pos - target_y - view_y) / motor_y.steps_per_mm
+    dz = 0
+    if tile['z'] is not None:
+        fast_focus(steps=50)
+        dz = motor_z.pos - tile['z']
+    manifest.reanchor(dx_mm, dy_mm, dz, session=STAGE_SESSION)
+    send_log_message(f'扫描 {manifest.scan_id} 已重新定位: X {dx_mm:+.3f} mm, Y {dy_mm:+.3f} mm, Z {dz:+d} 步', 'info')
+
+
+def focus_anchor_pass(surface, anchors, steps=50):
+    """依次移到各锚点tile中心完整对焦并加入焦面，返回对焦点 [[x, y, z], ...]（mm, mm, 步数）"""
+    points = []
+    for k, tile in enumerate(anchors):
+        send_log_message(f'焦面锚点对焦 {k+1}/{len(anchors)}', 'info')
+        motor_x.move_to_target(int(round(tile['x_mm'] * motor_x.steps_per_mm)))
+        time.sleep(0.1)
+        motor_y.move_to_target(int(round(tile['y_mm'] * motor_y.steps_per_mm)))
+        time.sleep(0.1)
+        fast_focus(steps=steps)
+        x_mm, y_mm = stage_position_mm()
+        surface.add(x_mm, y_mm, motor_z.pos)
+        points.append([x_mm, y_mm, motor_z.pos])
+    return points
+
+
+def save_height_map(base_name, focus_curve, z_positions, colors, points=True, mesh=False):
+    """
+    由焦点曲线计算高度图（μm）并导出16位TIFF，可选PLY点云和网格，
+    z_positions 为各层相对电机步数，返回保存的文件名列表
+    """
+    z_um = z_steps_to_um(z_positions, motor_z.steps_per_mm)
+    height, confidence = height_from_focus(*focus_curve, z_um)
+    pixel_size = getattr(cam0, 'pixel_size', 0.09)
+    filenames = [f'{base_name}_height.tiff', f'{base_name}_height.json']
+    save_height_tiff16(os.path.join(SAVE_DIR, filenames[0]), height, confidence)
+    if points:
+        filenames.append(f'{base_name}_points.ply')
+        save_ply_points(os.path.join(SAVE_DIR, filenames[-1]), height, pixel_size, colors, confidence)
+    if mesh:
+        filenames.append(f'{base_name}_mesh.ply')
+        save_ply_mesh(os.path.join(SAVE_DIR, filenames[-1]), height, pixel_size, colors)
+    for filename in filenames:
+        storage.register(filename)
+    return filenames
+
+
+def capture_z_stack(stacker, executor, z_positions, raw_prefix, on_slice=None, volume=None):
+    """
+    以当前Z为基准逐层移动并拍摄，每层提交到 executor（单线程）流式合并到 stacker，
+    合并与电机移动到下一层重叠进行，同时最多只有一层在处理，避免积压多张全分辨率图像。
+    volume 不为空时每层同时写入体数据（ZarrVolumeWriter）。
+    返回最后一层的Future，调用方在需要结果前等待它；结束时Z停在最后一层
+    """
+    def fold_slice(i, rgb):
+        if volume is not None:
+            volume.write_slice(i, rgb)
+        # 转换为BGR格式（OpenCV格式）后合并到堆叠结果
+        stacker.add_slice(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
+    
+    start_z = motor_z.pos
+    pending = None
+    for i, dz in enumerate(z_positions):
+        send_log_message(f'拍摄第 {i+1}/{len(z_positions)} 张景深图片', 'info')
+        # 移动到指定Z位置（上一层在后台合并）
+        motor_z.move_to_target(start_z + dz)
+        time.sleep(0.1)  # 等待移动完成，确保稳定
+        
+        # 拍摄图片
+        raw_name = f'{raw_prefix}/z_{i:03d}{RAW_SUFFIX}' if config.keep_raw else None
+        rgb = capture_still(raw_name=raw_name)
+        
+        if pending is not None:
+            pending.result()
+        pending = executor.submit(fold_slice, i, rgb)
+        if on_slice is not None:
+            on_slice(i)
+    return pending
+
+
+def open_z_volume(name, z_positions):
+    """在SAVE_DIR下创建Z堆栈体数据（Zarr），尺寸为拍照分辨率，Z位置按电机步数换算为μm"""
+    width, height = cam0.image_size
+    return ZarrVolumeWriter(
+        os.path.join(SAVE_DIR, name), len(z_positions), height, width,
+        pixel_size_um=getattr(cam0, 'pixel_size', 0.09),
+        z_positions_um=z_steps_to_um(z_positions, motor_z.steps_per_mm),
+    )
+
+
+def plan_adaptive_z(step_z_size, max_slices=31):
+    """
+    自适应Z范围：在预览流上逐步采样分区清晰度（AdaptiveZSweep），
+    返回需要拍摄的相对Z位置（步数，升序）。扫描结束后电机回到起始位置
+    """
+    original_z = motor_z.pos
+    sweep = AdaptiveZSweep(step_z_size, max_slices=max_slices)
+    try:
+        z = sweep.next_position()
+        while z is not None:
+            motor_z.move_to_target(original_z + z)
+            _ = queues_dict['rgb'].get(timeout=5.0)  # 丢弃移动过程中的帧
+            sweep.add(z, region_focus_scores(queues_dict['rgb'].get(timeout=5.0)))
+            z = sweep.next_position()
+    finally:
+        motor_z.move_to_target(original_z)
+    positions = sweep.capture_positions()
+    send_log_message(f'自适应Z范围: 采样 {len(sweep.samples)} 层，拍摄 {len(positions)} 层', 'info')
+    return positions
+
+
 @socketio.on('focus_stack')
-def handle_focus_stack():
+def handle_focus_stack(data=None):
+    """
+    景深堆叠：逐层拍摄并由后台线程流式合并（StreamingFocusStack），
+    当前层的处理与电机移动到下一层重叠进行，内存占用与层数无关
+    data 可选 {'slices': 层数(默认7), 'adaptive': 按焦点曲线自动决定范围和层数(默认否),
+               'height_map': 是否导出高度图(默认是), 'mesh': 是否导出网格(默认否),
+               'save_volume': 是否把全部切片保存为Zarr体数据(默认否),
+               'quality': 'fast' 逐像素选择(默认) | 'quality' 拉普拉斯金字塔融合}
+    """
+    data = data or {}
+    stack_executor = ThreadPoolExecutor(max_workers=1)
+    volume = None
     try:
         # 发送开始景深堆叠的状态
         emit('focus_stack_status', {'status': 'started', 'message': '开始景深堆叠...'})
         
-        # 拍摄不同Z轴位置的5张照片
-        images = []
-        
         # 保存当前Z位置
         original_z = motor_z.pos
-        # 计算Z轴移动步长（每张图片间隔0.02mm，总共覆盖0.08mm景深）
+        # 计算Z轴移动步长（每张图片间隔0.02mm），以当前位置为中心对称分布
         step_z_size = int(config.z_level*2)  # 使用config.z_level参数
-        z_positions = [-3*step_z_size, -2*step_z_size, -step_z_size, 0, step_z_size, 2*step_z_size, 3*step_z_size]  # 7个位置
-        
-        for i, dz in enumerate(z_positions):
-            send_log_message(f'拍摄第 {i+1}/{len(z_positions)} 张景深图片', 'info')
-            # 移动到指定Z位置
-            motor_z.move_to_target(original_z + dz)
-            time.sleep(0.1)  # 等待移动完成，确保稳定
-            
-            # 拍摄图片
-            rgb = cam0.capture_config()
-            rgb[:,:,0] = rgb[:,:,0] * cam0.r_gain
-            rgb[:,:,2] = rgb[:,:,2] * cam0.b_gain
-            # 恢复预览模式
-            
-            # 转换为BGR格式（OpenCV格式）
-            bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-            images.append(bgr)
-            
+        if data.get('adaptive', False):
+            z_positions = plan_adaptive_z(step_z_size)
+        else:
+            n_slices = max(2, int(data.get('slices', 7)))
+            z_positions = [(i - (n_slices - 1) // 2) * step_z_size for i in range(n_slices)]
+        n_slices = len(z_positions)
+        quality = data.get('quality', 'fast')
+        if quality not in FOCUS_STACK_ENGINES:
+            raise ValueError(f"未知的景深堆叠模式: {quality}")
+        stacker = StreamingFocusStack(n_slices=n_slices, fusion=FOCUS_STACK_ENGINES[quality])
+        
+        def on_slice(i):
             # 发送进度更新
             emit('focus_stack_progress', {'current': i+1, 'total': len(z_positions)})
+        
+        stack_timestamp = time.strftime("%Y%m%d-%H%M%S")
+        volume_name = f'zstack_{stack_timestamp}.zarr'
+        if data.get('save_volume', False):
+            volume = open_z_volume(volume_name, z_positions)
+        pending = capture_z_stack(stacker, stack_executor, z_positions, f'zstack_{stack_timestamp}', on_slice, volume)
         cam0.preview_config()
         
         # 恢复原始Z位置
         motor_z.move_to_target(original_z)
-        time.sleep(0.2)
         
-        # 景深堆叠处理
+        # 等待最后一层合并完成
         send_log_message('正在处理景深堆叠...', 'info')
-        stacked_image, depthmap_image = focus_stack(images)
+        pending.result()
+        raw_writer.wait()
+        stacked_image, depthmap_image = stacker.result()
 
         if stacked_image is not None:
             # 生成景深堆叠后的图像文件名
             timestamp = time.strftime("%Y%m%d-%H%M%S")
             stacked_filename = f'focus_stacked_{timestamp}.jpeg'
             
-            # 直接将堆叠图像转换为base64，不保存到本地
+            # 编码堆叠图像，保存一份并生成缩略图
             _, buffer = cv2.imencode('.jpeg', stacked_image)
+            save_capture(stacked_filename, buffer.tobytes())
             file_data = base64.b64encode(buffer).decode('utf-8')
             
+            # 高度图及3D表面导出
+            height_files = []
+            if data.get('height_map', True):
+                send_log_message('正在生成高度图...', 'info')
+                height_files = save_height_map(f'focus_stacked_{timestamp}', stacker.focus_curve,
+                                               z_positions, stacked_image, mesh=data.get('mesh', False))
+            
             emit('focus_stack_response', {
                 'success': True,
                 'filename': stacked_filename,
+                'height_files': height_files,
+                'volume': volume_name if data.get('save_volume', False) else None,
                 'data': file_data
             })
         else:
@@ -916,9 +1650,130 @@ def handle_focus_stack():
             'error': str(e)
         })
     finally:
+        stack_executor.shutdown(wait=True)
+        if volume is not None:
+            # 中途失败时也登记已写入的块；.zarr目录整体记账和淘汰，不会只删掉其中的块
+            volume.close()
+            storage.register_dir(volume_name)
         cam0.preview_config()
 
 
+@socketio.on('edf_scan')
+def handle_edf_scan(data=None):
+    """
+    扩展景深拼接扫描：在3x3网格的每个位置拍摄一组Z堆叠并流式合并，只保留合成后的tile（JPEG）及其高度图。
+    扫描按 ScanPipeline 流水线进行：tile k 的合成收尾和高度图计算在预处理线程进行，同时平台移动到 tile k+1；
+    合成的tile直接配准并写入DeepZoom金字塔 <scan_dir>/mosaic.dzi，
+    各tile的高度图按同样的位置合成 <scan_dir>/height_mosaic.tiff（与金字塔最高分辨率层像素对齐）
+    data 可选 {'slices': 每个位置的层数(默认5), 'quality': 'fast'(默认) | 'quality'，同 focus_stack}
+    """
+    data = data or {}
+    stack_executor = ThreadPoolExecutor(max_workers=1)
+    original_x, original_y, original_z = motor_x.pos, motor_y.pos, motor_z.pos
+    scan_dir, cover = None, None
+    try:
+        emit('edf_scan_status', {'status': 'started', 'message': '开始扩展景深拼接扫描...'})
+        
+        step_z_size = int(config.z_level*2)
+        n_slices = max(2, int(data.get('slices', 5)))
+        z_positions = [(i - (n_slices - 1) // 2) * step_z_size for i in range(n_slices)]
+        quality = data.get('quality', 'fast')
+        if quality not in FOCUS_STACK_ENGINES:
+            raise ValueError(f"未知的景深堆叠模式: {quality}")
+        moves = stitch_grid_moves()
+        scan_dir = f'edf_{time.strftime("%Y%m%d-%H%M%S")}'
+        os.makedirs(os.path.join(SAVE_DIR, scan_dir), exist_ok=True)
+        height_files = {}
+        
+        def move(dx, dy):
+            if dx != 0:
+                motor_x.move(dx)
+                time.sleep(0.1)
+            if dy != 0:
+                motor_y.move(dy)
+                time.sleep(0.1)
+        
+        def settle():
+            fast_focus(steps=50)
+        
+        def capture(i):
+            send_log_message(f'扩展景深扫描: 第 {i+1}/{len(moves)} 个位置', 'info')
+            tile_z = motor_z.pos
+            stacker = StreamingFocusStack(n_slices=n_slices, fusion=FOCUS_STACK_ENGINES[quality])
+            last_slice = capture_z_stack(stacker, stack_executor, z_positions, f'{scan_dir}/tile_{i:03d}')
+            motor_z.move_to_target(tile_z)
+            return i, stacker, last_slice, tile_z
+        
+        def finish_tile(item):
+            # 预处理线程：等最后一层合并完成后收尾，同时平台已在移动到下一个位置
+            i, stacker, last_slice, tile_z = item
+            last_slice.result()
+            fused, _ = stacker.result()
+            tile_name = f'{scan_dir}/tile_{i:03d}'
+            _, buffer = cv2.imencode('.jpeg', fused)
+            save_capture(f'{tile_name}.jpeg', buffer.tobytes())
+            # 高度以扫描起始Z为零点，各tile的高度图可按拼接位置直接合成
+            z_from_start = [tile_z - original_z + dz for dz in z_positions]
+            height_files[i] = save_height_map(tile_name, stacker.focus_curve, z_from_start, fused, points=False)[0]
+            return fused
+        
+        def on_tile(i, corner):
+            socketio.emit('edf_scan_progress', {'current': i+1, 'total': len(moves)})
+        
+        pipeline = ScanPipeline(moves, move, capture, stitch_pixels_per_step(), settle=settle,
+                                after_capture=cam0.preview_config, preprocess=finish_tile, on_tile=on_tile,
+                                dzi_path=os.path.join(SAVE_DIR, scan_dir, 'mosaic.dzi'))
+        send_log_message('扩展景深扫描中，合成的tile边扫描边拼接...', 'info')
+        writer = pipeline.run()
+        raw_writer.wait()
+        print(f"扩展景深扫描耗时: {pipeline.timings}")
+        try:
+            pipeline.check_registration()
+        except StitchingError as e:
+            send_log_message(f'拼接配准不可靠，结果主要按平台位置拼接: {e}', 'warning')
+        
+        # 高度图按配准得到的位置和同样的接缝合成
+        corners = [pipeline.corners[i] for i in range(len(moves))]
+        sizes = writer.sizes.tolist()
+        height_filename = f'{scan_dir}/height_mosaic.tiff'
+        save_height_mosaic(os.path.join(SAVE_DIR, height_filename),
+                           [os.path.join(SAVE_DIR, height_files[i]) for i in range(len(moves))],
+                           corners, sizes, masks=pipeline.stitcher.seam_masks(corners, sizes),
+                           canvas=(*writer.origin, writer.width, writer.height))
+        
+        _, buffer = cv2.imencode('.jpeg', writer.preview())
+        preview_filename = f'{scan_dir}/mosaic_preview.jpeg'
+        save_capture(preview_filename, buffer.tobytes())
+        cover = preview_filename
+        emit('edf_scan_response', {
+            'success': True,
+            'dzi': f'{scan_dir}/mosaic.dzi',
+            'filename': preview_filename,
+            'height': height_filename,
+            'tiles': len(moves),
+            'data': base64.b64encode(buffer).decode('utf-8')
+        })
+    
+    except Exception as e:
+        print(f"EDF scan error: {e}")
+        emit('edf_scan_response', {
+            'success': False,
+            'error': str(e)
+        })
+    finally:
+        stack_executor.shutdown(wait=True)
+        raw_writer.wait()
+        if scan_dir is not None:
+            # 金字塔和高度图写完后整个扫描目录作为一个存储单元重新统计
+            storage.register_dir(scan_dir, cover=cover)
+        # 恢复原始位置
+        motor_x.move(original_x - motor_x.pos)
+        time.sleep(0.1)
+        motor_y.move(original_y - motor_y.pos)
+        time.sleep(0.1)
+        motor_z.move_to_target(original_z)
+        cam0.preview_config()
+
 
 @socketio.on('cell_count')
 def handle_cell_count():
@@ -1265,7 +2120,21 @@ def handle_fast_focus():
     fast_focus(steps=200)
 
 
-def fast_focus(steps=200):
+def fast_focus(steps=200, fast_roi=True):
+    """
+    自动对焦，fast_roi=True 时切换到传感器最高帧率模式并只读取视野中心窗口，
+    每步等待新帧的时间大幅缩短，对焦结束后恢复预览模式
+    """
+    if fast_roi:
+        cam0.fast_roi_config()
+    try:
+        focus_search(steps)
+    finally:
+        if fast_roi:
+            cam0.preview_config()
+
+
+def focus_search(steps=200):
     send_log_message('开始快速对焦...', 'info')
     motor_z.focus = True
     # 参数配置
@@ -1338,6 +2207,58 @@ def fast_focus(steps=200):
     send_log_message('对焦完成', 'success')
 
 
+def read_sharpness():
+    """当前位置的清晰度（丢弃移动过程中的帧）"""
+    _ = queues_dict['frame_len'].get()
+    return queues_dict['frame_len'].get()
+
+
+def stage_position_mm():
+    """平台当前位置 (x, y) mm"""
+    return motor_x.pos / motor_x.steps_per_mm, motor_y.pos / motor_y.steps_per_mm
+
+
+def predictive_focus(surface, steps=50, stats=None):
+    """
+    按焦面（FocusSurface）预测当前位置的Z，移动过去后只做短程精测；
+    焦面还没有对焦点、或精测范围内找不到峰值时退回完整对焦。结果加入焦面，边扫描边修正。
+    stats 不为空时累计 predicted / fallback 次数
+    """
+    x_mm, y_mm = stage_position_mm()
+    found = False
+    if surface.ready:
+        predicted = surface.predict(x_mm, y_mm)
+        # 焦面越不确定，精测范围越大
+        span = int(np.clip(np.ceil(2 * surface.residual_std / 10), 2, 5))
+        cam0.fast_roi_config()
+        try:
+            _, _, found = refine_focus(predicted, motor_z.move_to_target, read_sharpness, step=10, span=span)
+        finally:
+            cam0.preview_config()
+        if not found:
+            send_log_message(f'预测焦点 {predicted:.0f} 附近没有找到清晰峰值，改为完整对焦', 'warning')
+    if not found:
+        fast_focus(steps=steps)
+    if not surface.add(x_mm, y_mm, motor_z.pos):
+        send_log_message(f'对焦结果 {motor_z.pos} 偏离焦面，未用于预测', 'warning')
+    if stats is not None:
+        key = 'predicted' if found else 'fallback'
+        stats[key] = stats.get(key, 0) + 1
+    return motor_z.pos
+
+
+@socketio.on('set_digital_zoom')
+def handle_set_digital_zoom(data):
+    """数字变焦：由ISP通过ScalerCrop输出所选区域，而不是在CPU上截取"""
+    try:
+        zoom = float(data.get('zoom', 1.0))
+        center = (float(data.get('center_x', 0.5)), float(data.get('center_y', 0.5)))
+        crop = cam0.set_digital_zoom(zoom, center)
+        emit('digital_zoom_set', {'status': 'success', 'zoom': cam0.zoom, 'scaler_crop': list(crop)})
+    except Exception as e:
+        emit('digital_zoom_set', {'status': 'error', 'message': str(e)})
+
+
 @socketio.on('set_led_0')
 def handle_set_led_0(data):
     try:
@@ -1400,7 +2321,9 @@ def handle_set_magnification(data):
         if magnification not in valid_magnifications:
             raise ValueError(f"无效的倍率值: {magnification}")
         
-        # 更新cam0的mag_scale值
+        # 更新cam0的mag_scale值，像素尺寸随倍率反比缩放，保持已有标定
+        cam0.pixel_size = getattr(cam0, 'pixel_size', pixel_size_um(cam0.mag_scale, cam0.image_size[0])) \
+            * cam0.mag_scale / magnification
         cam0.mag_scale = magnification
         
         # 只保存倍率参数到settings.json
@@ -1412,8 +2335,9 @@ def handle_set_magnification(data):
             except FileNotFoundError:
                 settings = {}
             
-            # 只更新倍率参数
+            # 只更新倍率参数和随之变化的像素尺寸
             settings['magnification'] = cam0.mag_scale
+            settings['pixel_size'] = cam0.pixel_size
             
             # 保存更新后的配置
             with open('/home/admin/Documents/microscopy/settings.json', 'w') as f:
@@ -1523,7 +2447,7 @@ def handle_delete_video(data):
             return
         file_path = os.path.join(SAVE_DIR, filename)
         if os.path.exists(file_path):
-            os.remove(file_path)
+            storage.remove(filename)
             emit('delete_video_response', {'success': True, 'message': f'{filename} deleted'})
         else:
             emit('delete_video_response', {'success': False, 'error': 'File not found'})
@@ -1531,6 +2455,47 @@ def handle_delete_video(data):
         emit('delete_video_response', {'success': False, 'error': str(e)})
 
 
+@socketio.on('get_storage_status')
+def handle_get_storage_status():
+    try:
+        emit('storage_status', {'success': True, **storage.status()})
+    except Exception as e:
+        emit('storage_status', {'success': False, 'error': str(e)})
+
+
+@socketio.on('pin_file')
+def handle_pin_file(data):
+    """固定/取消固定文件，固定的文件不会被配额淘汰"""
+    try:
+        filename = data.get('filename')
+        pinned = bool(data.get('pinned', True))
+        if not storage.pin(filename, pinned):
+            emit('pin_file_response', {'success': False, 'error': 'File not found'})
+            return
+        emit('pin_file_response', {'success': True, 'filename': filename, 'pinned': pinned})
+    except Exception as e:
+        emit('pin_file_response', {'success': False, 'error': str(e)})
+
+
+@socketio.on('set_storage_quota')
+def handle_set_storage_quota(data):
+    try:
+        if 'quota_gb' in data:
+            config.storage_quota_gb = max(0.5, float(data['quota_gb']))
+        if 'reserve_mb' in data:
+            config.storage_reserve_mb = max(100, int(data['reserve_mb']))
+        if 'policy' in data:
+            if data['policy'] not in StorageManager.EVICTION_POLICIES:
+                raise ValueError(f"无效的淘汰策略: {data['policy']}")
+            config.storage_policy = data['policy']
+        config.apply_storage_settings()
+        # 持久化，否则下次连接时 load_settings 会恢复旧配额
+        config.save_settings()
+        emit('storage_status', {'success': True, **storage.status()})
+    except Exception as e:
+        emit('storage_status', {'success': False, 'error': str(e)})
+
+
 def check_wifi_permissions():
     """检查WiFi管理权限是否已配置"""
     try:
@@ -2665,6 +3630,36 @@ def get_settings():
     return jsonify(settings)
 
 
+@app.route('/api/gallery', methods=['GET'])
+def get_gallery():
+    """图库列表，只返回文件名和缩略图地址，图片本身由 /thumbnail 路由按需提供"""
+    items = []
+    for info in storage.list_files(ThumbnailCache.IMAGE_EXTS):  # 读取内存索引，不遍历目录
+        items.append({
+            'filename': info['filename'],
+            'mtime': info['created'],
+            'pinned': info['pinned'],
+            'thumb': f"/thumbnail/thumb/{info['filename']}",
+            'preview': f"/thumbnail/preview/{info['filename']}",
+        })
+    return jsonify(items)
+
+
+@app.route('/thumbnail/<level>/<path:filename>')
+def get_thumbnail(level, filename):
+    """返回缓存的缩略图/预览图，缓存被淘汰时按需重新生成"""
+    if level not in ThumbnailCache.LEVELS:
+        return jsonify({'error': f'Unknown level: {level}'}), 404
+    source_path = os.path.realpath(os.path.join(SAVE_DIR, filename))
+    if not source_path.startswith(os.path.realpath(SAVE_DIR) + os.sep):
+        return jsonify({'error': 'Invalid filename'}), 404
+    path = thumbnail_cache.get(filename, level)
+    storage.touch(filename)
+    if path is None:
+        return jsonify({'error': 'File not found'}), 404
+    return send_file(path, mimetype='image/jpeg', max_age=24 * 3600)
+
+
 # Background thread to send motor position updates
 def send_motor_positions():
     """Send motor positions every 200ms"""
@@ -2722,36 +3717,6 @@ def send_motor_positions():
 
 
 
-def cleanup_static_files():
-    """清理static文件夹下的缓存文件"""
-    try:
-        static_dir = '/home/admin/Documents/static'
-        if os.path.exists(static_dir):
-            # 删除.avi文件
-            for file in os.listdir(static_dir):
-                if file.endswith('.avi'):
-                    file_path = os.path.join(static_dir, file)
-                    try:
-                        os.remove(file_path)
-                        print(f"已删除缓存视频文件: {file}")
-                    except Exception as e:
-                        print(f"删除视频文件失败 {file}: {e}")
-            
-            # 删除.jpeg文件
-            for file in os.listdir(static_dir):
-                if file.endswith('.jpeg'):
-                    file_path = os.path.join(static_dir, file)
-                    try:
-                        os.remove(file_path)
-                        print(f"已删除缓存图片文件: {file}")
-                    except Exception as e:
-                        print(f"删除图片文件失败 {file}: {e}")
-        
-        print("缓存文件清理完成")
-    except Exception as e:
-        print(f"清理缓存文件时出错: {e}")
-
-
 def check_and_install_dependencies_for_update(microscopy_path):
     """在系统更新时检查并安装requirements.txt中的依赖包（支持日志消息发送）"""
     try:
@@ -2873,8 +3838,12 @@ if __name__ == "__main__":
     
     # 注意：依赖检查已在文件开头（所有 import 之前）完成
     
-    # 启动时清理缓存文件
-    cleanup_static_files()
+    # 启动时按已保存的配额检查SAVE_DIR占用，超出部分按淘汰策略清理；
+    # 磁盘空闲量只在写入前检查，启动时不为保留空间批量淘汰
+    config.load_storage_settings()
+    storage.enforce_quota(reserve=False)
+    status = storage.status()
+    print(f"存储占用: {status['used_bytes'] / 1024**2:.1f}MB / {status['quota_bytes'] / 1024**3:.1f}GB")
     
     # 检查WiFi权限配置
     print("检查WiFi管理权限...")
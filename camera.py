@@ -6,6 +6,7 @@ import numpy as np
 import time
 from utils import load_fused_perspective_transform
 from utils import load_transform_from_npz
+from raw_capture import bayer_pattern_from_format, raw_stream_to_bayer
 
 
 class VideoCamera(object):
@@ -24,6 +25,14 @@ class VideoCamera(object):
         self.apply_perspective = False
         self.mag_scale = 40
         self.normalize_intensity = False  # 强度归一化开关
+        # 传感器端ROI（ScalerCrop）与模式选择
+        self.zoom = 1.0  # 数字变焦倍数，1为全画幅
+        self.zoom_center = (0.5, 0.5)  # 变焦中心（相对坐标）
+        self.sensor_roi = None  # 当前下发的ScalerCrop (x, y, w, h)，None表示全画幅
+        self.fast_roi_active = False
+        self.fast_roi_region = None  # 高速ROI模式下画面在全画幅中的相对位置 (x, y, w, h)
+        self._sensor_modes = None
+        self.frame_correction = None  # 视频帧的原地校正函数 frame_correction(rgb)，如平场校正
 
 
     def __stop__(self):
@@ -34,8 +43,10 @@ class VideoCamera(object):
         预览模式设置，采集像素为2028*1520，这样才能看到全画幅以及高帧率
         """
         self.picam2.stop()
+        self.fast_roi_active = False
         preview_config = self.picam2.create_preview_configuration(
             main={"format": 'RGB888', "size": self.video_size},
+            raw=self._raw_stream_for(self.select_sensor_mode(self.video_size, self.framerate)),  # 优先使用binning模式读出
             queue=False,
             buffer_count=3,
             controls={
@@ -50,15 +61,145 @@ class VideoCamera(object):
         self.set_exposure()
         self.set_gain()
         self.set_framerate()
+        self.set_digital_zoom(self.zoom, self.zoom_center)  # 重新配置后恢复数字变焦
         time.sleep(0.5) #等待配置生效
         self.picam2.start()
 
 
+    @property
+    def sensor_modes(self):
+        """传感器支持的读出模式（picamera2枚举模式较慢，只查询一次）"""
+        if self._sensor_modes is None:
+            try:
+                self._sensor_modes = list(self.picam2.sensor_modes)
+            except Exception as e:
+                print(f"获取传感器模式失败: {e}")
+                self._sensor_modes = []
+        return self._sensor_modes
+
+    def select_sensor_mode(self, min_size=None, min_fps=0):
+        """
+        选择满足输出尺寸和帧率要求的最小传感器模式（binning模式读出像素少、帧率高）
+        min_size 为None时选择帧率最高的模式
+        """
+        modes = self.sensor_modes
+        if not modes:
+            return None
+        if min_size is None:
+            return max(modes, key=lambda m: (m.get('fps', 0), -m['size'][0] * m['size'][1]))
+        candidates = [
+            m for m in modes
+            if m['size'][0] >= min_size[0] and m['size'][1] >= min_size[1] and m.get('fps', 0) >= min_fps
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda m: m['size'][0] * m['size'][1])
+
+    @staticmethod
+    def _raw_stream_for(mode):
+        if mode is None:
+            return None
+        return {"size": mode['size'], "format": str(mode.get('unpacked', mode['format']))}
+
+    def _crop_limits(self, mode=None):
+        """当前模式在传感器像素坐标下可用的区域 (x, y, w, h)"""
+        if mode is not None and 'crop_limits' in mode:
+            return tuple(mode['crop_limits'])
+        crop_max = self.picam2.camera_properties.get('ScalerCropMaximum')
+        if crop_max:
+            return tuple(crop_max)
+        width, height = self.picam2.sensor_resolution
+        return (0, 0, width, height)
+
+    def scaler_crop_for(self, zoom=1.0, center=(0.5, 0.5), limits=None, aspect=None):
+        """
+        计算ScalerCrop矩形（传感器像素坐标），保持输出宽高比，并限制在可用区域内
+        """
+        lx, ly, lw, lh = limits or self._crop_limits()
+        if aspect is None:
+            aspect = self.video_size[0] / self.video_size[1]
+        zoom = max(1.0, float(zoom))
+        w = lw / zoom
+        h = w / aspect
+        if h > lh / zoom:
+            h = lh / zoom
+            w = h * aspect
+        w, h = int(w) & ~1, int(h) & ~1  # ISP要求偶数尺寸
+        x = int(lx + center[0] * lw - w / 2)
+        y = int(ly + center[1] * lh - h / 2)
+        x = min(max(x, lx), lx + lw - w)
+        y = min(max(y, ly), ly + lh - h)
+        return (x, y, w, h)
+
+    def set_digital_zoom(self, zoom=1.0, center=(0.5, 0.5)):
+        """
+        数字变焦：通过ScalerCrop让ISP只输出所选区域并缩放到输出尺寸，
+        预览和录像直接得到变焦后的画面，不再在CPU上截取
+        """
+        self.zoom = max(1.0, float(zoom))
+        self.zoom_center = (min(max(center[0], 0.0), 1.0), min(max(center[1], 0.0), 1.0))
+        if self.zoom == 1.0:
+            self.sensor_roi = None
+            crop = self._crop_limits()
+        else:
+            crop = self.scaler_crop_for(self.zoom, self.zoom_center)
+            self.sensor_roi = crop
+        self.picam2.set_controls({"ScalerCrop": crop})
+        return crop
+
+    def field_region(self):
+        """当前画面在全画幅中的相对位置 (x, y, w, h)，全画幅时返回None"""
+        if self.fast_roi_active:
+            return self.fast_roi_region
+        if self.sensor_roi is None:
+            return None
+        lx, ly, lw, lh = self._crop_limits()
+        x, y, w, h = self.sensor_roi
+        return ((x - lx) / lw, (y - ly) / lh, w / lw, h / lh)
+
+    def fast_roi_config(self, roi_fraction=0.25, output_size=(512, 384)):
+        """
+        自动对焦用的高速ROI模式：选择帧率最高的传感器读出模式，
+        ScalerCrop只取视野中心 roi_fraction 宽度的窗口，输出小尺寸图像
+        返回该模式的帧率
+        """
+        self.picam2.stop()
+        mode = self.select_sensor_mode()
+        fps = mode.get('fps', self.framerate) if mode else self.framerate
+        # 帧间隔不能短于曝光时间
+        frame_duration = max(int(1e6 / fps), int(self.exposure_time) + 1000)
+        limits = self._crop_limits(mode)
+        crop = self.scaler_crop_for(1.0 / roi_fraction, (0.5, 0.5), limits, aspect=output_size[0] / output_size[1])
+        fast_config = self.picam2.create_preview_configuration(
+            main={"format": 'RGB888', "size": output_size},
+            raw=self._raw_stream_for(mode),
+            queue=False,
+            buffer_count=3,
+            controls={
+                    "FrameDurationLimits": (frame_duration, frame_duration),
+                    "NoiseReductionMode": 2,
+                    "AwbMode": 0,
+                    "ExposureTime": self.exposure_time,
+                    "AnalogueGain": self.analogue_gain,
+                    "ScalerCrop": crop,
+                }
+        )
+        self.picam2.configure(fast_config)
+        self.picam2.start()
+        self.fast_roi_active = True
+        self.fast_roi_region = (
+            (crop[0] - limits[0]) / limits[2], (crop[1] - limits[1]) / limits[3],
+            crop[2] / limits[2], crop[3] / limits[3],
+        )
+        return 1e6 / frame_duration
+
+
     def capture_config(self):
         """
         拍照模式，全像素拍照
         """
         self.picam2.stop()
+        self.fast_roi_active = False
         capture_config = self.picam2.create_still_configuration(
             main={"format": 'RGB888', "size": self.image_size},  # 高分辨率图像（根据你的传感器调整）
             controls={"NoiseReductionMode": 2,  "AwbMode": 0}  # 启用降噪和白平衡等处理
@@ -72,6 +213,44 @@ class VideoCamera(object):
         return rgb
 
 
+    def capture_raw_config(self):
+        """
+        RAW拍照模式：一次请求同时取回ISP处理后的RGB图和传感器非打包12-bit Bayer数据
+        RAW不经过降噪，用于定量成像
+        返回: rgb, bayer(uint16), metadata
+        """
+        self.picam2.stop()
+        self.fast_roi_active = False
+        sensor_size = self.picam2.sensor_resolution
+        capture_config = self.picam2.create_still_configuration(
+            main={"format": 'RGB888', "size": self.image_size},
+            raw={"format": 'SRGGB12', "size": sensor_size},  # 非打包格式，每像素2字节
+            controls={"NoiseReductionMode": 2,  "AwbMode": 0}
+            )
+        self.picam2.configure(capture_config)
+        self.picam2.start()
+        (rgb, raw), request_metadata = self.picam2.capture_arrays(["main", "raw"])
+        raw_config = self.picam2.camera_configuration()['raw']
+        bit_depth = 12
+        metadata = {
+            'pattern': bayer_pattern_from_format(str(raw_config['format'])),
+            'bit_depth': bit_depth,
+            # SensorBlackLevels 按16位刻度给出，换算到传感器位深
+            'black_level': int(request_metadata.get('SensorBlackLevels', [4096])[0]) >> (16 - bit_depth),
+            'ExposureTime': request_metadata.get('ExposureTime', self.exposure_time),
+            'AnalogueGain': request_metadata.get('AnalogueGain', self.analogue_gain),
+            'ColourGains': [self.r_gain, self.b_gain],
+            'ColourCorrectionMatrix': list(request_metadata.get('ColourCorrectionMatrix', ())),
+            'pixel_size_um': self.pixel_size * self.image_size[0] / raw_config['size'][0],
+            'magnification': self.mag_scale,
+        }
+        bayer = raw_stream_to_bayer(raw, raw_config['size'][0])
+        if self.apply_perspective:
+            rgb = cv2.warpPerspective(rgb, self.cam1_params, self.cam1_output_size)
+            rgb = rgb[1000:, 800:2700]
+        return rgb, bayer, metadata
+
+
     def __start__(self):
         self.picam2.start()
 
@@ -138,6 +317,8 @@ class VideoCamera(object):
         if awb:
             rgb[:,:,0] = rgb[:,:,0] * self.r_gain  # 调整红色
             rgb[:,:,2] = rgb[:,:,2] * self.b_gain  # 调整绿色
+        if self.frame_correction is not None:
+            self.frame_correction(rgb)
         if flip:
             rgb = cv2.flip(rgb, 1)  # 0，上下翻转，1，水平翻转，-1，对角翻转
         if to_bgr:
@@ -160,7 +341,7 @@ class VideoCamera(object):
             # TO-DO视频录制失败
         else:
             if rgb.shape[0] > self.preview_size[0]:  #默认是video_size采集图像
-                if crap:
+                if crap and self.sensor_roi is None:  #传感器端已变焦时画面已经是所选区域，只需缩放
                     # 计算中心区域的起始位置
                     start_y = (rgb.shape[0] - self.preview_size[0]) // 2
                     start_x = (rgb.shape[1] - self.preview_size[1]) // 2
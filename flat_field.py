@@ -0,0 +1,199 @@
+"""
+平场/暗场校正
+
+- 参考图按 倍率 + LED功率 分组保存在 root/<key>/ 下：dark.npy、flat.npy（多帧均值，float32）和 meta.json
+- 由参考图预先算出 float32 增益图：gain = mean(flat - dark) / (flat - dark)，按通道归一化，
+  校正后整体亮度和白平衡不变，只去掉渐晕和光路中的固定不均匀
+- 校正在uint8帧上原地进行（cv2.subtract/cv2.multiply 写回原数组，饱和截断），不分配新图像；
+  按帧尺寸和视野区域缩放好的暗场/增益图会缓存，每帧只剩两次逐像素运算
+- 拼接时tile之间不再有渐晕造成的亮度接缝，只需便宜的曝光补偿（gain 或 no）
+"""
+
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+class FlatFieldCorrector:
+    """
+    平场/暗场参考管理与校正
+
+    region 为当前画面在全画幅中的相对位置 (x, y, w, h)（0~1），数字变焦或ROI模式下
+    从全画幅参考图中截取对应部分；为空时表示全画幅
+    """
+
+    KINDS = ('dark', 'flat')
+    MAX_CACHED_MAPS = 8
+
+    def __init__(self, root, max_gain=4.0, smooth_sigma=2.0):
+        """
+        参数:
+            root: 参考图目录
+            max_gain: 增益上限，避免光路遮挡处的噪声被无限放大
+            smooth_sigma: 计算增益前对平场做高斯平滑的sigma（像素），抑制参考图残余噪声
+        """
+        self.root = root
+        self.max_gain = max_gain
+        self.smooth_sigma = smooth_sigma
+        self._references = {}  # key -> (dark, gain)，参考图原尺寸
+        self._maps = {}  # (key, shape, region) -> (dark, gain)，已缩放到帧尺寸
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(magnification, led_values):
+        """倍率和各LED功率 -> 参考图分组名，如 '40x_led10_0'"""
+        return f"{int(magnification)}x_led" + '_'.join(str(int(v)) for v in led_values)
+
+    def _path(self, key, name):
+        return os.path.join(self.root, key, name)
+
+    def has_reference(self, key):
+        return os.path.exists(self._path(key, 'flat.npy'))
+
+    def references(self):
+        """已保存的参考图分组及其元数据"""
+        result = {}
+        for key in sorted(os.listdir(self.root)):
+            meta_path = self._path(key, 'meta.json')
+            if os.path.isfile(meta_path):
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    result[key] = json.load(f)
+        return result
+
+    def save_reference(self, key, kind, image, **meta):
+        """
+        保存暗场或平场参考（多帧均值，float32），并重新计算该分组的增益图
+
+        meta 中的参数（曝光、增益等）原样记录到 meta.json
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f"未知的参考类型: {kind}")
+        os.makedirs(os.path.join(self.root, key), exist_ok=True)
+        np.save(self._path(key, f'{kind}.npy'), np.asarray(image, dtype=np.float32))
+        meta_path = self._path(key, 'meta.json')
+        data = {}
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        data[kind] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'shape': list(np.shape(image)), **meta}
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        if self.has_reference(key):
+            np.save(self._path(key, 'gain.npy'), self.compute_gain(*self._load_dark_flat(key)))
+        self.invalidate(key)
+
+    def delete(self, key):
+        for name in ('dark.npy', 'flat.npy', 'gain.npy', 'meta.json'):
+            if os.path.exists(self._path(key, name)):
+                os.remove(self._path(key, name))
+        if os.path.isdir(os.path.join(self.root, key)) and not os.listdir(os.path.join(self.root, key)):
+            os.rmdir(os.path.join(self.root, key))
+        self.invalidate(key)
+
+    def invalidate(self, key=None):
+        """丢弃缓存的参考图和缩放后的校正图"""
+        with self._lock:
+            if key is None:
+                self._references.clear()
+                self._maps.clear()
+                return
+            self._references.pop(key, None)
+            for cache_key in [k for k in self._maps if k[0] == key]:
+                del self._maps[cache_key]
+
+    def _load_dark_flat(self, key):
+        flat = np.load(self._path(key, 'flat.npy'))
+        dark_path = self._path(key, 'dark.npy')
+        dark = np.load(dark_path) if os.path.exists(dark_path) else None
+        if dark is not None and dark.shape != flat.shape:
+            dark = cv2.resize(dark, (flat.shape[1], flat.shape[0]), interpolation=cv2.INTER_AREA)
+        return dark, flat
+
+    def compute_gain(self, dark, flat):
+        """平场扣除暗场后按通道归一化，返回float32增益图"""
+        signal = flat.astype(np.float32) if dark is None else cv2.subtract(flat, dark, dtype=cv2.CV_32F)
+        if self.smooth_sigma > 0:
+            signal = cv2.GaussianBlur(signal, (0, 0), self.smooth_sigma)
+        np.maximum(signal, 1.0, out=signal)
+        mean = signal.reshape(-1, signal.shape[2] if signal.ndim == 3 else 1).mean(axis=0)
+        gain = mean.astype(np.float32) / signal
+        np.minimum(gain, self.max_gain, out=gain)
+        return gain
+
+    def _reference(self, key):
+        if key not in self._references:
+            gain_path = self._path(key, 'gain.npy')
+            if not os.path.exists(gain_path):
+                return None
+            gain = np.load(gain_path)
+            dark_path = self._path(key, 'dark.npy')
+            dark = np.load(dark_path) if os.path.exists(dark_path) else None
+            self._references[key] = (dark, gain)
+        return self._references[key]
+
+    def maps(self, key, shape, region=None):
+        """
+        缩放到帧尺寸的 (暗场, 增益图)，没有该分组的参考时返回None
+        """
+        cache_key = (key, tuple(shape), None if region is None else tuple(round(v, 4) for v in region))
+        with self._lock:
+            if cache_key in self._maps:
+                return self._maps[cache_key]
+            reference = self._reference(key)
+            if reference is None:
+                return None
+            height, width = shape[:2]
+            maps = tuple(None if m is None else self._fit(m, (width, height), region) for m in reference)
+            if len(self._maps) >= self.MAX_CACHED_MAPS:
+                self._maps.pop(next(iter(self._maps)))
+            self._maps[cache_key] = maps
+            return maps
+
+    @staticmethod
+    def _fit(image, size, region):
+        if region is not None:
+            h, w = image.shape[:2]
+            x0, y0 = int(round(region[0] * w)), int(round(region[1] * h))
+            x1, y1 = int(round((region[0] + region[2]) * w)), int(round((region[1] + region[3]) * h))
+            image = image[max(y0, 0):min(y1, h), max(x0, 0):min(x1, w)]
+        if (image.shape[1], image.shape[0]) != tuple(size):
+            image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_LINEAR)
+        return np.ascontiguousarray(image)
+
+    def apply(self, frame, key, region=None):
+        """
+        原地校正uint8帧：frame = (frame - dark) * gain，返回是否已校正（无参考或通道数不符时不处理）
+        """
+        maps = self.maps(key, frame.shape, region)
+        if maps is None:
+            return False
+        dark, gain = maps
+        if gain.shape != frame.shape:
+            return False
+        if dark is not None:
+            cv2.subtract(frame, dark, dst=frame, dtype=cv2.CV_8U)
+        cv2.multiply(frame, gain, dst=frame, dtype=cv2.CV_8U)
+        return True
+
+
+def benchmark(shape=(1520, 2028, 3), repeat=50):
+    """单帧原地校正耗时（毫秒），用于确认视频帧率不受影响"""
+    import tempfile
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as root:
+        corrector = FlatFieldCorrector(root)
+        yy, xx = np.mgrid[-1:1:shape[0] * 1j, -1:1:shape[1] * 1j]
+        vignette = (1 - 0.4 * (xx ** 2 + yy ** 2))[..., None].astype(np.float32)
+        corrector.save_reference('bench', 'dark', np.full(shape, 8, np.float32))
+        corrector.save_reference('bench', 'flat', np.repeat(200 * vignette, shape[2], axis=2) + 8)
+        frame = rng.integers(0, 255, shape, dtype=np.uint8)
+        corrector.apply(frame, 'bench')
+        start = time.perf_counter()
+        for _ in range(repeat):
+            corrector.apply(frame, 'bench')
+        return (time.perf_counter() - start) / repeat * 1000
@@ -0,0 +1,273 @@
+"""
+预测焦面（focus map）
+
+拼接扫描时不再对每个tile做完整的粗测+精测对焦：
+- 先在少量锚点（select_anchors，在tile中心里按最远点采样，覆盖整个区域）完整对焦
+- 用锚点的 (x, y, z) 拟合焦面 FocusSurface（常数/平面/二次曲面/薄板样条），
+  拟合时按残差迭代剔除离群点（对焦失败、灰尘、盖玻片边缘等）
+- 每个tile移动到预测的Z后只做短程精测 refine_focus，结果再加入焦面，边扫描边修正
+
+XY 单位为 mm（平台坐标），Z 单位为电机步数
+"""
+
+import numpy as np
+
+FOCUS_MODELS = ('auto', 'constant', 'plane', 'quadratic', 'tps')
+# 多项式模型的系数个数
+_MODEL_TERMS = {'constant': 1, 'plane': 3, 'quadratic': 6}
+
+
+def select_anchors(points, count=9, start=None):
+    """
+    锚点选择：最远点采样，返回 points 中的序号
+
+    参数:
+        points: (N, 2) 候选位置（tile中心，mm）
+        count: 锚点个数
+        start: 第一个锚点附近的位置，默认取所有候选的中心
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0 or count <= 0:
+        return []
+    if start is None:
+        start = points.mean(axis=0)
+    first = int(np.argmin(np.hypot(*(points - start).T)))
+    anchors = [first]
+    distance = np.hypot(*(points - points[first]).T)
+    while len(anchors) < min(count, len(points)):
+        idx = int(np.argmax(distance))
+        if distance[idx] <= 0:
+            break
+        anchors.append(idx)
+        distance = np.minimum(distance, np.hypot(*(points - points[idx]).T))
+    return anchors
+
+
+def _poly_design(xy, terms):
+    x, y = xy[:, 0], xy[:, 1]
+    columns = [np.ones_like(x), x, y, x * x, x * y, y * y]
+    return np.stack(columns[:terms], axis=1)
+
+
+def _tps_kernel(a, b):
+    r2 = ((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = 0.5 * r2 * np.log(r2)
+    k[r2 == 0] = 0
+    return k
+
+
+class FocusSurface:
+    """
+    焦面 z = f(x, y)
+
+    model:
+        constant: 所有点的中位数
+        plane / quadratic: 最小二乘多项式
+        tps: 薄板样条（带平滑），能跟随玻片的局部起伏；
+             点数超过 max_points 时先按网格取中位数稀疏化，拟合量不随扫描规模增长
+        auto: 按点数选择，点太少或共线时自动退回更简单的模型
+    """
+
+    def __init__(self, model='auto', tolerance=20, outlier_sigma=3.0, smoothing=0.1, max_points=64):
+        """
+        参数:
+            tolerance: 残差不超过该值（步数）的点总是保留，避免对焦噪声把正常点判为离群
+            outlier_sigma: 离群阈值为 max(tolerance, outlier_sigma * 残差的稳健标准差)
+            smoothing: 薄板样条的平滑系数（归一化坐标下），越大越接近平面
+            max_points: 薄板样条的最大控制点数
+        """
+        if model not in FOCUS_MODELS:
+            raise ValueError(f"未知的焦面模型: {model}")
+        self.model = model
+        self.tolerance = tolerance
+        self.outlier_sigma = outlier_sigma
+        self.smoothing = smoothing
+        self.max_points = max_points
+        self.xy = np.zeros((0, 2))
+        self.z = np.zeros(0)
+        self.inliers = np.zeros(0, dtype=bool)
+        self.fitted_model = None
+        self.residual_std = 0.0
+        self._coeffs = None
+
+    def __len__(self):
+        return len(self.z)
+
+    @property
+    def ready(self):
+        return self.fitted_model is not None
+
+    def add(self, x, y, z, refit=True):
+        """加入一个对焦结果，返回它是否被当作有效点（非离群）"""
+        self.xy = np.vstack([self.xy, [[x, y]]])
+        self.z = np.append(self.z, float(z))
+        self.inliers = np.append(self.inliers, True)
+        if refit:
+            self.fit()
+        return bool(self.inliers[-1])
+
+    def add_points(self, points):
+        """批量加入 [(x, y, z), ...] 并拟合一次"""
+        for x, y, z in points:
+            self.add(x, y, z, refit=False)
+        self.fit()
+
+    def points(self):
+        """所有点 [[x, y, z], ...]，可写入扫描清单"""
+        return np.column_stack([self.xy, self.z]).tolist()
+
+    # ------------------------------------------------------------------
+    # 拟合
+    # ------------------------------------------------------------------
+    def _normalize(self, xy):
+        return (np.asarray(xy, dtype=np.float64).reshape(-1, 2) - self._center) / self._scale
+
+    def _choose_model(self, xy):
+        if self.model != 'auto':
+            return self.model
+        n = len(xy)
+        if n >= 16:
+            return 'tps'
+        if n >= 12:
+            return 'quadratic'
+        if n >= 4:
+            return 'plane'
+        return 'constant'
+
+    def _fit_model(self, model, xy, z):
+        """拟合系数；点共线等退化情况退回更简单的模型。返回 (实际模型, 系数)"""
+        if model == 'tps':
+            xy, z = self._thin(xy, z)
+            if len(z) >= 6 and np.linalg.matrix_rank(_poly_design(xy, 3)) == 3:
+                n = len(z)
+                P = _poly_design(xy, 3)
+                A = np.zeros((n + 3, n + 3))
+                A[:n, :n] = _tps_kernel(xy, xy) + self.smoothing * np.eye(n)
+                A[:n, n:] = P
+                A[n:, :n] = P.T
+                b = np.concatenate([z, np.zeros(3)])
+                solution = np.linalg.lstsq(A, b, rcond=None)[0]
+                return 'tps', (xy, solution[:n], solution[n:])
+            model = 'quadratic'
+        for name in ('quadratic', 'plane'):
+            if model != name:
+                continue
+            terms = _MODEL_TERMS[name]
+            design = _poly_design(xy, terms)
+            if len(z) >= terms and np.linalg.matrix_rank(design) == terms:
+                return name, np.linalg.lstsq(design, z, rcond=None)[0]
+            model = 'plane' if name == 'quadratic' else 'constant'
+        return 'constant', np.array([np.median(z)])
+
+    def _thin(self, xy, z):
+        """按网格取每格中位数，控制点数不超过 max_points"""
+        if len(z) <= self.max_points:
+            return xy, z
+        cells = int(np.sqrt(self.max_points))
+        low, high = xy.min(axis=0), xy.max(axis=0)
+        index = np.minimum(((xy - low) / np.maximum(high - low, 1e-9) * cells).astype(int), cells - 1)
+        keys = index[:, 1] * cells + index[:, 0]
+        thinned_xy, thinned_z = [], []
+        for key in np.unique(keys):
+            members = keys == key
+            thinned_xy.append(np.median(xy[members], axis=0))
+            thinned_z.append(np.median(z[members]))
+        return np.array(thinned_xy), np.array(thinned_z)
+
+    def _evaluate(self, model, coeffs, xy):
+        if model == 'constant':
+            return np.full(len(xy), coeffs[0])
+        if model == 'tps':
+            control, weights, affine = coeffs
+            return _tps_kernel(xy, control) @ weights + _poly_design(xy, 3) @ affine
+        return _poly_design(xy, len(coeffs)) @ coeffs
+
+    def fit(self):
+        """
+        稳健拟合：用不高于二次的模型迭代剔除残差超过阈值的点，再用选定模型拟合剩余点。
+        薄板样条几乎穿过每个控制点，不能用它自己的残差判断离群
+        """
+        if len(self.z) == 0:
+            self.fitted_model, self._coeffs = None, None
+            return
+        self._center = self.xy.mean(axis=0)
+        self._scale = max(np.ptp(self.xy, axis=0).max(), 1e-6)
+        xy = self._normalize(self.xy)
+        inliers = np.ones(len(self.z), dtype=bool)
+        model = self._choose_model(xy)
+        robust_model = 'quadratic' if model == 'tps' else model
+        for _ in range(5):
+            fitted, coeffs = self._fit_model(robust_model, xy[inliers], self.z[inliers])
+            residuals = np.abs(self.z - self._evaluate(fitted, coeffs, xy))
+            sigma = 1.4826 * np.median(residuals[inliers])
+            updated = residuals <= max(self.tolerance, self.outlier_sigma * sigma)
+            # 至少保留一半的点
+            if updated.sum() < (len(self.z) + 1) // 2:
+                updated = residuals <= np.median(residuals)
+            if np.array_equal(updated, inliers):
+                break
+            inliers = updated
+        self.inliers = inliers
+        self.fitted_model, self._coeffs = self._fit_model(self._choose_model(xy[inliers]), xy[inliers],
+                                                          self.z[inliers])
+        residuals = self.z[inliers] - self._evaluate(self.fitted_model, self._coeffs, xy[inliers])
+        self.residual_std = float(np.sqrt(np.mean(residuals ** 2)))
+
+    def predict(self, x, y):
+        """预测 (x, y) 处的焦点Z（步数），标量输入返回float"""
+        if not self.ready:
+            raise ValueError("焦面还没有对焦点")
+        xy = self._normalize(np.column_stack([np.ravel(x), np.ravel(y)]))
+        z = self._evaluate(self.fitted_model, self._coeffs, xy)
+        return float(z[0]) if np.ndim(x) == 0 else z.reshape(np.shape(x))
+
+
+def refine_focus(z0, move_to, sharpness, step=10, span=2, max_extend=6, min_rise=0.05):
+    """
+    在预测位置附近的短程精测
+
+    从 z0 - span*step 向上依次测到 z0 + span*step（同一方向移动，不受回程差影响），
+    峰值在边缘时沿该方向继续延伸，最多 max_extend 步；最后对峰值和两侧做抛物线插值并移动到该位置。
+
+    参数:
+        move_to: move_to(z) 移动Z电机到绝对位置并等待到位
+        sharpness: sharpness() -> 当前位置的清晰度
+        min_rise: 峰值需比最低值高出该比例才算找到焦点（排除无纹理区域）
+
+    返回:
+        (z, score, found)：found 为 False 表示范围内没有明显峰值，调用方应改用完整对焦
+    """
+    scores = {}
+    z0 = int(round(z0))
+
+    def measure(z):
+        move_to(z)
+        scores[z] = sharpness()
+        return scores[z]
+
+    for k in range(-span, span + 1):
+        measure(z0 + k * step)
+    for _ in range(max_extend):
+        positions = sorted(scores)
+        best = max(scores, key=scores.get)
+        if best == positions[-1]:
+            measure(best + step)
+        elif best == positions[0]:
+            measure(best - step)
+        else:
+            break
+
+    positions = sorted(scores)
+    best = max(scores, key=scores.get)
+    values = np.array([scores[z] for z in positions])
+    found = positions[0] < best < positions[-1] and values.max() > (1 + min_rise) * values.min()
+    z = best
+    if found:
+        # 抛物线顶点
+        left, right = scores[best - step], scores[best + step]
+        curvature = left - 2 * scores[best] + right
+        if curvature < 0:
+            z = int(round(best + 0.5 * step * (left - right) / curvature))
+    move_to(z)
+    return z, scores[best], bool(found)
@@ -32,6 +32,8 @@ from typing import List, Tuple, Optional
 import logging
 import time
 import warnings
+from height_map import neighbour_focus
+from concurrent.futures import ThreadPoolExecutor
 warnings.filterwarnings('ignore')
 
 # 设置日志
@@ -39,10 +41,103 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger(__name__)
 
 class LowPowerImageAligner:
-    """低算力图像对齐类 - 使用模板匹配替代ECC"""
+    """
+    低算力图像对齐类 - 降采样相位相关
+
+    参考图像的频谱只计算一次并缓存；每张切片在降采样、加汉宁窗的灰度图上估计平移，
+    峰值做质心亚像素插值，最后用一次 warpAffine 补偿。各切片在线程池中并行处理
+    """
+    
+    def __init__(self, scale: float = 0.25, workers: int = 4, max_shift: float = 0.25):
+        """
+        参数:
+            scale: 估计平移时的降采样比例
+            workers: 并行对齐的线程数（OpenCV运算会释放GIL）
+            max_shift: 允许的最大平移（占图像宽高的比例），超过时认为对齐失败，使用原图
+        """
+        self.scale = scale
+        self.workers = workers
+        self.max_shift = max_shift
+        self._ref_spectrum = None
+        self._small_size = None  # 降采样后的 (宽, 高)，取DFT最优尺寸
+        self._window = None
+        self._full_size = None
+    
+    def _prepare(self, img: np.ndarray) -> np.ndarray:
+        """降采样 -> 灰度 -> float32 -> 加窗"""
+        small = cv2.resize(img, self._small_size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        small = small.astype(np.float32)
+        small -= cv2.mean(small)[0]  # 去直流分量，减小窗函数边缘效应
+        return cv2.multiply(small, self._window)
+    
+    def set_reference(self, reference: np.ndarray):
+        """设置参考图像（彩色或灰度）并缓存其频谱"""
+        h, w = reference.shape[:2]
+        self._full_size = (w, h)
+        self._small_size = (cv2.getOptimalDFTSize(max(16, int(w * self.scale))),
+                            cv2.getOptimalDFTSize(max(16, int(h * self.scale))))
+        self._window = cv2.createHanningWindow(self._small_size, cv2.CV_32F)
+        self._ref_spectrum = cv2.dft(self._prepare(reference), flags=cv2.DFT_COMPLEX_OUTPUT)
+    
+    @staticmethod
+    def _subpixel_peak(correlation: np.ndarray) -> Tuple[float, float]:
+        """相关峰位置，按3x3邻域加权质心插值到亚像素，并换算为有符号的循环偏移"""
+        h, w = correlation.shape
+        _, _, _, (px, py) = cv2.minMaxLoc(correlation)
+        xs = np.arange(px - 1, px + 2)
+        ys = np.arange(py - 1, py + 2)
+        window = np.maximum(correlation[np.ix_(ys % h, xs % w)], 0)
+        total = window.sum()
+        if total <= 0:
+            dx, dy = float(px), float(py)
+        else:
+            dx = float((window.sum(axis=0) * xs).sum() / total)
+            dy = float((window.sum(axis=1) * ys).sum() / total)
+        if dx > w / 2:
+            dx -= w
+        if dy > h / 2:
+            dy -= h
+        return dx, dy
+    
+    def estimate_shift(self, img: np.ndarray) -> Tuple[float, float]:
+        """估计 img 相对参考图像的平移（全分辨率像素），img 需与参考图像同尺寸"""
+        spectrum = cv2.dft(self._prepare(img), flags=cv2.DFT_COMPLEX_OUTPUT)
+        cross = cv2.mulSpectrums(self._ref_spectrum, spectrum, 0, conjB=True)
+        re, im = cv2.split(cross)
+        magnitude = cv2.magnitude(re, im)
+        magnitude += 1e-8
+        cross = cv2.merge([re / magnitude, im / magnitude])
+        correlation = cv2.idft(cross, flags=cv2.DFT_REAL_OUTPUT)
+        dx, dy = self._subpixel_peak(correlation)
+        return (-dx * self._full_size[0] / self._small_size[0],
+                -dy * self._full_size[1] / self._small_size[1])
+    
+    def align_one(self, src_color: np.ndarray) -> np.ndarray:
+        """将一张图像对齐到参考图像，需先调用 set_reference"""
+        try:
+            dx, dy = self.estimate_shift(src_color)
+            w, h = self._full_size
+            
+            # 如果偏移量太大，使用原始图像
+            if abs(dx) > w * self.max_shift or abs(dy) > h * self.max_shift:
+                logger.warning(f"偏移量过大 ({dx:.1f}, {dy:.1f})，使用原始图像")
+                return src_color
+            # 小于0.1像素的平移在估计误差范围内，插值反而会使图像变模糊
+            if abs(dx) < 0.1 and abs(dy) < 0.1:
+                return src_color
+            
+            # 应用偏移
+            M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+            return cv2.warpAffine(src_color, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+            
+        except Exception as e:
+            logger.warning(f"相位相关对齐失败，使用原始图像: {e}")
+            return src_color
     
     def align_images(self, images: List[np.ndarray], reference_idx: int = -1) -> List[np.ndarray]:
-        """简化的图像对齐"""
+        """对齐全部图像到参考图像，参考图像原样返回"""
         if len(images) < 2:
             return images
         
@@ -50,86 +145,86 @@ class LowPowerImageAligner:
         if reference_idx < 0:
             reference_idx = len(images) // 2
         reference_idx = min(reference_idx, len(images) - 1)
+        self.set_reference(images[reference_idx])
         
-        aligned_images = [None] * len(images)
-        aligned_images[reference_idx] = images[reference_idx].copy()
-        
-        # 转换为灰度图进行对齐
-        ref_gray = cv2.cvtColor(images[reference_idx], cv2.COLOR_BGR2GRAY)
+        others = [i for i in range(len(images)) if i != reference_idx]
+        aligned_images = list(images)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for i, aligned in zip(others, executor.map(self.align_one, [images[i] for i in others])):
+                aligned_images[i] = aligned
         
-        for i, img in enumerate(images):
-            if i == reference_idx:
-                continue
-            
-            src_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            
-            # 使用简单的模板匹配进行对齐
-            aligned = self._simple_align(src_gray, ref_gray, img)
-            aligned_images[i] = aligned
-            
         return aligned_images
-    
-    def _simple_align(self, src_gray: np.ndarray, ref_gray: np.ndarray, src_color: np.ndarray) -> np.ndarray:
-        """简化的图像对齐 - 使用相位相关"""
-        try:
-            # 使用相位相关进行对齐
-            h, w = src_gray.shape
-            
-            # 转换为浮点数
-            src_float = src_gray.astype(np.float32)
-            ref_float = ref_gray.astype(np.float32)
-            
-            # 计算相位相关
-            src_fft = np.fft.fft2(src_float)
-            ref_fft = np.fft.fft2(ref_float)
-            
-            # 计算互相关
-            cross_power_spectrum = (src_fft * np.conj(ref_fft)) / (np.abs(src_fft * np.conj(ref_fft)) + 1e-8)
-            correlation = np.fft.ifft2(cross_power_spectrum)
-            correlation = np.real(correlation)
-            
-            # 找到最大相关位置
-            max_loc = np.unravel_index(np.argmax(correlation), correlation.shape)
-            
-            # 计算偏移量
-            dy = max_loc[0] if max_loc[0] < h//2 else max_loc[0] - h
-            dx = max_loc[1] if max_loc[1] < w//2 else max_loc[1] - w
-            
-            # 如果偏移量太大，使用原始图像
-            if abs(dx) > w//4 or abs(dy) > h//4:
-                logger.warning(f"偏移量过大 ({dx}, {dy})，使用原始图像")
-                return src_color.copy()
-            
-            # 应用偏移
-            M = np.float32([[1, 0, dx], [0, 1, dy]])
-            aligned = cv2.warpAffine(src_color, M, (w, h))
-            
-            return aligned
-            
-        except Exception as e:
-            logger.warning(f"相位相关对齐失败，使用原始图像: {e}")
-            return src_color.copy()
 
 
 class LowPowerFocusMeasure:
-    """低算力焦点测量类 - 使用改进的拉普拉斯算子"""
+    """
+    低算力焦点测量类
+
+    - 全程float32，各步骤原地运算，不产生整幅float64临时数组
+    - 按水平条带（带重叠边）在线程池中并行计算，OpenCV运算释放GIL，可用满4个核心
+    - 可选测量方法：'laplacian'（|拉普拉斯|^1.5）、'tenengrad'（Sobel梯度平方和）、
+      'modified_laplacian'（x、y方向二阶差分绝对值之和）
+    """
     
-    def compute(self, img: np.ndarray) -> np.ndarray:
-        """改进的焦点测量"""
-        # 使用拉普拉斯算子
-        laplacian = cv2.Laplacian(img, cv2.CV_64F)
-        focus_measure = np.abs(laplacian)
-        
-        # 增强对比度，使焦点差异更明显
-        focus_measure = np.power(focus_measure, 1.5)
+    MEASURES = ('laplacian', 'tenengrad', 'modified_laplacian')
+    # 条带上下扩展的行数：算子半径1 + 5x5高斯平滑半径2，再留1行余量
+    HALO = 4
+    
+    def __init__(self, method: str = 'laplacian', strip_rows: int = 512, workers: int = 4):
+        if method not in self.MEASURES:
+            raise ValueError(f"未知的焦点测量方法: {method}")
+        self.method = method
+        self.strip_rows = strip_rows
+        self.workers = workers
+        self._kernel_x = np.array([[-1, 2, -1]], dtype=np.float32)
+        self._kernel_y = self._kernel_x.T.copy()
+    
+    def _measure(self, img: np.ndarray) -> np.ndarray:
+        """对一个条带计算未归一化的焦点测量"""
+        if self.method == 'tenengrad':
+            gx = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=3)
+            gy = cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=3)
+            cv2.multiply(gx, gx, dst=gx)
+            cv2.multiply(gy, gy, dst=gy)
+            focus = cv2.add(gx, gy, dst=gx)
+        elif self.method == 'modified_laplacian':
+            focus = cv2.filter2D(img, cv2.CV_32F, self._kernel_x)
+            dy = cv2.filter2D(img, cv2.CV_32F, self._kernel_y)
+            np.abs(focus, out=focus)
+            np.abs(dy, out=dy)
+            cv2.add(focus, dy, dst=focus)
+        else:
+            focus = cv2.Laplacian(img, cv2.CV_32F)
+            np.abs(focus, out=focus)
+            # 增强对比度，使焦点差异更明显：x^1.5 = x*sqrt(x)，比 pow 的非整数幂快得多
+            cv2.multiply(focus, cv2.sqrt(focus), dst=focus)
         
         # 平滑处理，减少噪声影响
-        focus_measure = cv2.GaussianBlur(focus_measure, (5, 5), 1.0)
+        cv2.GaussianBlur(focus, (5, 5), 1.0, dst=focus)
+        return focus
+    
+    def _compute_strip(self, img: np.ndarray, out: np.ndarray, y0: int, y1: int) -> float:
+        h = img.shape[0]
+        top = max(0, y0 - self.HALO)
+        bottom = min(h, y1 + self.HALO)
+        focus = self._measure(img[top:bottom])
+        out[y0:y1] = focus[y0 - top:y1 - top]
+        return float(out[y0:y1].max())
+    
+    def compute(self, img: np.ndarray) -> np.ndarray:
+        """计算焦点测量，返回归一化到0-1的float32图"""
+        h = img.shape[0]
+        out = np.empty(img.shape[:2], dtype=np.float32)
+        bounds = [(y0, min(h, y0 + self.strip_rows)) for y0 in range(0, h, self.strip_rows)]
+        if len(bounds) > 1 and self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                maxima = list(executor.map(lambda b: self._compute_strip(img, out, *b), bounds))
+        else:
+            maxima = [self._compute_strip(img, out, y0, y1) for y0, y1 in bounds]
         
         # 归一化到0-1范围
-        focus_measure = focus_measure / (np.max(focus_measure) + 1e-8)
-        
-        return focus_measure
+        cv2.multiply(out, 1.0 / (max(maxima) + 1e-8), dst=out)
+        return out
 
 
 class LowPowerGrayscaleConverter:
@@ -155,6 +250,99 @@ class LowPowerGrayscaleConverter:
         return gray_images
 
 
+class PyramidFocusFusion:
+    """
+    拉普拉斯金字塔多尺度融合
+
+    每层细节系数在各切片间取绝对值最大者，顶层（低频）取平均，
+    相比逐像素硬选择可以避免光晕和椒盐状接缝。
+    按带重叠的分块处理，每块只保存一套金字塔，峰值内存与整幅图像大小无关
+    """
+    
+    def __init__(self, levels: int = 5, tile_size: int = 1024):
+        """
+        参数:
+            levels: 金字塔细节层数
+            tile_size: 分块输出尺寸（像素），每块向四周额外扩展 overlap 像素参与计算
+        """
+        self.levels = levels
+        self.tile_size = tile_size
+        # 重叠量覆盖顶层高斯核在原图上的作用范围，保证分块结果与整幅计算一致
+        self.overlap = 2 ** (levels + 2)
+    
+    def _laplacian_pyramid(self, img: np.ndarray) -> List[np.ndarray]:
+        pyramid = []
+        gauss = img
+        for _ in range(self.levels):
+            down = cv2.pyrDown(gauss)
+            up = cv2.pyrUp(down, dstsize=(gauss.shape[1], gauss.shape[0]))
+            pyramid.append(cv2.subtract(gauss, up))
+            gauss = down
+        pyramid.append(gauss)
+        return pyramid
+    
+    @staticmethod
+    def _collapse(pyramid: List[np.ndarray]) -> np.ndarray:
+        img = pyramid[-1]
+        for detail in reversed(pyramid[:-1]):
+            img = cv2.add(cv2.pyrUp(img, dstsize=(detail.shape[1], detail.shape[0])), detail)
+        return img
+    
+    @staticmethod
+    def _activity(band: np.ndarray) -> np.ndarray:
+        """细节系数的强度，彩色图像对各通道绝对值求和"""
+        activity = np.abs(band)
+        return activity.sum(axis=2) if activity.ndim == 3 else activity
+    
+    def fold(self, state: Optional[list], img: np.ndarray) -> list:
+        """
+        把一张切片并入融合状态 [细节层, 细节强度, 顶层累加, 张数]，state 为None时新建；
+        切片可以逐张到达（流式堆叠），不需要同时保存全部切片
+        """
+        pyramid = self._laplacian_pyramid(img.astype(np.float32))
+        if state is None:
+            return [pyramid[:-1], [self._activity(band) for band in pyramid[:-1]], pyramid[-1], 1]
+        fused, best_activity, base_sum, _ = state
+        for level, band in enumerate(pyramid[:-1]):
+            activity = self._activity(band)
+            better = activity > best_activity[level]
+            fused[level][better] = band[better]
+            np.maximum(best_activity[level], activity, out=best_activity[level])
+        cv2.add(base_sum, pyramid[-1], dst=base_sum)
+        state[3] += 1
+        return state
+    
+    def collapse_state(self, state: list) -> np.ndarray:
+        """融合状态 -> float32图像（未截断）"""
+        fused, _, base_sum, count = state
+        return self._collapse(fused + [base_sum / count])
+    
+    def _fuse_tile(self, tiles: List[np.ndarray]) -> np.ndarray:
+        state = None
+        for tile in tiles:
+            state = self.fold(state, tile)
+        return self.collapse_state(state)
+    
+    def fuse(self, images: List[np.ndarray]) -> np.ndarray:
+        """融合已对齐的切片，返回与输入同类型的uint8图像"""
+        h, w = images[0].shape[:2]
+        output = np.empty_like(images[0])
+        align = 2 ** self.levels
+        for y0 in range(0, h, self.tile_size):
+            for x0 in range(0, w, self.tile_size):
+                y1 = min(h, y0 + self.tile_size)
+                x1 = min(w, x0 + self.tile_size)
+                # 扩展重叠区域参与计算，只写回中心部分；
+                # 起点对齐到 2^levels，使各层降采样的相位与整幅计算相同
+                ey0 = max(0, y0 - self.overlap) // align * align
+                ex0 = max(0, x0 - self.overlap) // align * align
+                ey1, ex1 = min(h, y1 + self.overlap), min(w, x1 + self.overlap)
+                fused = self._fuse_tile([img[ey0:ey1, ex0:ex1] for img in images])
+                inner = fused[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+                output[y0:y1, x0:x1] = np.clip(inner, 0, 255).astype(np.uint8)
+        return output
+
+
 class LowPowerFocusStack:
     """低算力焦点堆叠主类"""
     
@@ -162,13 +350,17 @@ class LowPowerFocusStack:
         self.input_images = input_images
         self.output_image = None
         self.depthmap_image = None
+        self.focus_curve = None  # (峰值索引, 峰值焦点, 前一层焦点, 后一层焦点)，用于计算高度图
         self.verbose = False
         self.reference_idx = -1
+        self.strip_rows = 256  # 合成时按行条带处理，限制峰值内存；None表示整幅一次处理
+        self.fusion = 'argmax'  # 'argmax': 逐像素选择（快）；'pyramid': 拉普拉斯金字塔融合（质量高）
         
         # 初始化低算力组件
         self.image_aligner = LowPowerImageAligner()
         self.focus_measure = LowPowerFocusMeasure()
         self.grayscale_converter = LowPowerGrayscaleConverter()
+        self.pyramid_fusion = PyramidFocusFusion()
         
         
         
@@ -215,14 +407,21 @@ class LowPowerFocusStack:
             # 5. 简化的深度图生成
             depth_start = time.time()
             logger.info("生成简化深度图...")
-            self.depthmap_image = self._generate_simple_depthmap(focus_measures)
+            best_indices, best_values = self._select_best_focus(focus_measures)
+            self.depthmap_image = self._generate_simple_depthmap(focus_measures, best_indices)
+            self.focus_curve = (best_indices, best_values) + neighbour_focus(focus_measures, best_indices)
             depth_time = time.time() - depth_start
             logger.info(f"深度图生成完成: {depth_time:.2f}秒")
             
             # 6. 简化的焦点堆叠
             stack_start = time.time()
             logger.info("执行简化焦点堆叠...")
-            self.output_image = self._simple_focus_stack(aligned_images, focus_measures)
+            if self.fusion == 'pyramid':
+                self.output_image = self.pyramid_fusion.fuse(aligned_images)
+            else:
+                self.output_image = self._simple_focus_stack(
+                    aligned_images, focus_measures, best_indices, best_values, strip_rows=self.strip_rows
+                )
             stack_time = time.time() - stack_start
             logger.info(f"焦点堆叠完成: {stack_time:.2f}秒")
             
@@ -262,7 +461,22 @@ class LowPowerFocusStack:
         
         return images
     
-    def _generate_simple_depthmap(self, focus_measures: List[np.ndarray]) -> np.ndarray:
+    @staticmethod
+    def _select_best_focus(focus_measures: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        逐张比较求每个像素焦点值最大的图像索引及对应焦点值
+        与 np.argmax(np.stack(...)) 结果一致（并列时取靠前的索引），但不需要 (h, w, N) 的中间数组
+        """
+        best_values = focus_measures[0].copy()
+        best_indices = np.zeros(best_values.shape, dtype=np.intp)
+        for i, focus in enumerate(focus_measures[1:], start=1):
+            better = focus > best_values
+            best_indices[better] = i
+            np.maximum(best_values, focus, out=best_values)
+        return best_indices, best_values
+
+    def _generate_simple_depthmap(self, focus_measures: List[np.ndarray],
+                                  best_indices: Optional[np.ndarray] = None) -> np.ndarray:
         """生成改进的深度图"""
         if not focus_measures:
             return np.zeros((100, 100), dtype=np.uint8)
@@ -270,8 +484,8 @@ class LowPowerFocusStack:
         h, w = focus_measures[0].shape
         
         # 使用向量化操作提高效率
-        focus_matrix = np.stack(focus_measures, axis=2)  # (h, w, num_images)
-        best_indices = np.argmax(focus_matrix, axis=2)  # (h, w)
+        if best_indices is None:
+            best_indices, _ = self._select_best_focus(focus_measures)
         
         # 映射到0-255范围
         if len(focus_measures) > 1:
@@ -284,63 +498,312 @@ class LowPowerFocusStack:
         
         return depthmap
     
-    def _simple_focus_stack(self, color_images: List[np.ndarray], focus_measures: List[np.ndarray]) -> np.ndarray:
-        """改进的焦点堆叠"""
+    def _simple_focus_stack(self, color_images: List[np.ndarray], focus_measures: List[np.ndarray],
+                            best_indices: Optional[np.ndarray] = None, best_values: Optional[np.ndarray] = None,
+                            strip_rows: Optional[int] = None) -> np.ndarray:
+        """
+        改进的焦点堆叠（向量化）
+
+        每个像素取焦点值最大的图像；焦点值低于全图10%分位数的像素使用参考图像（中间图像）。
+        strip_rows 不为空时按行条带合成，每次只堆叠 (N, strip_rows, W, 3)，峰值内存与图像高度无关
+        """
         if not color_images or not focus_measures:
             return np.zeros((100, 100, 3), dtype=np.uint8)
         
         h, w = color_images[0].shape[:2]
-        result = np.zeros((h, w, 3), dtype=np.uint8)
+        result = np.empty_like(color_images[0])
         
-        # 创建焦点测量矩阵
-        focus_matrix = np.stack(focus_measures, axis=2)  # (h, w, num_images)
-        
-        # 找到每个像素的最佳图像索引
-        best_indices = np.argmax(focus_matrix, axis=2)  # (h, w)
+        # 找到每个像素的最佳图像索引及焦点值
+        if best_indices is None or best_values is None:
+            best_indices, best_values = self._select_best_focus(focus_measures)
         
         # 设置最小焦点阈值，避免选择模糊区域
-        max_focus_values = np.max(focus_matrix, axis=2)
-        min_threshold = np.percentile(max_focus_values, 10)  # 使用10%分位数作为阈值
+        min_threshold = np.percentile(best_values, 10)  # 使用10%分位数作为阈值
+        # 焦点值太低时使用参考图像（通常是中间图像）
+        ref_idx = len(color_images) // 2
+        indices = np.where(best_values < min_threshold, ref_idx, best_indices)
         
-        # 为每个像素选择最佳图像
-        for y in range(h):
-            for x in range(w):
-                best_idx = best_indices[y, x]
-                focus_value = focus_matrix[y, x, best_idx]
-                
-                # 如果焦点值太低，使用参考图像（通常是中间图像）
-                if focus_value < min_threshold:
-                    ref_idx = len(color_images) // 2
-                    result[y, x] = color_images[ref_idx][y, x]
-                else:
-                    result[y, x] = color_images[best_idx][y, x]
+        step = h if strip_rows is None else max(1, strip_rows)
+        for y0 in range(0, h, step):
+            y1 = min(h, y0 + step)
+            stack = np.stack([img[y0:y1] for img in color_images])  # (N, rows, W, 3)
+            strip_indices = indices[y0:y1, :, None] if stack.ndim == 4 else indices[y0:y1]
+            result[y0:y1] = np.take_along_axis(stack, strip_indices[None], axis=0)[0]
         
         return result
 
 
+class StreamingFocusStack:
+    """
+    流式焦点堆叠：每拍摄一层Z切片就立即合并，不保存全部切片
+
+    只保留当前最佳焦点值、最佳切片索引和合成图像，内存占用与切片数无关，
+    可以在电机移动到下一层时处理当前切片，支持15-30层的深堆栈。
+    与 LowPowerFocusStack 的区别：对齐参考为第一层切片（相邻层的平台漂移很小）；
+    低焦点区域回退到 reference_idx 指定的切片（默认中间层，需给出 n_slices）。
+    fusion='pyramid' 时每层切片同时并入整幅拉普拉斯金字塔（PyramidFocusFusion.fold），
+    质量与 LowPowerFocusStack 的金字塔融合相同，代价是常驻一套float32金字塔（约为单张切片的6倍内存）。
+    """
+    
+    FUSIONS = ('argmax', 'pyramid')
+    
+    def __init__(self, n_slices: Optional[int] = None, reference_idx: int = -1, align: bool = True,
+                 focus_method: str = 'laplacian', fusion: str = 'argmax'):
+        """
+        参数:
+            n_slices: 预计切片数，用于确定中间参考层；为空时以第一层为参考
+            reference_idx: 低焦点区域回退使用的切片索引，-1表示中间层
+            align: 是否对每层切片做平移对齐
+            focus_method: 焦点测量方法，见 LowPowerFocusMeasure.MEASURES
+            fusion: 'argmax' 逐像素选择（快）；'pyramid' 拉普拉斯金字塔融合（无光晕和接缝）
+        """
+        if fusion not in self.FUSIONS:
+            raise ValueError(f"未知的融合方式: {fusion}")
+        self.fusion = fusion
+        self.n_slices = n_slices
+        if reference_idx < 0:
+            reference_idx = n_slices // 2 if n_slices else 0
+        self.reference_idx = reference_idx
+        self.align = align
+        
+        self.image_aligner = LowPowerImageAligner()
+        self.focus_measure = LowPowerFocusMeasure(focus_method)
+        self.grayscale_converter = LowPowerGrayscaleConverter()
+        self.pyramid_fusion = PyramidFocusFusion()
+        self._pyramid_state = None
+        
+        self.count = 0
+        self.composite = None  # 当前合成图像
+        self.best_values = None  # 每个像素的最大焦点值 (float32)
+        self.best_indices = None  # 每个像素焦点最好的切片索引 (uint8)
+        self.prev_values = None  # 峰值切片前一层的焦点值，用于亚切片高度插值
+        self.next_values = None  # 峰值切片后一层的焦点值
+        self._last_focus = None
+        self.reference_image = None  # 回退用的参考切片
+    
+    def add_slice(self, img: np.ndarray) -> int:
+        """合并一层切片，返回已合并的切片数"""
+        if self.count == 0:
+            self.image_aligner.set_reference(img)
+        elif self.align:
+            img = self.image_aligner.align_one(img)
+        
+        gray = self.grayscale_converter.convert([img])[0]
+        focus = self.focus_measure.compute(gray)
+        
+        index = self.count
+        if self.composite is None:
+            self.composite = img.copy()
+            self.best_values = focus
+            self.best_indices = np.zeros(focus.shape, dtype=np.uint8)
+            self.prev_values = np.zeros(focus.shape, dtype=np.float32)
+            self.next_values = np.zeros(focus.shape, dtype=np.float32)
+        else:
+            better = focus > self.best_values
+            # 峰值仍在上一层的像素，本层就是其后一层
+            after_peak = (self.best_indices == index - 1) & ~better
+            self.next_values[after_peak] = focus[after_peak]
+            # 峰值移到本层的像素，前一层焦点即上一层的测量值，后一层待下一层切片填入
+            self.prev_values[better] = self._last_focus[better]
+            self.next_values[better] = 0
+            self.best_indices[better] = index
+            if self.fusion == 'argmax':
+                self.composite[better] = img[better]
+            np.maximum(self.best_values, focus, out=self.best_values)
+        if self.fusion == 'pyramid':
+            self._pyramid_state = self.pyramid_fusion.fold(self._pyramid_state, img)
+        if index == self.reference_idx:
+            self.reference_image = img.copy()
+        self._last_focus = focus
+        self.count += 1
+        return self.count
+    
+    @property
+    def focus_curve(self) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        """(峰值索引, 峰值焦点, 前一层焦点, 后一层焦点)，与 LowPowerFocusStack.focus_curve 相同"""
+        if self.composite is None:
+            return None
+        return self.best_indices, self.best_values, self.prev_values, self.next_values
+    
+    def result(self) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """返回 (合成图像, 深度图)；尚未加入切片时返回 (None, None)"""
+        if self.composite is None:
+            return None, None
+        
+        if self.fusion == 'pyramid':
+            output = np.clip(self.pyramid_fusion.collapse_state(self._pyramid_state), 0, 255).astype(np.uint8)
+        else:
+            output = self.composite.copy()
+        if self.fusion == 'argmax' and self.count > 1 and self.reference_image is not None:
+            # 焦点值太低的像素使用参考切片，与 LowPowerFocusStack 一致
+            min_threshold = np.percentile(self.best_values, 10)
+            low_focus = self.best_values < min_threshold
+            output[low_focus] = self.reference_image[low_focus]
+        
+        if self.count > 1:
+            depthmap = (255.0 * self.best_indices / (self.count - 1)).astype(np.uint8)
+        else:
+            depthmap = np.zeros(self.best_indices.shape, dtype=np.uint8)
+        depthmap = cv2.GaussianBlur(depthmap, (3, 3), 0.5)
+        return output, depthmap
+
+
+def _reference_focus_stack(color_images: List[np.ndarray], focus_measures: List[np.ndarray]) -> np.ndarray:
+    """逐像素循环的原始合成实现，仅用于基准测试中验证向量化结果一致"""
+    h, w = color_images[0].shape[:2]
+    result = np.zeros((h, w, 3), dtype=np.uint8)
+    focus_matrix = np.stack(focus_measures, axis=2)
+    best_indices = np.argmax(focus_matrix, axis=2)
+    max_focus_values = np.max(focus_matrix, axis=2)
+    min_threshold = np.percentile(max_focus_values, 10)
+    ref_idx = len(color_images) // 2
+    for y in range(h):
+        for x in range(w):
+            best_idx = best_indices[y, x]
+            if focus_matrix[y, x, best_idx] < min_threshold:
+                result[y, x] = color_images[ref_idx][y, x]
+            else:
+                result[y, x] = color_images[best_idx][y, x]
+    return result
+
+
+def _synthetic_sharp(size: Tuple[int, int], seed: int = 0) -> np.ndarray:
+    """合成堆叠的全清晰真值图像"""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    sharp = rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    return cv2.GaussianBlur(sharp, (3, 3), 0)
+
+
+def _synthetic_stack(num_images: int, size: Tuple[int, int], seed: int = 0) -> List[np.ndarray]:
+    """生成合成焦点堆叠：同一纹理在不同区域分别清晰，用于基准测试"""
+    w, h = size
+    sharp = _synthetic_sharp(size, seed)
+    # 每张图像只有一条水平带是清晰的
+    band = max(1, h // num_images)
+    images = []
+    for i in range(num_images):
+        img = cv2.GaussianBlur(sharp, (0, 0), 4)
+        img[i * band:(i + 1) * band] = sharp[i * band:(i + 1) * band]
+        images.append(img)
+    return images
+
+
+def benchmark_focus_stack(num_images: int = 7, size: Tuple[int, int] = (4056, 3040),
+                          reference_size: Tuple[int, int] = (507, 380)) -> dict:
+    """
+    合成阶段基准测试
+    - 在 reference_size 上与逐像素循环实现比较，验证输出逐像素一致并给出加速比
+    - 在 size（默认12MP）上测试整幅和条带两种向量化实现的耗时
+    """
+    stacker = LowPowerFocusStack([])
+    results = {}
+
+    images = _synthetic_stack(num_images, reference_size)
+    measures = [stacker.focus_measure.compute(img) for img in stacker.grayscale_converter.convert(images)]
+    start = time.time()
+    expected = _reference_focus_stack(images, measures)
+    loop_time = time.time() - start
+    start = time.time()
+    vectorized = stacker._simple_focus_stack(images, measures)
+    vector_time = time.time() - start
+    results['equivalent'] = bool(np.array_equal(expected, vectorized))
+    results['reference_loop_s'] = loop_time
+    results['reference_vectorized_s'] = vector_time
+    print(f"{reference_size[0]}x{reference_size[1]} x{num_images}: 循环 {loop_time:.2f}s, "
+          f"向量化 {vector_time:.3f}s, 加速 {loop_time / max(vector_time, 1e-9):.0f}x, "
+          f"结果一致: {results['equivalent']}")
+
+    images = _synthetic_stack(num_images, size)
+    measures = [stacker.focus_measure.compute(img) for img in stacker.grayscale_converter.convert(images)]
+    for strip_rows in (None, 256):
+        start = time.time()
+        stacker._simple_focus_stack(images, measures, strip_rows=strip_rows)
+        elapsed = time.time() - start
+        label = '整幅' if strip_rows is None else f'条带{strip_rows}行'
+        results[f'full_size_{strip_rows or "whole"}_s'] = elapsed
+        print(f"{size[0]}x{size[1]} x{num_images} {label}: {elapsed:.2f}s")
+    return results
+
+
+def _reference_focus_measure(img: np.ndarray) -> np.ndarray:
+    """原float64实现，仅用于基准测试对比"""
+    laplacian = np.abs(cv2.Laplacian(img, cv2.CV_64F))
+    focus_measure = cv2.GaussianBlur(np.power(laplacian, 1.5), (5, 5), 1.0)
+    return focus_measure / (np.max(focus_measure) + 1e-8)
+
+
+def benchmark_focus_measure(size: Tuple[int, int] = (4056, 3040), repeats: int = 3) -> dict:
+    """焦点测量耗时：原float64实现与各float32条带并行测量方法对比"""
+    gray = cv2.cvtColor(_synthetic_stack(3, size)[1], cv2.COLOR_BGR2GRAY)
+    candidates = [('float64_reference', _reference_focus_measure)]
+    candidates += [(method, LowPowerFocusMeasure(method).compute) for method in LowPowerFocusMeasure.MEASURES]
+    results = {}
+    for name, compute in candidates:
+        start = time.time()
+        for _ in range(repeats):
+            compute(gray)
+        elapsed = (time.time() - start) / repeats
+        results[name] = elapsed
+        print(f"{size[0]}x{size[1]} 焦点测量 {name}: {elapsed:.3f}s")
+    return results
+
+
+def benchmark_fusion(num_images: int = 7, size: Tuple[int, int] = (2028, 1520)) -> dict:
+    """
+    融合引擎对比：以合成堆叠的全清晰图像为真值，比较 argmax 与 pyramid 两种融合的PSNR和耗时
+    """
+    images = _synthetic_stack(num_images, size)
+    truth = _synthetic_sharp(size)
+    results = {}
+    for fusion in ('argmax', 'pyramid'):
+        stacker = LowPowerFocusStack(images)
+        stacker.fusion = fusion
+        start = time.time()
+        stacker.run()
+        elapsed = time.time() - start
+        psnr = cv2.PSNR(truth, stacker.output_image)
+        results[fusion] = {'seconds': elapsed, 'psnr': psnr}
+        print(f"{size[0]}x{size[1]} x{num_images} {fusion}: {elapsed:.2f}s, PSNR {psnr:.2f}dB")
+    return results
+
+
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description='Focus Stacking - Low Power High Efficiency Version')
-    parser.add_argument('input_files', nargs='+', help='输入图像文件')
+    parser.add_argument('input_files', nargs='*', help='输入图像文件')
     parser.add_argument('--output', '-o', default='output_low_power.jpg', help='输出文件')
     parser.add_argument('--depthmap', '-d', default='', help='深度图输出文件')
     parser.add_argument('--verbose', '-v', action='store_true', help='详细输出')
     parser.add_argument('--reference', type=int, default=-1, help='参考图像索引')
+    parser.add_argument('--fusion', choices=('argmax', 'pyramid'), default='argmax', help='融合引擎')
+    parser.add_argument('--measure', choices=LowPowerFocusMeasure.MEASURES, default='laplacian', help='焦点测量方法')
+    parser.add_argument('--benchmark', action='store_true', help='运行合成数据基准测试')
     
     args = parser.parse_args()
     
+    if args.benchmark:
+        benchmark_focus_stack()
+        benchmark_focus_measure()
+        benchmark_fusion()
+        return
+    
     # 创建LowPowerFocusStack实例
-    stack = LowPowerFocusStack()
-    stack.set_inputs(args.input_files)
-    stack.set_output(args.output)
-    stack.set_depthmap(args.depthmap)
+    stack = LowPowerFocusStack([])
+    stack.input_files = args.input_files
+    stack.input_images = stack._load_images()
     stack.set_verbose(args.verbose)
     stack.reference_idx = args.reference
+    stack.fusion = args.fusion
+    stack.focus_measure = LowPowerFocusMeasure(args.measure)
     
     # 运行算法
     success = stack.run()
     
     if success:
+        cv2.imwrite(args.output, stack.output_image)
+        if args.depthmap:
+            cv2.imwrite(args.depthmap, stack.depthmap_image)
         print(f"\n低算力焦点堆叠完成！结果已保存到: {args.output}")
         if args.depthmap:
             print(f"深度图已保存到: {args.depthmap}")
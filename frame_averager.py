@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+
+
+class FrameAverager:
+    """
+    视频流多帧降噪：对连续N帧做均值或中值合成，替代切换到拍照模式的单帧降噪
+
+    - mean: 使用float32累加器原地累加（cv2.accumulate），内存占用与帧数无关
+    - median: 预分配 (N,H,W,C) 的uint8帧缓存，结束时逐像素取中值，对偶发噪点更稳健
+    - register=True 时每帧先与第一帧做相位相关配准，抵消平台振动造成的平移
+    """
+
+    METHODS = ('mean', 'median')
+
+    def __init__(self, n_frames, method='mean', register=False, register_scale=0.5, max_shift=0.1):
+        """
+        参数:
+            n_frames: 合成帧数
+            method: 'mean' 或 'median'
+            register: 是否进行相位相关配准
+            register_scale: 配准时的降采样比例，越小越快
+            max_shift: 允许的最大平移（占图像宽高的比例），超过时认为配准失败，按零位移处理
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"未知的合成方法: {method}")
+        if n_frames < 1:
+            raise ValueError("合成帧数至少为1")
+        self.n_frames = n_frames
+        self.method = method
+        self.register = register
+        self.register_scale = register_scale
+        self.max_shift = max_shift
+
+        self.count = 0
+        self._accumulator = None  # mean: float32累加器
+        self._stack = None  # median: 帧缓存
+        self._ref_gray = None
+        self._window = None
+        self.shifts = []
+
+    def add(self, frame):
+        """加入一帧，返回是否已收集满 n_frames 帧"""
+        if self.count >= self.n_frames:
+            return True
+        if self.register:
+            frame = self._register(frame)
+
+        if self.method == 'mean':
+            if self._accumulator is None:
+                self._accumulator = np.zeros(frame.shape, dtype=np.float32)
+            cv2.accumulate(frame, self._accumulator)
+        else:
+            if self._stack is None:
+                self._stack = np.empty((self.n_frames,) + frame.shape, dtype=frame.dtype)
+            self._stack[self.count] = frame
+        self.count += 1
+        return self.count >= self.n_frames
+
+    def _to_register_gray(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        if self.register_scale != 1:
+            gray = cv2.resize(gray, None, fx=self.register_scale, fy=self.register_scale, interpolation=cv2.INTER_AREA)
+        return gray.astype(np.float32)
+
+    def _register(self, frame):
+        """以第一帧为参考，亚像素相位相关估计平移并反向补偿"""
+        gray = self._to_register_gray(frame)
+        if self._ref_gray is None:
+            self._ref_gray = gray
+            self._window = cv2.createHanningWindow(gray.shape[::-1], cv2.CV_32F)
+            self.shifts.append((0.0, 0.0))
+            return frame
+        (dx, dy), _ = cv2.phaseCorrelate(self._ref_gray, gray, self._window)
+        dx /= self.register_scale
+        dy /= self.register_scale
+        h, w = frame.shape[:2]
+        if abs(dx) > w * self.max_shift or abs(dy) > h * self.max_shift:
+            dx, dy = 0.0, 0.0
+        self.shifts.append((dx, dy))
+        if abs(dx) < 0.05 and abs(dy) < 0.05:
+            return frame
+        M = np.float32([[1, 0, -dx], [0, 1, -dy]])
+        return cv2.warpAffine(frame, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+
+    def average(self):
+        """返回不取整的float32合成结果，用于暗场/平场等参考图"""
+        if self.count == 0:
+            return None
+        if self.method == 'mean':
+            return self._accumulator / np.float32(self.count)
+        return np.median(self._stack[:self.count], axis=0).astype(np.float32)
+
+    def result(self, output_size=None):
+        """
+        返回合成后的uint8图像
+        output_size: (宽, 高)，不为空时放大到该尺寸（例如拍照分辨率）
+        """
+        if self.count == 0:
+            return None
+        if self.method == 'mean':
+            out = np.empty(self._accumulator.shape, dtype=np.uint8)
+            cv2.convertScaleAbs(self._accumulator, dst=out, alpha=1.0 / self.count)
+        else:
+            out = np.median(self._stack[:self.count], axis=0).astype(np.uint8)
+        if output_size is not None and tuple(output_size) != (out.shape[1], out.shape[0]):
+            out = cv2.resize(out, tuple(output_size), interpolation=cv2.INTER_CUBIC)
+        return out
@@ -0,0 +1,220 @@
+"""
+景深堆叠高度图
+
+- height_from_focus: 由每个像素焦点曲线的峰值切片及其前后两层的焦点值，
+  用抛物线插值得到亚切片精度的高度（μm），整幅向量化计算
+- save_height_tiff16: 16位TIFF，数值按线性比例映射，比例和偏移写入同名 .json
+- save_height_mosaic: 按拼接得到的tile位置把各tile的16位高度图合成一张（同一Z零点），格式同上
+- save_ply_points / save_ply_mesh: 二进制PLY点云和网格，可直接用MeshLab/CloudCompare打开
+"""
+
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+def z_steps_to_um(z_positions, steps_per_mm):
+    """电机步数 -> μm"""
+    return np.asarray(z_positions, dtype=np.float32) / steps_per_mm * 1000.0
+
+
+def neighbour_focus(focus_measures, best_indices):
+    """
+    批量版本：按每个像素的峰值切片索引取出前一层和后一层的焦点值，
+    不存在的相邻层（峰值在第一层或最后一层）填0
+    """
+    prev_values = np.zeros(best_indices.shape, dtype=np.float32)
+    next_values = np.zeros(best_indices.shape, dtype=np.float32)
+    for i, focus in enumerate(focus_measures):
+        np.copyto(prev_values, focus, where=best_indices == i + 1, casting='unsafe')
+        np.copyto(next_values, focus, where=best_indices == i - 1, casting='unsafe')
+    return prev_values, next_values
+
+
+def height_from_focus(best_indices, best_values, prev_values, next_values, z_positions_um,
+                      median_ksize=5, min_confidence_percentile=10):
+    """
+    计算高度图
+
+    参数:
+        best_indices: 每个像素焦点最大的切片索引
+        best_values / prev_values / next_values: 峰值切片及其前后切片的焦点值
+        z_positions_um: 各切片的实际Z位置（μm），允许不等间距
+        median_ksize: 中值滤波核大小（3或5，float32只支持这两种），0表示不滤波
+        min_confidence_percentile: 峰值焦点低于该分位数的像素标记为不可信（无纹理区域）
+    返回:
+        (height float32 μm, confidence bool)
+    """
+    z = np.asarray(z_positions_um, dtype=np.float32)
+    n = len(z)
+    index = best_indices.astype(np.intp)
+    best = best_values.astype(np.float32, copy=False)
+
+    # 抛物线顶点相对峰值切片的偏移（单位：切片），边界切片不插值
+    denom = prev_values - 2.0 * best + next_values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(denom < 0, 0.5 * (prev_values - next_values) / denom, 0.0).astype(np.float32)
+    np.clip(offset, -0.5, 0.5, out=offset)
+    offset[(index == 0) | (index == n - 1)] = 0.0
+
+    # 不等间距：向上偏移按到下一层的间距换算，向下偏移按到上一层的间距换算
+    if n > 1:
+        step_up = np.append(np.diff(z), z[-1] - z[-2])
+        step_down = np.insert(np.diff(z), 0, z[1] - z[0])
+    else:
+        step_up = step_down = np.zeros(1, dtype=np.float32)
+    height = z[index] + np.where(offset > 0, offset * step_up[index], offset * step_down[index])
+    height = height.astype(np.float32)
+
+    if median_ksize:
+        height = cv2.medianBlur(height, median_ksize)
+
+    confidence = best >= np.percentile(best, min_confidence_percentile)
+    return height, confidence
+
+
+def save_height_tiff16(path, height_um, confidence=None):
+    """
+    保存16位TIFF：最低点映射为1，最高点映射为65535，不可信像素为0
+    换算关系 height = offset_um + (value - 1) * scale_um 写入 path 同名的 .json
+    """
+    valid = height_um if confidence is None else height_um[confidence]
+    low = float(valid.min()) if valid.size else 0.0
+    high = float(valid.max()) if valid.size else 0.0
+    scale = (high - low) / 65534.0 or 1.0
+    image = np.clip((height_um - low) / scale + 1.0, 1, 65535).astype(np.uint16)
+    if confidence is not None:
+        image[~confidence] = 0
+    cv2.imwrite(path, image)
+    with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'offset_um': low, 'scale_um': scale, 'invalid_value': 0}, f)
+    return path
+
+
+def save_height_mosaic(path, tile_paths, corners, sizes, masks=None, canvas=None):
+    """
+    把各tile的16位高度图（save_height_tiff16，须以同一Z零点为基准）按拼接位置合成一张16位TIFF，
+    合成后统一换算关系，写入 path 同名的 .json；一次只读入一张tile
+
+    参数:
+        corners / sizes: 各tile在拼接画布上的位置 (x, y) 和尺寸 (宽, 高)
+        masks: 各tile负责的像素（uint8，如拼接的接缝掩膜），为空时后面的tile覆盖前面的
+        canvas: 输出范围 (x, y, 宽, 高)，与拼接结果对齐；为空时取全部tile的外接矩形
+    """
+    metas = []
+    for tile_path in tile_paths:
+        with open(os.path.splitext(tile_path)[0] + '.json', 'r', encoding='utf-8') as f:
+            metas.append(json.load(f))
+    low = min(meta['offset_um'] for meta in metas)
+    high = max(meta['offset_um'] + 65534 * meta['scale_um'] for meta in metas)
+    scale = (high - low) / 65534.0 or 1.0
+
+    corners = np.round(np.asarray(corners, dtype=np.float64)).astype(int).reshape(-1, 2)
+    sizes = np.asarray(sizes, dtype=int).reshape(-1, 2)
+    if canvas is None:
+        x0, y0 = corners.min(axis=0)
+        x1, y1 = (corners + sizes).max(axis=0)
+        canvas = (x0, y0, x1 - x0, y1 - y0)
+    origin = np.array(canvas[:2], dtype=int)
+    mosaic = np.zeros((int(canvas[3]), int(canvas[2])), dtype=np.uint16)
+    masks = iter(masks) if masks is not None else None
+
+    for tile_path, meta, corner in zip(tile_paths, metas, corners):
+        value = cv2.imread(tile_path, cv2.IMREAD_UNCHANGED)
+        select = value > 0
+        if masks is not None:
+            select &= next(masks) > 0
+        height_um = meta['offset_um'] + (value.astype(np.float32) - 1) * meta['scale_um']
+        value = np.clip((height_um - low) / scale + 1.0, 1, 65535).astype(np.uint16)
+        # 裁掉画布之外的部分
+        x, y = corner - origin
+        h, w = value.shape
+        left, top = max(0, -x), max(0, -y)
+        right, bottom = min(w, mosaic.shape[1] - x), min(h, mosaic.shape[0] - y)
+        if right <= left or bottom <= top:
+            continue
+        region = mosaic[y + top:y + bottom, x + left:x + right]
+        part = select[top:bottom, left:right]
+        region[part] = value[top:bottom, left:right][part]
+
+    cv2.imwrite(path, mosaic)
+    with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'offset_um': low, 'scale_um': scale, 'invalid_value': 0}, f)
+    return path
+
+
+def _grid(height_um, pixel_size_um, step):
+    """按 step 降采样的网格顶点坐标（μm）"""
+    sub = height_um[::step, ::step]
+    rows, cols = sub.shape
+    ys, xs = np.mgrid[0:rows, 0:cols].astype(np.float32)
+    xs *= step * pixel_size_um
+    ys *= step * pixel_size_um
+    return xs, ys, sub
+
+
+def _vertex_array(xs, ys, zs, colors):
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertices = np.empty(xs.size, dtype=fields)
+    vertices['x'] = xs.ravel()
+    vertices['y'] = ys.ravel()
+    vertices['z'] = zs.ravel()
+    if colors is not None:
+        bgr = colors.reshape(-1, 3)
+        vertices['red'] = bgr[:, 2]
+        vertices['green'] = bgr[:, 1]
+        vertices['blue'] = bgr[:, 0]
+    return vertices
+
+
+def _ply_header(vertices, n_faces=0):
+    lines = ['ply', 'format binary_little_endian 1.0', f'element vertex {len(vertices)}']
+    ply_types = {'<f4': 'float', 'u1': 'uchar'}
+    for name in vertices.dtype.names:
+        lines.append(f'property {ply_types[vertices.dtype[name].str.replace("|", "")]} {name}')
+    if n_faces:
+        lines += [f'element face {n_faces}', 'property list uchar int vertex_indices']
+    lines.append('end_header')
+    return ('\n'.join(lines) + '\n').encode('ascii')
+
+
+def save_ply_points(path, height_um, pixel_size_um, colors=None, confidence=None, step=4):
+    """
+    导出点云（x、y、z 单位μm，可选BGR颜色），每 step 个像素取一个点，跳过不可信像素
+    """
+    xs, ys, zs = _grid(height_um, pixel_size_um, step)
+    sub_colors = colors[::step, ::step] if colors is not None else None
+    vertices = _vertex_array(xs, ys, zs, sub_colors)
+    if confidence is not None:
+        vertices = vertices[confidence[::step, ::step].ravel()]
+    with open(path, 'wb') as f:
+        f.write(_ply_header(vertices))
+        f.write(vertices.tobytes())
+    return path
+
+
+def save_ply_mesh(path, height_um, pixel_size_um, colors=None, step=8):
+    """导出规则网格曲面，每个网格单元两个三角形"""
+    xs, ys, zs = _grid(height_um, pixel_size_um, step)
+    rows, cols = zs.shape
+    sub_colors = colors[::step, ::step] if colors is not None else None
+    vertices = _vertex_array(xs, ys, zs, sub_colors)
+
+    idx = np.arange(rows * cols, dtype=np.int32).reshape(rows, cols)
+    a = idx[:-1, :-1].ravel()
+    b = idx[:-1, 1:].ravel()
+    c = idx[1:, :-1].ravel()
+    d = idx[1:, 1:].ravel()
+    faces = np.empty(2 * a.size, dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+    faces['n'] = 3
+    faces['v'][0::2] = np.stack([a, c, b], axis=1)
+    faces['v'][1::2] = np.stack([b, c, d], axis=1)
+    with open(path, 'wb') as f:
+        f.write(_ply_header(vertices, len(faces)))
+        f.write(vertices.tobytes())
+        f.write(faces.tobytes())
+    return path
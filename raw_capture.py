@@ -0,0 +1,174 @@
+"""
+RAW (Bayer) 采集与存储
+
+- pack12/unpack12: 12-bit Bayer数据按 MIPI RAW12 方式两像素打包为3字节，比uint16节省25%
+- save_raw/load_raw: 打包后的Bayer数据与采集元数据一起保存为 .raw12.npz
+- demosaic_linear: 黑电平扣除 + 去马赛克 + 白平衡 + 颜色校正矩阵，输出线性float32图像，用于定量分析
+- RawBatchWriter: 后台线程打包写盘，Z堆栈/拼接扫描保存RAW时不阻塞采集
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+RAW_SUFFIX = '.raw12.npz'
+
+# 传感器Bayer排列 -> OpenCV转换代码（OpenCV按第二行第二、三个像素命名）
+BAYER_TO_BGR = {
+    'RGGB': cv2.COLOR_BayerBG2BGR,
+    'BGGR': cv2.COLOR_BayerRG2BGR,
+    'GRBG': cv2.COLOR_BayerGB2BGR,
+    'GBRG': cv2.COLOR_BayerGR2BGR,
+}
+
+
+def bayer_pattern_from_format(raw_format):
+    """从libcamera格式名（如 'SRGGB12'、'SBGGR12_CSI2P'）中解析Bayer排列"""
+    pattern = raw_format[1:5] if raw_format.startswith('S') else raw_format[:4]
+    if pattern not in BAYER_TO_BGR:
+        raise ValueError(f"不支持的RAW格式: {raw_format}")
+    return pattern
+
+
+def pack12(bayer):
+    """
+    将12-bit数据（uint16存储）打包：每两个像素a、b写成3字节
+    [a高8位, b高8位, a低4位 | b低4位<<4]
+    """
+    if bayer.shape[-1] % 2:
+        raise ValueError("打包要求图像宽度为偶数")
+    pairs = bayer.reshape(-1, 2)
+    a = pairs[:, 0]
+    b = pairs[:, 1]
+    packed = np.empty((pairs.shape[0], 3), dtype=np.uint8)
+    packed[:, 0] = a >> 4
+    packed[:, 1] = b >> 4
+    packed[:, 2] = (a & 0x0F) | ((b & 0x0F) << 4)
+    return packed.reshape(-1)
+
+
+def unpack12(packed, shape):
+    """pack12 的逆运算，返回 uint16 数组"""
+    triplets = packed.reshape(-1, 3).astype(np.uint16)
+    bayer = np.empty((triplets.shape[0], 2), dtype=np.uint16)
+    bayer[:, 0] = (triplets[:, 0] << 4) | (triplets[:, 2] & 0x0F)
+    bayer[:, 1] = (triplets[:, 1] << 4) | (triplets[:, 2] >> 4)
+    return bayer.reshape(shape)
+
+
+def raw_stream_to_bayer(raw_array, width):
+    """
+    picamera2 非打包RAW流的数组为 uint8 (H, stride)，每像素2字节且行尾可能有填充，
+    转为 (H, W) 的 uint16 视图
+    """
+    return raw_array.view(np.uint16)[:, :width]
+
+
+def save_raw(path, bayer, metadata):
+    """
+    保存Bayer数据及元数据
+    metadata 至少包含 'pattern'、'bit_depth'、'black_level'，其余采集参数原样保存
+    """
+    np.savez(
+        path,
+        packed=pack12(np.ascontiguousarray(bayer)),
+        shape=np.array(bayer.shape),
+        metadata=np.array(json.dumps(metadata)),
+    )
+    return path
+
+
+def load_raw(path):
+    """返回 (bayer uint16, metadata)"""
+    with np.load(path) as data:
+        shape = tuple(data['shape'])
+        bayer = unpack12(data['packed'], shape)
+        metadata = json.loads(str(data['metadata']))
+    return bayer, metadata
+
+
+def demosaic_linear(bayer, metadata, white_balance=True, color_correction=True):
+    """
+    RAW -> 线性BGR float32，数值范围约为0-1（1对应传感器饱和）
+
+    处理步骤均为整幅数组运算：
+    1. 去马赛克（OpenCV双线性，直接在uint16上完成）
+    2. 扣除黑电平并归一化
+    3. 白平衡增益 ColourGains (r, b)
+    4. 颜色校正矩阵 ColourCorrectionMatrix（RGB顺序的3x3矩阵）
+    """
+    pattern = metadata.get('pattern', 'RGGB')
+    bit_depth = metadata.get('bit_depth', 12)
+    black_level = float(metadata.get('black_level', 0))
+    white_level = float((1 << bit_depth) - 1)
+
+    bgr = cv2.cvtColor(bayer, BAYER_TO_BGR[pattern]).astype(np.float32)
+    scale = 1.0 / (white_level - black_level)
+    cv2.subtract(bgr, black_level, dst=bgr)
+    cv2.multiply(bgr, scale, dst=bgr)
+    np.maximum(bgr, 0, out=bgr)
+
+    matrix = np.eye(3, dtype=np.float32)
+    if white_balance and metadata.get('ColourGains'):
+        r_gain, b_gain = metadata['ColourGains']
+        matrix = matrix @ np.diag([b_gain, 1.0, r_gain]).astype(np.float32)
+    if color_correction and metadata.get('ColourCorrectionMatrix'):
+        ccm_rgb = np.array(metadata['ColourCorrectionMatrix'], dtype=np.float32).reshape(3, 3)
+        # RGB顺序的矩阵转换为BGR顺序：输入输出通道同时翻转
+        ccm_bgr = ccm_rgb[::-1, ::-1]
+        matrix = ccm_bgr @ matrix
+    if not np.allclose(matrix, np.eye(3)):
+        bgr = cv2.transform(bgr, matrix)
+    return bgr
+
+
+def linear_to_display(bgr_linear, gamma=2.2):
+    """线性图像 -> 8位显示图像（仅用于预览，定量分析请使用线性数据）"""
+    display = np.clip(bgr_linear, 0, 1) ** (1.0 / gamma)
+    return (display * 255 + 0.5).astype(np.uint8)
+
+
+class RawBatchWriter:
+    """
+    后台RAW写盘队列
+    Z堆栈和拼接扫描中每张RAW约24MB（uint16），打包和写SD卡放到后台线程，
+    用信号量限制排队数量，避免内存无限增长
+    """
+
+    def __init__(self, workers=1, max_pending=4, on_saved=None):
+        """
+        参数:
+            workers: 写盘线程数
+            max_pending: 最多排队的帧数，超过时 submit 阻塞等待
+            on_saved: 写盘完成回调 on_saved(path)
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='raw_writer')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self.on_saved = on_saved
+
+    def submit(self, path, bayer, metadata):
+        self._slots.acquire()
+        future = self._executor.submit(self._write, path, bayer, metadata)
+        self._futures = [f for f in self._futures if not f.done()] + [future]
+        return future
+
+    def _write(self, path, bayer, metadata):
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            save_raw(path, bayer, metadata)
+            if self.on_saved is not None:
+                self.on_saved(path)
+            return path
+        finally:
+            self._slots.release()
+
+    def wait(self):
+        """等待所有排队的RAW写完，返回写入的路径"""
+        paths = [f.result() for f in self._futures]
+        self._futures = []
+        return paths
@@ -0,0 +1,368 @@
+"""
+流水线拼接扫描
+
+运动 -> 拍摄 -> 预处理 -> 配准 -> 放置 五个阶段各占一个线程，之间用有界队列连接：
+- 运动线程移动到 tile k+1 的同时，tile k 的预处理、配准和融合在其他线程进行
+- 运动和拍摄之间握手：拍完当前tile才开始下一次移动（拍摄时平台必须静止）；
+  拍摄后的收尾（如恢复预览模式）与下一次移动并行
+- 有界队列提供背压：计算跟不上时拍摄自动等待，内存中最多只有 queue_size 张待处理的全分辨率图像
+- 配准是增量的：每张tile只和已放置的相邻tile做相位相关（TranslationStitcher.estimate_offset），
+  按响应加权平均得到位置；修正量相对“相邻tile实际位置 + 先验相对位移”的预测限制在单步误差余量内，
+  因此步数换算的系统误差随扫描累积也不会被截断；没有可靠相邻时沿用平台先验加上已累积的漂移
+- 放置阶段把tile直接融合进画布（内存中的 Blender，或给出 dzi_path 时写入磁盘金字塔 MosaicWriter），
+  画布范围按平台先验加余量预先确定，余量包含单步误差和步数换算误差在整个扫描范围上的累积；
+  写金字塔时每放置一张tile，按其漂移预测剩余tile能到达的范围，不会再被覆盖的块立即写出（MosaicWriter.restrict），
+  内存中等待的块不随扫描范围增长
+- 配准成功的相邻对太少时 check_registration() 抛出 StitchingError，调用方可改用其他拼接方式
+
+总耗时接近 max(运动, 计算) 而不是二者之和；各阶段实际忙碌时间记录在 timings 中
+"""
+
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from stitching import TranslationStitcher
+from stitching.mosaic_writer import MosaicWriter
+from stitching.tile_layout import TileLayout
+
+_DONE = object()
+
+
+class ScanPipeline:
+    """按相对移动序列扫描并增量拼接"""
+
+    STAGES = ('motion', 'capture', 'preprocess', 'registration', 'placement')
+
+    def __init__(self, moves, move, capture, pixels_per_step, settle=None, after_capture=None,
+                 preprocess=None, dzi_path=None, queue_size=2, max_error=0.05, max_scale_error=0.05,
+                 on_tile=None, skip=(), **stitcher_kwargs):
+        """
+        参数:
+            moves: 每张tile拍摄前的相对移动 (dx, dy)（电机步数）
+            move: move(dx, dy)，移动平台并等待到位
+            capture: capture(i) -> 图像数组
+            pixels_per_step: (x, y) 电机一步对应的图像像素数
+            settle: 拍摄前调用（如自动对焦），与拍摄在同一线程
+            after_capture: 拍摄后调用（如恢复预览模式），与下一次移动并行
+            preprocess: preprocess(img) -> img，在预处理线程调用（如平场校正）
+            dzi_path: 给出时结果写成DeepZoom金字塔，否则在内存中融合
+            queue_size: 各阶段之间队列的长度
+            max_error: 单步平台定位误差上限（占tile尺寸的比例），决定配准修正的上限
+            max_scale_error: pixels_per_step 的系统误差上限（比例），与扫描范围一起决定画布余量
+            on_tile: on_tile(i, corner) 每放置一张tile后在放置线程中回调
+            skip: 不需要移动和对焦的tile序号（如续扫时已拍摄的tile，capture 从文件读取），
+                  其相对移动累积到下一个需要拍摄的tile
+            stitcher_kwargs: 传给 TranslationStitcher（registration_scale、min_response、blender_type 等）
+        """
+        self.moves = list(moves)
+        self.move = move
+        self.capture = capture
+        self.settle = settle
+        self.after_capture = after_capture
+        self.preprocess = preprocess
+        self.dzi_path = dzi_path
+        self.max_error = max_error
+        self.max_scale_error = max_scale_error
+        self.on_tile = on_tile
+        self.skip = set(skip)
+        self.stitcher = TranslationStitcher(**stitcher_kwargs)
+        self.priors = np.cumsum(np.asarray(self.moves, dtype=np.float64).reshape(-1, 2), axis=0) * pixels_per_step
+
+        self._queues = {stage: queue.Queue(maxsize=queue_size) for stage in self.STAGES[2:]}
+        self._arrived = queue.Queue(maxsize=1)
+        self._captured = queue.Queue(maxsize=1)
+        self._stop = threading.Event()
+        self._error = None
+        self.timings = {stage: 0.0 for stage in self.STAGES}
+        self.corners = {}
+        self.offsets = {}
+        self._drift_sum = np.zeros(2)
+        self.layout = None
+        self.writer = None
+        self._blender = None
+
+    # ------------------------------------------------------------------
+    # 队列工具：出错时所有阶段尽快退出，不会卡在已满/已空的队列上
+    # ------------------------------------------------------------------
+    def _put(self, q, item):
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_stage(self, name, body):
+        try:
+            body()
+        except Exception as e:
+            print(f"扫描流水线 {name} 阶段出错: {e}")
+            if self._error is None:
+                self._error = e
+            self._stop.set()
+
+    def _timed(self, stage, func, *args):
+        start = time.time()
+        result = func(*args)
+        self.timings[stage] += time.time() - start
+        return result
+
+    # ------------------------------------------------------------------
+    # 各阶段
+    # ------------------------------------------------------------------
+    def _motion(self):
+        pending_x = pending_y = 0
+        for i, (dx, dy) in enumerate(self.moves):
+            pending_x, pending_y = pending_x + dx, pending_y + dy
+            if i not in self.skip:
+                self._timed('motion', self.move, pending_x, pending_y)
+                pending_x = pending_y = 0
+            if not self._put(self._arrived, i):
+                return
+            # 拍完才能继续移动
+            if self._get(self._captured) is _DONE:
+                return
+        self._put(self._arrived, _DONE)
+
+    def _capture(self):
+        while True:
+            i = self._get(self._arrived)
+            if i is _DONE:
+                self._put(self._queues['preprocess'], _DONE)
+                return
+            skipped = i in self.skip
+            if self.settle is not None and not skipped:
+                self._timed('capture', self.settle)
+            img = self._timed('capture', self.capture, i)
+            self._put(self._captured, i)
+            if self.after_capture is not None and not skipped:
+                self._timed('capture', self.after_capture)
+            if not self._put(self._queues['preprocess'], (i, img)):
+                return
+
+    def _preprocess(self):
+        while True:
+            item = self._get(self._queues['preprocess'])
+            if item is _DONE:
+                self._put(self._queues['registration'], _DONE)
+                return
+            i, img = item
+            start = time.time()
+            if self.preprocess is not None:
+                img = self.preprocess(img)
+            small = self.stitcher._registration_image(img)
+            self.timings['preprocess'] += time.time() - start
+            if not self._put(self._queues['registration'], (i, img, small)):
+                return
+
+    def _registration(self):
+        smalls = {}
+        last_neighbour = None
+        while True:
+            item = self._get(self._queues['registration'])
+            if item is _DONE:
+                self._put(self._queues['placement'], _DONE)
+                return
+            i, img, small = item
+            start = time.time()
+            if self.layout is None:
+                size = (img.shape[1], img.shape[0])
+                self.layout = TileLayout(self.priors, [size] * len(self.priors), self.stitcher.min_overlap)
+                self.neighbours = self.layout.neighbours()
+                last_neighbour = [max(n, default=k) for k, n in enumerate(self.neighbours)]
+                self.margin = int(np.ceil(self.max_error * max(size)))
+                extent = np.ptp(self.priors, axis=0).max() if len(self.priors) else 0
+                self.canvas_margin = self.margin + int(np.ceil(self.max_scale_error * extent))
+            smalls[i] = small
+            corner = self._place_tile(i, smalls)
+            self.corners[i] = corner
+            # 后面不再有相邻tile的低分辨率图像不再需要
+            for j in [j for j in smalls if last_neighbour[j] <= i]:
+                del smalls[j]
+            self.timings['registration'] += time.time() - start
+            if not self._put(self._queues['placement'], (i, img, corner)):
+                return
+
+    def _place_tile(self, i, smalls):
+        """相对已放置的相邻tile定位，修正量相对相邻tile给出的预测限制在单步余量之内"""
+        placed = [j for j in self.neighbours[i] if j in self.corners]
+        if placed:
+            # 相邻tile的实际位置加先验相对位移，已包含之前累积的漂移
+            prediction = np.mean([np.asarray(self.corners[j]) + self.priors[i] - self.priors[j] for j in placed],
+                                 axis=0)
+        else:
+            prediction = self.priors[i] + self._drift_sum / max(len(self.corners), 1)
+        estimates, weights = [], []
+        for j in placed:
+            if j not in smalls:
+                continue
+            measured = self.stitcher.estimate_offset(smalls, self.layout, j, i)
+            if measured is None:
+                continue
+            dx, dy, response = measured
+            self.offsets[(j, i)] = measured
+            estimates.append(np.asarray(self.corners[j]) + (dx, dy))
+            weights.append(response)
+        if estimates:
+            corner = np.average(estimates, axis=0, weights=weights)
+            corner = np.clip(corner, prediction - self.margin, prediction + self.margin)
+        else:
+            # 没有可靠配准时沿用预测位置（相邻tile或平均漂移）
+            corner = prediction
+        # 不超出预先确定的画布
+        corner = np.clip(corner, self.priors[i] - self.canvas_margin, self.priors[i] + self.canvas_margin)
+        self._drift_sum += corner - self.priors[i]
+        return corner
+
+    def check_registration(self):
+        """配准成功的相邻对太少时抛出 StitchingError（见 TranslationStitcher.check_registration）"""
+        self.stitcher.check_registration(self.layout, self.offsets)
+
+    def _placement(self):
+        masks = None
+        while True:
+            item = self._get(self._queues['placement'])
+            if item is _DONE:
+                return
+            i, img, corner = item
+            start = time.time()
+            if masks is None:
+                sizes = self.layout.sizes.astype(int).tolist()
+                masks = self._start_canvas(sizes)
+            mask = next(masks)
+            if self.writer is not None:
+                # 不进入已写出的区域（只在漂移超出预测误差时生效）
+                corner = np.clip(corner, *self.writer.limits(i))
+                self.corners[i] = corner
+            corner = tuple(int(v) for v in np.round(corner))
+            if self.writer is not None:
+                kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (self.writer.blend_width + 1,) * 2)
+                self.writer.add(i, img, cv2.dilate(mask, kernel), corner=corner)
+                self._release_passed(i, corner)
+            else:
+                self._blender.feed(img, mask, corner)
+            self.timings['placement'] += time.time() - start
+            if self.on_tile is not None:
+                self.on_tile(i, corner)
+
+    def _release_passed(self, i, corner):
+        """
+        按刚放置的tile的漂移预测剩余tile的位置，误差为单步余量加上步数换算误差在与该tile距离上的累积；
+        剩余tile都不会再覆盖的金字塔块随即写出（MosaicWriter.restrict）。
+        画布余量按整个扫描范围预留，但内存中等待的块只取决于这个预测范围
+        """
+        rest = np.arange(i + 1, len(self.priors))
+        if not len(rest):
+            return
+        drift = np.asarray(corner) - self.priors[i]
+        reach = self.margin + self.max_scale_error * np.abs(self.priors[rest] - self.priors[i])
+        lo = self.priors[rest] + drift - reach
+        hi = self.priors[rest] + self.layout.sizes[rest] + drift + reach
+        for j, (x0, y0), (x1, y1) in zip(rest, lo, hi):
+            self.writer.restrict(j, x0, y0, x1, y1)
+
+    def _start_canvas(self, sizes):
+        """按先验位置和余量建立画布，返回按tile顺序的接缝掩膜生成器"""
+        priors = np.round(self.priors).astype(int)
+        if self.dzi_path:
+            self.writer = MosaicWriter(self.dzi_path, priors, sizes, margin=self.canvas_margin)
+        else:
+            margin = self.canvas_margin
+            self._blender = self.stitcher.blender
+            self._blender.prepare([tuple(c) for c in (priors - margin).tolist()],
+                                  [(w + 2 * margin, h + 2 * margin) for w, h in sizes])
+        return self.stitcher.seam_masks(priors.tolist(), sizes)
+
+    # ------------------------------------------------------------------
+    def run(self):
+        """
+        执行扫描，返回拼接结果：
+        内存融合时返回全景图（按实际覆盖范围裁剪），写金字塔时返回 MosaicWriter
+        """
+        start = time.time()
+        bodies = {
+            'motion': self._motion,
+            'capture': self._capture,
+            'preprocess': self._preprocess,
+            'registration': self._registration,
+            'placement': self._placement,
+        }
+        threads = [threading.Thread(target=self._run_stage, args=(name, body), name=f'scan_{name}', daemon=True)
+                   for name, body in bodies.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
+        self.timings['total'] = time.time() - start
+
+        if self.writer is not None:
+            self.writer.close()
+            return self.writer
+        panorama, mask = self._blender.blend()
+        x, y, w, h = cv2.boundingRect(mask.get() if isinstance(mask, cv2.UMat) else mask)
+        if isinstance(panorama, cv2.UMat):
+            panorama = panorama.get()
+        return panorama[y:y + h, x:x + w]
+
+
+def benchmark_scan_pipeline(grid=(3, 3), tile_size=(2028, 1520), move_seconds=0.5, capture_seconds=0.3):
+    """
+    合成扫描：平台移动和拍摄用 sleep 模拟，比较先全部拍完再拼接的串行方式与流水线方式的总耗时
+    """
+    rows, cols = grid
+    w, h = tile_size
+    step_x, step_y = int(w * 0.8), int(h * 0.8)
+    rng = np.random.default_rng(0)
+    canvas = np.zeros((step_y * (rows - 1) + h + 100, step_x * (cols - 1) + w + 100, 3), np.uint8)
+    for _ in range(rows * cols * 400):
+        center = (int(rng.integers(0, canvas.shape[1])), int(rng.integers(0, canvas.shape[0])))
+        cv2.circle(canvas, center, int(rng.integers(4, 30)), [int(v) for v in rng.integers(0, 255, 3)], -1)
+
+    moves = []
+    for r in range(rows):
+        for c in range(cols):
+            moves.append((0, 0) if not moves else ((step_x if r % 2 == 0 else -step_x, 0) if c else (0, step_y)))
+    positions = np.cumsum(moves, axis=0)
+    errors = rng.integers(-20, 21, positions.shape)
+
+    def capture(i):
+        time.sleep(capture_seconds)
+        x, y = positions[i] + errors[i] + 50
+        return canvas[y:y + h, x:x + w].copy()
+
+    def move(dx, dy):
+        time.sleep(move_seconds)
+
+    start = time.time()
+    tiles = []
+    for i, (dx, dy) in enumerate(moves):
+        move(dx, dy)
+        tiles.append(capture(i))
+    TranslationStitcher().stitch(tiles, positions.tolist())
+    serial = time.time() - start
+
+    pipeline = ScanPipeline(moves, move, capture, (1.0, 1.0))
+    pipeline.run()
+    pipelined = pipeline.timings['total']
+    busy = {stage: round(pipeline.timings[stage], 2) for stage in ScanPipeline.STAGES}
+    print(f"{rows}x{cols} tiles {w}x{h}: 串行 {serial:.2f}s, 流水线 {pipelined:.2f}s, 各阶段忙碌时间 {busy}")
+    return {'serial': serial, 'pipelined': pipelined, 'stages': busy}
+
+
+if __name__ == '__main__':
+    benchmark_scan_pipeline()
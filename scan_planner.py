@@ -0,0 +1,278 @@
+"""
+拼接扫描规划
+
+- 区域：平台坐标（mm）下的矩形 {'bbox': [x0, y0, x1, y1]} 或多边形 {'polygon': [[x, y], ...]}
+- 视野随物镜倍率变化：20x 下约 0.4mm x 0.3mm，按 20/倍率 缩放
+- tile 网格以区域外接矩形为中心铺设，相邻tile按 overlap 比例重叠；多边形区域只保留与多边形相交的tile
+- 路径：serpentine（逐行往返）、raster（逐行同向）、nearest（贪心最近邻），
+  auto 按移动代价选最小的。代价按电机实际行程计算：X、Y 依次移动，反向移动需额外走两倍回程差
+- 扫描清单（manifest.json）记录规划和每个tile的状态，原子写入，中断后可从未完成的tile继续；
+  平台没有回零开关，清单中的绝对位置只在记录它的会话（session）内有效，跨会话续扫前需用 reanchor() 平移坐标
+"""
+
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+FOV_AT_20X_MM = (0.4, 0.3)
+ORDERS = ('auto', 'serpentine', 'raster', 'nearest')
+
+
+def field_of_view_mm(magnification, fov_at_20x=FOV_AT_20X_MM):
+    """物镜倍率对应的视野 (宽, 高) mm"""
+    scale = 20 / magnification
+    return fov_at_20x[0] * scale, fov_at_20x[1] * scale
+
+
+def pixel_size_um(magnification, image_width, fov_at_20x=FOV_AT_20X_MM):
+    """倍率和图像宽度（像素）对应的像素尺寸 μm/像素，与 field_of_view_mm 一致"""
+    return field_of_view_mm(magnification, fov_at_20x)[0] * 1000 / image_width
+
+
+def region_polygon(region):
+    """区域描述 -> 多边形顶点数组 (N, 2) mm"""
+    if 'polygon' in region:
+        polygon = np.asarray(region['polygon'], dtype=np.float64).reshape(-1, 2)
+        if len(polygon) < 3:
+            raise ValueError("多边形至少需要3个顶点")
+        return polygon
+    if 'bbox' in region:
+        x0, y0, x1, y1 = region['bbox']
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        return np.array([[x0, y0], [x1, y0], [x1, y1], [x0, y1]], dtype=np.float64)
+    raise ValueError("扫描区域需要 bbox 或 polygon")
+
+
+def plan_tiles(region, fov_mm, overlap=0.2):
+    """
+    铺设覆盖区域的tile网格
+
+    返回:
+        tile列表，每项 {'row', 'col', 'x_mm', 'y_mm'}（tile中心），按行列顺序
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap 需在 [0, 1) 之间")
+    polygon = region_polygon(region)
+    fov = np.asarray(fov_mm, dtype=np.float64)
+    step = fov * (1 - overlap)
+    low, high = polygon.min(axis=0), polygon.max(axis=0)
+    extent = high - low
+    counts = np.maximum(1, np.ceil(np.maximum(extent - fov, 0) / step).astype(int) + 1)
+    # 网格整体居中于外接矩形
+    origin = (low + high) / 2 - step * (counts - 1) / 2
+
+    # 以 1/8 视野的分辨率栅格化多边形，tile矩形内有任一像素即认为相交
+    resolution = fov.min() / 8
+    grid_low = origin - fov / 2
+    grid_size = np.ceil((step * (counts - 1) + fov) / resolution).astype(int) + 1
+    mask = np.zeros((grid_size[1], grid_size[0]), dtype=np.uint8)
+    points = np.round((polygon - grid_low) / resolution).astype(np.int32)
+    cv2.fillPoly(mask, [points], 1)
+    cv2.polylines(mask, [points], True, 1)
+
+    tiles = []
+    for row in range(counts[1]):
+        for col in range(counts[0]):
+            center = origin + step * (col, row)
+            x0, y0 = np.floor((center - fov / 2 - grid_low) / resolution).astype(int)
+            x1, y1 = np.ceil((center + fov / 2 - grid_low) / resolution).astype(int)
+            if mask[max(y0, 0):y1 + 1, max(x0, 0):x1 + 1].any():
+                tiles.append({'row': row, 'col': col, 'x_mm': float(center[0]), 'y_mm': float(center[1])})
+    return tiles
+
+
+def move_cost(delta, backlash_mm=0.0):
+    """单次移动的电机行程（mm）：X、Y 依次移动，负方向多走两倍回程差"""
+    delta = np.asarray(delta, dtype=np.float64)
+    return np.abs(delta).sum(axis=-1) + 2 * backlash_mm * (delta < 0).sum(axis=-1)
+
+
+def travel_cost(points, start=None, backlash_mm=0.0):
+    """按给定顺序走完所有点的总行程（mm）"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if start is not None:
+        points = np.vstack([start, points])
+    if len(points) < 2:
+        return 0.0
+    return float(move_cost(np.diff(points, axis=0), backlash_mm).sum())
+
+
+def _line_order(tiles, serpentine, by_column=False):
+    major, minor = ('col', 'row') if by_column else ('row', 'col')
+    lines = {}
+    for idx, tile in enumerate(tiles):
+        lines.setdefault(tile[major], []).append(idx)
+    order = []
+    for n, line in enumerate(sorted(lines)):
+        indices = sorted(lines[line], key=lambda idx: tiles[idx][minor])
+        if serpentine and n % 2:
+            indices.reverse()
+        order.extend(indices)
+    return order
+
+
+def _nearest_order(points, start, backlash_mm):
+    remaining = np.ones(len(points), dtype=bool)
+    current = np.asarray(start, dtype=np.float64)
+    order = []
+    for _ in range(len(points)):
+        cost = move_cost(points - current, backlash_mm)
+        cost[~remaining] = np.inf
+        idx = int(np.argmin(cost))
+        order.append(idx)
+        remaining[idx] = False
+        current = points[idx]
+    return order
+
+
+def order_tiles(tiles, order='auto', start=None, backlash_mm=0.0):
+    """
+    确定扫描顺序，返回按扫描顺序排列的tile列表
+
+    参数:
+        order: serpentine / raster / nearest / auto（逐行、逐列和最近邻中取行程最小者）
+        start: 当前平台位置 (x, y) mm，为空时从第一个tile出发
+        backlash_mm: 回程差（mm），反向移动的额外代价
+    """
+    if order not in ORDERS:
+        raise ValueError(f"未知的扫描顺序: {order}")
+    if not tiles:
+        return []
+    points = np.array([(t['x_mm'], t['y_mm']) for t in tiles])
+    if start is None:
+        start = points[np.lexsort((points[:, 0], points[:, 1]))[0]]
+
+    candidates = {}
+    if order in ('serpentine', 'auto'):
+        candidates['serpentine'] = _line_order(tiles, serpentine=True)
+        if order == 'auto':
+            candidates['serpentine_columns'] = _line_order(tiles, serpentine=True, by_column=True)
+    if order == 'raster':
+        candidates['raster'] = _line_order(tiles, serpentine=False)
+    if order in ('nearest', 'auto'):
+        candidates['nearest'] = _nearest_order(points, start, backlash_mm)
+
+    costs = {name: travel_cost(points[idx], start, backlash_mm) for name, idx in candidates.items()}
+    best = min(costs, key=costs.get)
+    return [dict(tiles[idx]) for idx in candidates[best]]
+
+
+class ScanManifest:
+    """
+    扫描清单：scans/<scan_id>/manifest.json
+
+    tiles 按扫描顺序排列，每个tile记录 status（pending/done）、图像文件和拍摄时的Z位置；
+    每次更新都先写临时文件再替换，断电也不会留下半个清单
+    """
+
+    FILENAME = 'manifest.json'
+
+    def __init__(self, scan_dir, data):
+        self.scan_dir = scan_dir
+        self.path = os.path.join(scan_dir, self.FILENAME)
+        self.data = data
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, scans_root, region, fov_mm, overlap=0.2, order='auto', start=None, backlash_mm=0.0,
+               scan_id=None, **extra):
+        """规划扫描并写出新清单，extra 中的参数原样记录（如倍率、步数换算）"""
+        scan_id = scan_id or time.strftime('%Y%m%d-%H%M%S')
+        scan_dir = os.path.join(scans_root, scan_id)
+        os.makedirs(scan_dir, exist_ok=True)
+        tiles = order_tiles(plan_tiles(region, fov_mm, overlap), order, start, backlash_mm)
+        for i, tile in enumerate(tiles):
+            tile.update({'index': i, 'status': 'pending', 'file': None, 'z': None})
+        manifest = cls(scan_dir, {
+            'scan_id': scan_id,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'region': {key: np.asarray(value).tolist() for key, value in region.items()},
+            'fov_mm': list(fov_mm),
+            'overlap': overlap,
+            'order': order,
+            'tiles': tiles,
+            **extra,
+        })
+        manifest.save()
+        return manifest
+
+    @classmethod
+    def load(cls, scan_dir):
+        with open(os.path.join(scan_dir, cls.FILENAME), 'r', encoding='utf-8') as f:
+            return cls(scan_dir, json.load(f))
+
+    @property
+    def scan_id(self):
+        return self.data['scan_id']
+
+    @property
+    def tiles(self):
+        return self.data['tiles']
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    def mark_done(self, index, filename, z=None):
+        with self._lock:
+            tile = self.tiles[index]
+            tile.update({'status': 'done', 'file': filename, 'z': z})
+            self.save()
+
+    def update(self, **fields):
+        """更新清单顶层字段（如焦面的对焦点）并保存"""
+        with self._lock:
+            self.data.update(fields)
+            self.save()
+
+    def reanchor(self, dx_mm, dy_mm, dz=0, **fields):
+        """
+        平移区域、全部tile和对焦点的平台坐标（电机位置在两次会话之间被重置时），
+        fields 同时更新（如新的会话号）并保存
+        """
+        with self._lock:
+            shift = np.array([dx_mm, dy_mm])
+            region = self.data['region']
+            if 'bbox' in region:
+                region['bbox'] = (np.asarray(region['bbox'], dtype=np.float64) + np.tile(shift, 2)).tolist()
+            if 'polygon' in region:
+                region['polygon'] = (np.asarray(region['polygon'], dtype=np.float64).reshape(-1, 2) + shift).tolist()
+            for tile in self.tiles:
+                tile['x_mm'] += dx_mm
+                tile['y_mm'] += dy_mm
+                if tile['z'] is not None:
+                    tile['z'] += dz
+            self.data['focus_anchors'] = [[x + dx_mm, y + dy_mm, z + dz]
+                                          for x, y, z in self.data.get('focus_anchors', [])]
+            self.data.update(fields)
+            self.save()
+
+    def done_indices(self):
+        return {t['index'] for t in self.tiles if t['status'] == 'done'}
+
+    def is_complete(self):
+        return all(t['status'] == 'done' for t in self.tiles)
+
+    def target_steps(self, steps_per_mm_x, steps_per_mm_y):
+        """各tile中心的电机绝对位置（步数）"""
+        return [(int(round(t['x_mm'] * steps_per_mm_x)), int(round(t['y_mm'] * steps_per_mm_y)))
+                for t in self.tiles]
+
+    def summary(self):
+        rows = len({t['row'] for t in self.tiles})
+        cols = len({t['col'] for t in self.tiles})
+        return {'scan_id': self.scan_id, 'tiles': len(self.tiles), 'done': len(self.done_indices()),
+                'rows': rows, 'cols': cols}
+
+
+def planned_travel(tiles, start=None, backlash_mm=0.0):
+    """规划结果的总行程和扫描面积，便于前端预估扫描时间"""
+    points = [(t['x_mm'], t['y_mm']) for t in tiles]
+    return {'travel_mm': travel_cost(points, start, backlash_mm), 'tiles': len(tiles)}
@@ -1,3 +1,4 @@
 from .stitcher import AffineStitcher, Stitcher  # noqa: F401
+from .translation_stitcher import TranslationStitcher  # noqa: F401
 
 __version__ = "0.6.1"
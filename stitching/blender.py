@@ -1,9 +1,26 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2 as cv
 import numpy as np
 
+from .images import Images
+
 
 class Blender:
-    """https://docs.opencv.org/4.x/d6/d4a/classcv_1_1detail_1_1Blender.html"""
+    """https://docs.opencv.org/4.x/d6/d4a/classcv_1_1detail_1_1Blender.html
+
+    With strip_height, fed images are spilled to temporary .npy files and the
+    canvas is blended in horizontal strips of that height. Each strip is
+    padded by the reach of the blender and only the images intersecting it are
+    read back, so the blend pyramids never cover more than one strip.
+
+    With workers > 1 the canvas is split into one tile per worker, the tiles
+    are blended the same way in a process pool. The padding makes the tile
+    borders seamless.
+    """
 
     BLENDER_CHOICES = (
         "multiband",
@@ -12,41 +29,162 @@ class Blender:
     )
     DEFAULT_BLENDER = "multiband"
     DEFAULT_BLEND_STRENGTH = 5
+    DEFAULT_STRIP_HEIGHT = None
+    LOW_MEMORY_STRIP_HEIGHT = 512
+    DEFAULT_WORKERS = 1
 
     def __init__(
-        self, blender_type=DEFAULT_BLENDER, blend_strength=DEFAULT_BLEND_STRENGTH
+        self,
+        blender_type=DEFAULT_BLENDER,
+        blend_strength=DEFAULT_BLEND_STRENGTH,
+        strip_height=DEFAULT_STRIP_HEIGHT,
+        workers=DEFAULT_WORKERS,
     ):
         self.blender_type = blender_type
         self.blend_strength = blend_strength
+        self.strip_height = strip_height
+        self.workers = workers
         self.blender = None
+        self._spill_dir = None
+
+    @property
+    def in_regions(self):
+        return bool(self.strip_height) or self.workers > 1
 
     def prepare(self, corners, sizes):
         dst_sz = cv.detail.resultRoi(corners=corners, sizes=sizes)
-        blend_width = np.sqrt(dst_sz[2] * dst_sz[3]) * self.blend_strength / 100
+        self.dst_roi = dst_sz
+        self.blend_width = np.sqrt(dst_sz[2] * dst_sz[3]) * self.blend_strength / 100
+        if self.blender_type == "multiband" and self.blend_width >= 1:
+            self.num_bands = int((np.log(self.blend_width) / np.log(2.0) - 1.0))
 
-        if self.blender_type == "no" or blend_width < 1:
-            self.blender = cv.detail.Blender_createDefault(cv.detail.Blender_NO)
+        if self.in_regions:
+            self._cleanup()
+            self._spill_dir = tempfile.mkdtemp(prefix="stitching_blender_")
+            self._fed = []
+        else:
+            self.blender = self.create_blender(dst_sz)
+
+    def create_blender(self, roi):
+        """cv.detail blender prepared for roi, with the settings of the full canvas"""
+        if self.blender_type == "no" or self.blend_width < 1:
+            blender = cv.detail.Blender_createDefault(cv.detail.Blender_NO)
 
         elif self.blender_type == "multiband":
-            self.blender = cv.detail_MultiBandBlender()
-            self.blender.setNumBands(int((np.log(blend_width) / np.log(2.0) - 1.0)))
+            blender = cv.detail_MultiBandBlender()
+            blender.setNumBands(self.num_bands)
 
         elif self.blender_type == "feather":
-            self.blender = cv.detail_FeatherBlender()
-            self.blender.setSharpness(1.0 / blend_width)
+            blender = cv.detail_FeatherBlender()
+            blender.setSharpness(1.0 / self.blend_width)
+
+        blender.prepare(roi)
+        return blender
 
-        self.blender.prepare(dst_sz)
+    def padding(self):
+        """Distance in pixels over which a blended pixel depends on its
+        neighbourhood"""
+        if self.blender_type == "no" or self.blend_width < 1:
+            return 0
+        if self.blender_type == "multiband":
+            # 5x5 gaussian kernel on each of the num_bands pyramid levels
+            return 2 ** (self.num_bands + 2)
+        return int(np.ceil(self.blend_width)) + 1
 
     def feed(self, img, mask, corner):
-        self.blender.feed(cv.UMat(img.astype(np.int16)), mask, corner)
+        if self.in_regions:
+            self._spill(img, mask, corner)
+        else:
+            self.blender.feed(cv.UMat(img.astype(np.int16)), mask, corner)
+
+    def _spill(self, img, mask, corner):
+        idx = len(self._fed)
+        img_file = os.path.join(self._spill_dir, f"img_{idx:04d}.npy")
+        mask_file = os.path.join(self._spill_dir, f"mask_{idx:04d}.npy")
+        img = cv.UMat.get(img) if isinstance(img, cv.UMat) else img
+        mask = cv.UMat.get(mask) if isinstance(mask, cv.UMat) else mask
+        np.save(img_file, img)
+        np.save(mask_file, mask)
+        size = Images.get_image_size(img)
+        self._fed.append((img_file, mask_file, tuple(corner), size))
 
     def blend(self):
+        if self.in_regions:
+            return self._blend_regions()
         result = None
         result_mask = None
         result, result_mask = self.blender.blend(result, result_mask)
         result = cv.convertScaleAbs(result)
         return result, result_mask
 
+    def regions(self):
+        """Canvas rectangles (x, y, width, height) which are blended separately"""
+        x, y, width, height = self.dst_roi
+        region_width, region_height = width, height
+        if self.workers > 1:
+            # one roughly square tile per worker, every tile border costs
+            # padding on both sides
+            cols = max(1, int(round(np.sqrt(self.workers * width / height))))
+            rows = max(1, int(np.ceil(self.workers / cols)))
+            region_width, region_height = -(-width // cols), -(-height // rows)
+        if self.strip_height:
+            region_height = min(region_height, self.strip_height)
+        for top in range(y, y + height, region_height):
+            for left in range(x, x + width, region_width):
+                yield (
+                    left,
+                    top,
+                    min(region_width, x + width - left),
+                    min(region_height, y + height - top),
+                )
+
+    def _blend_regions(self):
+        x, y, width, height = self.dst_roi
+        result = np.zeros((height, width, 3), dtype=np.uint8)
+        result_mask = np.zeros((height, width), dtype=np.uint8)
+        regions = list(self.regions())
+        padding = self.padding()
+        args = (
+            self.blender_type,
+            self.blend_width,
+            getattr(self, "num_bands", None),
+            self.dst_roi,
+            self._fed,
+        )
+        try:
+            if self.workers > 1:
+                with ProcessPoolExecutor(
+                    self.workers, initializer=_init_worker
+                ) as executor:
+                    futures = [
+                        executor.submit(blend_region, *args, rect, padding)
+                        for rect in regions
+                    ]
+                    blended = (future.result() for future in futures)
+                    self._assemble(result, result_mask, regions, blended)
+            else:
+                blended = (blend_region(*args, rect, padding) for rect in regions)
+                self._assemble(result, result_mask, regions, blended)
+        finally:
+            self._cleanup()
+        return result, result_mask
+
+    def _assemble(self, result, result_mask, regions, blended):
+        x, y = self.dst_roi[:2]
+        for (left, top, width, height), (region, region_mask) in zip(regions, blended):
+            rows = slice(top - y, top - y + height)
+            cols = slice(left - x, left - x + width)
+            result[rows, cols] = region
+            result_mask[rows, cols] = region_mask
+
+    def _cleanup(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def __del__(self):
+        self._cleanup()
+
     @classmethod
     def create_panorama(cls, imgs, masks, corners, sizes):
         blender = cls("no")
@@ -54,3 +192,42 @@ class Blender:
         for img, mask, corner in zip(imgs, masks, corners):
             blender.feed(img, mask, corner)
         return blender.blend()
+
+
+def _init_worker():
+    # one OpenCV thread per worker process, the pool provides the parallelism
+    cv.setNumThreads(1)
+
+
+def blend_region(blender_type, blend_width, num_bands, dst_roi, fed, rect, padding):
+    """Blend rect of the canvas dst_roi from the images fed as .npy files
+    (img_file, mask_file, corner, size), reading only the padded rect"""
+    x, y, width, height = dst_roi
+    rx, ry, rw, rh = rect
+    x0, y0 = max(rx - padding, x), max(ry - padding, y)
+    x1, y1 = min(rx + rw + padding, x + width), min(ry + rh + padding, y + height)
+    if blender_type == "multiband" and num_bands:
+        # keep the pyramid sampling grid of the full canvas
+        step = 2**num_bands
+        x0, y0 = x + (x0 - x) // step * step, y + (y0 - y) // step * step
+
+    blender = Blender(blender_type)
+    blender.blend_width, blender.num_bands = blend_width, num_bands
+    region = blender.create_blender((x0, y0, x1 - x0, y1 - y0))
+    for img_file, mask_file, (cx, cy), (cw, ch) in fed:
+        ix0, iy0 = max(cx, x0), max(cy, y0)
+        ix1, iy1 = min(cx + cw, x1), min(cy + ch, y1)
+        if ix1 <= ix0 or iy1 <= iy0:
+            continue
+        rows, cols = slice(iy0 - cy, iy1 - cy), slice(ix0 - cx, ix1 - cx)
+        img = np.load(img_file, mmap_mode="r")[rows, cols].astype(np.int16)
+        mask = np.ascontiguousarray(np.load(mask_file, mmap_mode="r")[rows, cols])
+        region.feed(img, mask, (ix0, iy0))
+
+    result, result_mask = region.blend(None, None)
+    result = cv.convertScaleAbs(result)
+    if isinstance(result, cv.UMat):
+        result, result_mask = result.get(), result_mask.get()
+    rows = slice(ry - y0, ry - y0 + rh)
+    cols = slice(rx - x0, rx - x0 + rw)
+    return result[rows, cols], result_mask[rows, cols]
@@ -0,0 +1,225 @@
+import json
+import os
+
+import cv2 as cv
+import numpy as np
+
+from .images import Images
+from .stitching_error import StitchingError
+from .warper import Warper
+
+
+class StitchCalibration:
+    """Registration of a fixed image grid, saved to a directory and reused for
+    later scans with the same geometry.
+
+    Per image and per resolution (low and final), the warp and the crop are
+    baked into one pair of fixed point cv.remap maps
+    (https://docs.opencv.org/4.x/da/d54/group__imgproc__transform.html#gab75ef31ce5cdfb5c44b6da5f3b908ea4),
+    together with the warped masks, the cropped corners and sizes and the
+    low resolution seam masks. A reused calibration only needs remapping,
+    exposure compensation and blending.
+
+    The normalized cross correlation of the overlapping low resolution images
+    is stored as a reference. If a new scan correlates clearly worse, the
+    geometry changed and the calibration must not be used.
+    """  # noqa: E501
+
+    FILENAME = "calibration.json"
+    DEFAULT_MIN_NCC_RATIO = 0.7
+    MIN_OVERLAP_PIXELS = 100
+    RESOLUTIONS = ("low", "final")
+
+    def __init__(self, path, data, arrays=None):
+        self.path = path
+        self.data = data
+        self.arrays = arrays or {}
+
+    @property
+    def indices(self):
+        return self.data["indices"]
+
+    @property
+    def image_sizes(self):
+        return [tuple(size) for size in self.data["image_sizes"]]
+
+    def corners(self, resolution):
+        return [tuple(corner) for corner in self.data[resolution]["corners"]]
+
+    def sizes(self, resolution):
+        return [tuple(size) for size in self.data[resolution]["sizes"]]
+
+    @classmethod
+    def from_stitcher(cls, stitcher, path=None):
+        """Calibration from the last Stitcher.stitch() run"""
+        images, cameras = stitcher.images, stitcher.cameras
+        data = {
+            "image_sizes": [list(size) for size in images.sizes],
+            "n_images": stitcher.n_images,
+            "indices": [int(i) for i in stitcher.indices],
+            "megapix": [stitcher.low_megapix, stitcher.final_megapix],
+            "warper_type": stitcher.warper.warper_type,
+            "scale": float(stitcher.warper.scale),
+            "cameras": [cls._camera_to_dict(camera) for camera in cameras],
+        }
+        arrays = {}
+        medium = Images.Resolution.MEDIUM
+        for resolution in cls.RESOLUTIONS:
+            res = Images.Resolution[resolution.upper()]
+            aspect = images.get_ratio(medium, res)
+            crop_aspect = images.get_ratio(Images.Resolution.LOW, res)
+            sizes = images.get_scaled_img_sizes(res)
+            warper = cv.PyRotationWarper(
+                stitcher.warper.warper_type, stitcher.warper.scale * aspect
+            )
+            for idx, (size, camera) in enumerate(zip(sizes, cameras)):
+                K = Warper.get_K(camera, aspect)
+                _, xmap, ymap = warper.buildMaps(size, K, camera.R)
+                mask = stitcher.warper.create_and_warp_mask(size, camera, aspect)
+                if stitcher.cropper.do_crop:
+                    rect = stitcher.cropper.intersection_rectangles[idx]
+                    x, y, w, h = rect.times(crop_aspect)
+                    xmap, ymap = xmap[y : y + h, x : x + w], ymap[y : y + h, x : x + w]
+                    mask = mask[y : y + h, x : x + w]
+                map1, map2 = cv.convertMaps(xmap, ymap, cv.CV_16SC2)
+                arrays[f"{resolution}_{idx:03d}_map1"] = map1
+                arrays[f"{resolution}_{idx:03d}_map2"] = map2
+                arrays[f"{resolution}_{idx:03d}_mask"] = np.ascontiguousarray(mask)
+            corners, roi_sizes = stitcher.warper.warp_rois(sizes, cameras, aspect)
+            corners, roi_sizes = stitcher.cropper.crop_rois(
+                corners, roi_sizes, crop_aspect
+            )
+            data[resolution] = {
+                "corners": [[int(c) for c in corner] for corner in corners],
+                "sizes": [[int(s) for s in size] for size in roi_sizes],
+            }
+        for idx, seam_mask in enumerate(stitcher.seam_masks):
+            arrays[f"seam_{idx:03d}"] = cv.UMat.get(seam_mask)
+
+        calibration = cls(path, data, arrays)
+        low_imgs = stitcher.images.resize(Images.Resolution.LOW)
+        low_imgs = list(calibration.remap_images(low_imgs, "low"))
+        calibration.data["reference_ncc"] = calibration.overlap_ncc(low_imgs)
+        return calibration
+
+    @staticmethod
+    def _camera_to_dict(camera):
+        return {
+            "focal": float(camera.focal),
+            "aspect": float(camera.aspect),
+            "ppx": float(camera.ppx),
+            "ppy": float(camera.ppy),
+            "R": np.asarray(camera.R, dtype=np.float64).tolist(),
+            "t": np.asarray(camera.t, dtype=np.float64).ravel().tolist(),
+        }
+
+    def save(self, path=None):
+        self.path = path or self.path
+        os.makedirs(self.path, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(self.path, name + ".npy"), array)
+        with open(os.path.join(self.path, self.FILENAME), "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+
+    @classmethod
+    def load(cls, path):
+        filename = os.path.join(path, cls.FILENAME)
+        if not os.path.isfile(filename):
+            raise StitchingError(f"No stitching calibration in {path}")
+        with open(filename, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(path, data)
+
+    def _array(self, name):
+        if name not in self.arrays:
+            filename = os.path.join(self.path, name + ".npy")
+            if not os.path.isfile(filename):
+                raise StitchingError(f"Calibration file {filename} is missing")
+            self.arrays[name] = np.load(filename)
+        return self.arrays[name]
+
+    def check_settings(self, stitcher):
+        if len(stitcher.images.names) != self.data["n_images"]:
+            raise StitchingError(
+                f"Calibration is for {self.data['n_images']} images, "
+                f"got {len(stitcher.images.names)}"
+            )
+        if [stitcher.low_megapix, stitcher.final_megapix] != self.data["megapix"]:
+            raise StitchingError("Calibration was made with other resolutions")
+
+    def check_sizes(self, sizes):
+        if [tuple(size) for size in sizes] != self.image_sizes:
+            raise StitchingError("Image sizes differ from the calibration")
+
+    def remap(self, img, idx, resolution):
+        """Warped and cropped image idx"""
+        return cv.remap(
+            img,
+            self._array(f"{resolution}_{idx:03d}_map1"),
+            self._array(f"{resolution}_{idx:03d}_map2"),
+            cv.INTER_LINEAR,
+            borderMode=cv.BORDER_REFLECT,
+        )
+
+    def remap_images(self, imgs, resolution):
+        for idx, img in enumerate(imgs):
+            yield self.remap(img, idx, resolution)
+
+    def masks(self, resolution):
+        for idx in range(len(self.indices)):
+            yield self._array(f"{resolution}_{idx:03d}_mask")
+
+    def seam_masks(self):
+        for idx in range(len(self.indices)):
+            yield self._array(f"seam_{idx:03d}")
+
+    def overlap_ncc(self, low_imgs):
+        """{"i,j": ncc} of all overlapping low resolution image pairs"""
+        corners, sizes = self.corners("low"), self.sizes("low")
+        masks = list(self.masks("low"))
+        grays = [
+            cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img
+            for img in low_imgs
+        ]
+        ncc = {}
+        for i in range(len(grays)):
+            for j in range(i + 1, len(grays)):
+                x0 = max(corners[i][0], corners[j][0])
+                y0 = max(corners[i][1], corners[j][1])
+                x1 = min(corners[i][0] + sizes[i][0], corners[j][0] + sizes[j][0])
+                y1 = min(corners[i][1] + sizes[i][1], corners[j][1] + sizes[j][1])
+                if x1 <= x0 or y1 <= y0:
+                    continue
+                rois = [
+                    (
+                        slice(y0 - corners[k][1], y1 - corners[k][1]),
+                        slice(x0 - corners[k][0], x1 - corners[k][0]),
+                    )
+                    for k in (i, j)
+                ]
+                valid = (masks[i][rois[0]] > 0) & (masks[j][rois[1]] > 0)
+                if valid.sum() < self.MIN_OVERLAP_PIXELS:
+                    continue
+                a = grays[i][rois[0]][valid].astype(np.float64)
+                b = grays[j][rois[1]][valid].astype(np.float64)
+                a -= a.mean()
+                b -= b.mean()
+                denominator = np.sqrt((a * a).sum() * (b * b).sum())
+                if denominator > 0:
+                    ncc[f"{i},{j}"] = float((a * b).sum() / denominator)
+        return ncc
+
+    def verify(self, low_imgs, min_ncc_ratio=DEFAULT_MIN_NCC_RATIO):
+        """Raise a StitchingError if the overlaps correlate clearly worse than
+        in the calibration scan"""
+        reference = self.data.get("reference_ncc", {})
+        if not reference:
+            return
+        ncc = self.overlap_ncc(low_imgs)
+        current = np.mean([ncc.get(pair, 0.0) for pair in reference])
+        expected = np.mean(list(reference.values()))
+        if current < min_ncc_ratio * expected:
+            raise StitchingError(
+                f"Overlaps correlate with {current:.2f}, the calibration with "
+                f"{expected:.2f}"
+            )
@@ -0,0 +1,151 @@
+"""
+Peak memory and run time of the stitching package
+
+Every configuration is stitched in its own subprocess, so the peak resident
+set size (ru_maxrss) of one run is not hidden by an earlier one. Without
+images, a synthetic grid of overlapping tiles is written to a temporary
+directory first.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+
+from stitching import AffineStitcher, Stitcher
+
+CONFIGURATIONS = {
+    "default": {},
+    "low_memory": {"low_memory": True},
+    "blend_workers": {"blend_workers": os.cpu_count() or 1},
+    # cheap exposure compensation, enough for flat field corrected tiles
+    "gain": {"compensator": "gain"},
+    "no_compensator": {"compensator": "no"},
+}
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog="benchmark.py")
+    parser.add_argument("images", nargs="*", help="Files to stitch", type=str)
+    parser.add_argument(
+        "--configurations",
+        nargs="+",
+        default=list(CONFIGURATIONS),
+        choices=list(CONFIGURATIONS),
+        help="Stitcher configurations to compare. The default is all of them.",
+    )
+    parser.add_argument(
+        "--affine",
+        action="store_true",
+        help="Use the AffineStitcher, as for scans of a planar sample.",
+    )
+    parser.add_argument(
+        "--grid",
+        nargs=2,
+        default=(3, 3),
+        type=int,
+        help="Columns and rows of the synthetic tile grid. The default is 3 3.",
+    )
+    parser.add_argument(
+        "--tile_size",
+        nargs=2,
+        default=(2028, 1520),
+        type=int,
+        help="Width and height of the synthetic tiles. The default is 2028 1520.",
+    )
+    parser.add_argument(
+        "--overlap",
+        default=0.3,
+        type=float,
+        help="Overlap of neighbouring synthetic tiles. The default is 0.3.",
+    )
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    return parser
+
+
+def write_synthetic_tiles(directory, grid=(3, 3), tile_size=(2028, 1520), overlap=0.3):
+    """Cut a grid of overlapping tiles from a random textured image"""
+    cols, rows = grid
+    width, height = tile_size
+    step_x, step_y = int(width * (1 - overlap)), int(height * (1 - overlap))
+    rng = np.random.default_rng(0)
+    shape = (step_y * (rows - 1) + height, step_x * (cols - 1) + width, 3)
+    canvas = cv.GaussianBlur(rng.integers(0, 255, shape, dtype=np.uint8), (0, 0), 3)
+    for _ in range(shape[0] * shape[1] // 20000):
+        center = (int(rng.integers(shape[1])), int(rng.integers(shape[0])))
+        color = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv.circle(canvas, center, int(rng.integers(5, 60)), color, -1)
+    files = []
+    for row in range(rows):
+        for col in range(cols):
+            x, y = col * step_x, row * step_y
+            files.append(os.path.join(directory, f"tile_{row}_{col}.png"))
+            cv.imwrite(files[-1], canvas[y : y + height, x : x + width])
+    return files
+
+
+def run_child(configuration, images, affine):
+    """Stitch in this process and report time and peak memory as json"""
+    kwargs = CONFIGURATIONS[configuration]
+    stitcher = AffineStitcher(**kwargs) if affine else Stitcher(**kwargs)
+    start = time.time()
+    panorama = stitcher.stitch(images)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(
+        json.dumps(
+            {
+                "configuration": configuration,
+                "seconds": round(seconds, 2),
+                "max_rss_mb": round(max_rss, 1),
+                "panorama": list(panorama.shape[1::-1]),
+            }
+        )
+    )
+
+
+def benchmark(images, configurations=tuple(CONFIGURATIONS), affine=False):
+    """Stitch images once per configuration, each in a fresh subprocess"""
+    results = []
+    for configuration in configurations:
+        cmd = [sys.executable, "-m", "stitching.cli.benchmark", "--child"]
+        cmd += [configuration] + (["--affine"] if affine else []) + list(images)
+        output = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return results
+
+
+def main():
+    args = create_parser().parse_args(sys.argv[1:])
+    if args.child:
+        run_child(args.child, args.images, args.affine)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        images = args.images
+        if not images:
+            images = write_synthetic_tiles(
+                directory, args.grid, args.tile_size, args.overlap
+            )
+        input_mb = sum(
+            np.prod(cv.imread(img, cv.IMREAD_UNCHANGED).shape) for img in images
+        ) / 2**20
+        print(f"{len(images)} images, {input_mb:.0f} MB decoded")
+        for result in benchmark(images, args.configurations, args.affine):
+            print(
+                f"{result['configuration']:>14}: {result['seconds']:7.2f} s, "
+                f"peak RSS {result['max_rss_mb']:8.1f} MB, "
+                f"panorama {result['panorama'][0]}x{result['panorama'][1]}"
+            )
+
+
+if __name__ == "__main__":
+    main()
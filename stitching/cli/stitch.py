@@ -70,11 +70,36 @@ def create_parser():
         "--nfeatures",
         action="store",
         default=500,
+        nargs="+",
         help="Number of features to be detected per image. "
         "Only used for the detectors 'orb' and 'sift'. "
+        "Pass one value per image to set individual budgets. "
         "The default is 500.",
         type=int,
     )
+    parser.add_argument(
+        "--detector_workers",
+        action="store",
+        default=FeatureDetector.DEFAULT_WORKERS,
+        help="Number of threads used for feature detection. "
+        "The default is %s." % FeatureDetector.DEFAULT_WORKERS,
+        type=int,
+    )
+    parser.add_argument(
+        "--feature_grid",
+        action="store",
+        default=FeatureDetector.DEFAULT_GRID,
+        help="Spread features evenly by keeping the strongest keypoints in each "
+        "cell of a N x N grid. 0 disables the grid. "
+        "The default is %s." % FeatureDetector.DEFAULT_GRID,
+        type=int,
+    )
+    parser.add_argument(
+        "--feature_cache",
+        action="store_true",
+        help="Cache detected features by image content, so that stitching the "
+        "same images again skips the detection.",
+    )
     parser.add_argument(
         "--feature_masks",
         nargs="*",
@@ -254,6 +279,20 @@ def create_parser():
         "The default is '%s'." % Blender.DEFAULT_BLEND_STRENGTH,
         type=np.int32,
     )
+    parser.add_argument(
+        "--blend_workers",
+        action="store",
+        default=Blender.DEFAULT_WORKERS,
+        help="Number of processes blending tiles of the panorama in parallel. "
+        "The default is %s." % Blender.DEFAULT_WORKERS,
+        type=int,
+    )
+    parser.add_argument(
+        "--low_memory",
+        action="store_true",
+        help="Find seams on the 8 bit low resolution images and blend the "
+        "panorama in strips, the fed images are kept in temporary files.",
+    )
     parser.add_argument(
         "--timelapse",
         action="store",
@@ -264,6 +303,22 @@ def create_parser():
         choices=Timelapser.TIMELAPSE_CHOICES,
         type=str,
     )
+    parser.add_argument(
+        "--save_calibration",
+        action="store",
+        default=None,
+        help="Directory where the estimated registration (cameras, warp maps, "
+        "crops and seam masks) is saved for later scans with the same geometry.",
+        type=str,
+    )
+    parser.add_argument(
+        "--calibration",
+        action="store",
+        default=None,
+        help="Directory of a saved registration. Only exposure compensation and "
+        "blending are computed, unless the images do not fit the calibration.",
+        type=str,
+    )
     parser.add_argument(
         "--preview",
         action="store_true",
@@ -311,6 +366,10 @@ def main():
     preview = args_dict.pop("preview")
     output = args_dict.pop("output")
     output_params = args_dict.pop("output_params")
+    save_calibration = args_dict.pop("save_calibration")
+    calibration = args_dict.pop("calibration")
+    if verbose and (calibration or save_calibration):
+        parser.error("--calibration and --save_calibration can not be used with --verbose")
 
     # Create Stitcher
     affine_mode = args_dict.pop("affine")
@@ -327,7 +386,12 @@ def main():
         panorama = stitcher.stitch_verbose(images, feature_masks, verbose_dir)
     else:
         print("stitching " + " ".join(images) + " into " + output)
-        panorama = stitcher.stitch(images, feature_masks)
+        if calibration:
+            panorama = stitcher.stitch_calibrated(images, calibration, feature_masks)
+        else:
+            panorama = stitcher.stitch(images, feature_masks)
+        if save_calibration and stitcher.cameras is not None:
+            stitcher.save_calibration(save_calibration)
         cv.imwrite(output, panorama, output_params)
 
     if preview:
@@ -1,4 +1,7 @@
+import hashlib
+import threading
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2 as cv
 import numpy as np
@@ -18,17 +21,63 @@ class FeatureDetector:
 
     DEFAULT_DETECTOR = list(DETECTOR_CHOICES.keys())[0]
 
-    def __init__(self, detector=DEFAULT_DETECTOR, **kwargs):
-        self.detector = FeatureDetector.DETECTOR_CHOICES[detector](**kwargs)
+    DEFAULT_WORKERS = 1
+    DEFAULT_GRID = 0
+    DEFAULT_CACHE = False
+    DEFAULT_GRID_FEATURES = 500
+    GRID_OVERSAMPLING = 4
+    CACHE_SIZE = 64
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(
+        self,
+        detector=DEFAULT_DETECTOR,
+        workers=DEFAULT_WORKERS,
+        grid=DEFAULT_GRID,
+        cache=DEFAULT_CACHE,
+        **kwargs,
+    ):
+        nfeatures = kwargs.pop("nfeatures", None)
+        self.budgets = None
+        if isinstance(nfeatures, (list, tuple)):
+            if len(nfeatures) > 1:
+                self.budgets = [int(n) for n in nfeatures]
+                nfeatures = max(self.budgets)
+            else:
+                nfeatures = nfeatures[0]
+        self.detector_type = detector
+        self.nfeatures = nfeatures
+        self.kwargs = kwargs
+        self.workers = workers
+        self.grid = grid
+        self.cache = cache
+        self.detector = self._create_detector(nfeatures)
+        self._local = threading.local()
+
+    def _create_detector(self, nfeatures=None):
+        kwargs = dict(self.kwargs)
+        if nfeatures is not None:
+            kwargs["nfeatures"] = int(nfeatures)
+        return FeatureDetector.DETECTOR_CHOICES[self.detector_type](**kwargs)
+
+    def _thread_detector(self, nfeatures=None):
+        """Feature2D objects are not shared between worker threads"""
+        detectors = getattr(self._local, "detectors", None)
+        if detectors is None:
+            detectors = self._local.detectors = {}
+        if nfeatures not in detectors:
+            detectors[nfeatures] = self._create_detector(nfeatures)
+        return detectors[nfeatures]
 
     def detect_features(self, img, *args, **kwargs):
         return cv.detail.computeImageFeatures2(self.detector, img, *args, **kwargs)
 
     def detect(self, imgs):
-        return [self.detect_features(img) for img in imgs]
+        return self._detect_all(imgs, [None] * len(imgs))
 
     def detect_with_masks(self, imgs, masks):
-        features = []
         for idx, (img, mask) in enumerate(zip(imgs, masks)):
             assert len(img.shape) == 3 and len(mask.shape) == 2
             if not len(imgs) == len(masks):
@@ -38,9 +87,117 @@ class FeatureDetector:
                     f"Resolution of mask {idx + 1} {mask.shape} does not match"
                     f" the resolution of image {idx + 1} {img.shape[:2]}."
                 )
-            features.append(self.detect_features(img, mask=mask))
+        return self._detect_all(imgs, masks)
+
+    def _detect_all(self, imgs, masks):
+        budgets = self.budgets or [self.nfeatures] * len(imgs)
+        if len(budgets) != len(imgs):
+            raise StitchingError(
+                f"{len(budgets)} feature budgets given for {len(imgs)} images"
+            )
+        jobs = list(zip(imgs, masks, budgets))
+        if self.workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return list(executor.map(lambda job: self._detect_one(*job), jobs))
+        return [self._detect_one(*job) for job in jobs]
+
+    def _detect_one(self, img, mask, nfeatures):
+        key = self._cache_key(img, mask, nfeatures) if self.cache else None
+        if key is not None:
+            with FeatureDetector._cache_lock:
+                if key in FeatureDetector._cache:
+                    FeatureDetector._cache.move_to_end(key)
+                    return FeatureDetector._cache[key]
+
+        if self.grid:
+            features = self._detect_grid(img, mask, nfeatures)
+        else:
+            detector = self._thread_detector(nfeatures)
+            if mask is None:
+                features = cv.detail.computeImageFeatures2(detector, img)
+            else:
+                features = cv.detail.computeImageFeatures2(detector, img, mask=mask)
+
+        if key is not None:
+            with FeatureDetector._cache_lock:
+                FeatureDetector._cache[key] = features
+                while len(FeatureDetector._cache) > FeatureDetector.CACHE_SIZE:
+                    FeatureDetector._cache.popitem(last=False)
+        return features
+
+    def _cache_key(self, img, mask, nfeatures):
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (img, mask):
+            if array is None:
+                continue
+            if isinstance(array, cv.UMat):
+                array = array.get()
+            array = np.ascontiguousarray(array)
+            digest.update(str(array.shape).encode())
+            digest.update(array.data)
+        settings = (
+            self.detector_type,
+            sorted(self.kwargs.items()),
+            nfeatures,
+            self.grid,
+        )
+        return digest.hexdigest(), repr(settings)
+
+    def _detect_grid(self, img, mask, nfeatures):
+        """Keep the strongest keypoints per cell of a grid x grid bucket layout.
+        Budget left over by blank cells goes to the strongest remaining keypoints.
+        """
+        if isinstance(img, cv.UMat):
+            img = img.get()
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img
+        h, w = gray.shape
+        total = nfeatures or self.DEFAULT_GRID_FEATURES
+
+        oversampled = (
+            total * self.GRID_OVERSAMPLING if self.nfeatures is not None else None
+        )
+        detector = self._thread_detector(oversampled)
+        keypoints = detector.detect(gray, mask)
+
+        if len(keypoints) > total:
+            pts = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+            response = np.array([kp.response for kp in keypoints], dtype=np.float32)
+            cols = np.minimum((pts[:, 0] * self.grid / w).astype(int), self.grid - 1)
+            rows = np.minimum((pts[:, 1] * self.grid / h).astype(int), self.grid - 1)
+            cells = rows * self.grid + cols
+
+            # rank of each keypoint within its cell, strongest first
+            order = np.lexsort((-response, cells))
+            sorted_cells = cells[order]
+            group_start = np.searchsorted(sorted_cells, sorted_cells, side="left")
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order)) - group_start
+
+            per_cell = max(1, total // (self.grid * self.grid))
+            selected = rank < per_cell
+            remaining = total - int(selected.sum())
+            if remaining > 0:
+                leftovers = np.flatnonzero(~selected)
+                strongest = leftovers[np.argsort(-response[leftovers])[:remaining]]
+                selected[strongest] = True
+            keypoints = [keypoints[i] for i in np.flatnonzero(selected)]
+
+        keypoints, descriptors = detector.compute(gray, keypoints)
+        features = cv.detail.ImageFeatures()
+        features.img_idx = 0
+        features.img_size = (w, h)
+        features.keypoints = keypoints
+        if descriptors is None:
+            dtype = np.uint8 if detector.descriptorType() == cv.CV_8U else np.float32
+            descriptors = np.empty((0, detector.descriptorSize()), dtype)
+        features.descriptors = cv.UMat(descriptors)
         return features
 
+    @staticmethod
+    def clear_cache():
+        with FeatureDetector._cache_lock:
+            FeatureDetector._cache.clear()
+
     @staticmethod
     def draw_keypoints(img, features, **kwargs):
         kwargs.setdefault("color", (0, 255, 0))
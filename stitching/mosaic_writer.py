@@ -0,0 +1,302 @@
+import math
+import os
+
+import cv2 as cv
+import numpy as np
+
+from .stitching_error import StitchingError
+
+
+class MosaicWriter:
+    """Out-of-core planar mosaic written as a DeepZoom image pyramid
+    (https://github.com/openseadragon/openseadragon/wiki/The-DZI-File-Format)
+
+    The canvas is split into tile_size chunks. Images are feather blended into
+    the chunks they cover, each chunk keeps the running weighted mean (uint8)
+    and the summed weight (float16), 5 bytes per pixel. A chunk is written and
+    released as soon as all images that can cover it were added, and its half
+    resolution copy is handed on to the next pyramid level.
+
+    Memory is bounded by the chunks that were started but still wait for
+    images, not by the height of the mosaic. Images added row by row keep the
+    chunks of the row being added plus the band the next row will overlap
+    (overlap plus margin high) across the full canvas width, so it grows with
+    the row width.
+
+    If the corners are only known roughly (margin), restrict() narrows the
+    region an image can still be added in once its position is predicted
+    better, so the chunks no image can reach any more are written early.
+    """
+
+    DEFAULT_TILE_SIZE = 256
+    DEFAULT_BLEND_WIDTH = 64
+    DEFAULT_FORMAT = "jpeg"
+    DEFAULT_QUALITY = 90
+
+    def __init__(
+        self,
+        path,
+        corners,
+        sizes,
+        tile_size=DEFAULT_TILE_SIZE,
+        blend_width=DEFAULT_BLEND_WIDTH,
+        tile_format=DEFAULT_FORMAT,
+        quality=DEFAULT_QUALITY,
+        margin=0,
+    ):
+        """path: the .dzi file, the tiles go to <name>_files/<level>/<col>_<row>.
+        corners and sizes: (x, y) canvas position and (width, height) of each image.
+        margin: if the corners are only approximate, each image may be added up to
+        margin pixels away from its corner
+        """
+        if tile_size % 2:
+            raise StitchingError("tile_size must be even")
+        corners = np.round(np.asarray(corners, dtype=np.float64)).astype(int)
+        corners = corners.reshape(-1, 2)
+        self.origin = corners.min(axis=0) - margin
+        self.sizes = np.asarray(sizes, dtype=int).reshape(-1, 2)
+        self.corners = corners - self.origin
+        self.margin = margin
+        size = (self.corners + self.sizes).max(axis=0) + margin
+        self.width, self.height = size.tolist()
+        self.path = path
+        self.files_dir = os.path.splitext(path)[0] + "_files"
+        self.tile_size = tile_size
+        self.blend_width = blend_width
+        self.tile_format = tile_format
+        self.params = self._encode_params(tile_format, quality)
+        self.max_level = math.ceil(math.log2(max(self.width, self.height, 1)))
+        self.files = []
+
+        self._chunks = {}
+        self._children = {}
+        self._weights = {}
+        self._added = set()
+        # canvas region each image can be added in: (x0, y0, x1, y1)
+        self.regions = np.hstack(
+            [self.corners - margin, self.corners + self.sizes + margin]
+        )
+        self.pending = np.zeros(self.grid_size(self.max_level)[::-1], dtype=int)
+        self.written = np.zeros(self.pending.shape, dtype=bool)
+        for idx in range(len(self.corners)):
+            col0, row0, col1, row1 = self._chunk_range(self.regions[idx])
+            self.pending[row0:row1, col0:col1] += 1
+        for row, col in zip(*np.nonzero(self.pending == 0)):
+            self._finish_chunk(int(col), int(row))
+
+    @staticmethod
+    def _encode_params(tile_format, quality):
+        if tile_format in ("jpeg", "jpg"):
+            return [cv.IMWRITE_JPEG_QUALITY, quality]
+        if tile_format == "png":
+            return [cv.IMWRITE_PNG_COMPRESSION, 1]
+        return []
+
+    def level_size(self, level):
+        factor = 2 ** (self.max_level - level)
+        return math.ceil(self.width / factor), math.ceil(self.height / factor)
+
+    def grid_size(self, level):
+        width, height = self.level_size(level)
+        return math.ceil(width / self.tile_size), math.ceil(height / self.tile_size)
+
+    def _tile_rect(self, level, col, row):
+        width, height = self.level_size(level)
+        x, y = col * self.tile_size, row * self.tile_size
+        return x, y, min(self.tile_size, width - x), min(self.tile_size, height - y)
+
+    def _chunk_range(self, region):
+        x0, y0, x1, y1 = region
+        size = self.tile_size
+        return x0 // size, y0 // size, (x1 - 1) // size + 1, (y1 - 1) // size + 1
+
+    def _covered_chunks(self, idx):
+        col0, row0, col1, row1 = self._chunk_range(self.regions[idx])
+        return [(col, row) for row in range(row0, row1) for col in range(col0, col1)]
+
+    def limits(self, idx):
+        """Lowest and highest corner image idx can still be added at"""
+        x0, y0, x1, y1 = self.regions[idx]
+        lo = np.array([x0, y0])
+        hi = np.array([x1, y1]) - self.sizes[idx]
+        return lo + self.origin, hi + self.origin
+
+    def restrict(self, idx, x0, y0, x1, y1):
+        """Image idx will be added inside the region (x0, y0, x1, y1), in the
+        coordinates of the corners. Chunks no image can reach any more are
+        written. Regions that do not fit the image any more are ignored."""
+        if idx in self._added:
+            return
+        old = self.regions[idx].copy()
+        region = np.array([np.floor(x0), np.floor(y0), np.ceil(x1), np.ceil(y1)])
+        region = region.astype(int) - np.tile(self.origin, 2)
+        region[:2] = np.maximum(region[:2], old[:2])
+        region[2:] = np.minimum(region[2:], old[2:])
+        if (region[2:] - region[:2] < self.sizes[idx]).any():
+            return
+        self.regions[idx] = region
+        old_range = self._chunk_range(old)
+        new_range = self._chunk_range(region)
+        if old_range == new_range:
+            return
+        col0, row0, col1, row1 = old_range
+        self.pending[row0:row1, col0:col1] -= 1
+        col0, row0, col1, row1 = new_range
+        self.pending[row0:row1, col0:col1] += 1
+        col0, row0, col1, row1 = old_range
+        done = (self.pending[row0:row1, col0:col1] == 0) & ~self.written[
+            row0:row1, col0:col1
+        ]
+        for row, col in zip(*np.nonzero(done)):
+            self._finish_chunk(int(col0 + col), int(row0 + row))
+
+    def _feather(self, w, h):
+        """Weight rising linearly over blend_width pixels from each image border"""
+        if (w, h) not in self._weights:
+            ramp_x = np.minimum(np.arange(w) + 1, w - np.arange(w))
+            ramp_y = np.minimum(np.arange(h) + 1, h - np.arange(h))
+            weight = np.minimum(ramp_x[None, :], ramp_y[:, None]).astype(np.float32)
+            np.clip(weight / self.blend_width, None, 1, out=weight)
+            self._weights[(w, h)] = weight
+        return self._weights[(w, h)]
+
+    def add(self, idx, img, mask=None, corner=None):
+        """Blend image idx into its chunks. mask (uint8) restricts its footprint,
+        the weight ramps up over blend_width pixels from the mask border.
+        corner overrides the approximate corner given on construction."""
+        if idx in self._added:
+            raise StitchingError(f"Image {idx} was already added")
+        (x, y), (w, h) = self.corners[idx], self.sizes[idx]
+        if corner is not None:
+            corner = np.round(corner).astype(int)
+            lo, hi = self.limits(idx)
+            if (corner < lo).any() or (corner > hi).any():
+                raise StitchingError(
+                    f"Image {idx} is placed outside of the region it was "
+                    "expected in"
+                )
+            x, y = corner - self.origin
+        if img.shape[:2] != (h, w):
+            raise StitchingError(
+                f"Image {idx} has size {img.shape[1::-1]}, expected {(w, h)}"
+            )
+        if img.ndim == 2:
+            img = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
+        weight = self._feather(w, h)
+        if mask is not None:
+            # feather from the mask border as well
+            dist = cv.distanceTransform((mask > 0).astype(np.uint8), cv.DIST_L2, 3)
+            weight = np.minimum(weight, np.clip(dist / self.blend_width, None, 1))
+        self._added.add(idx)
+
+        for col, row in self._covered_chunks(idx):
+            cx, cy, cw, ch = self._tile_rect(self.max_level, col, row)
+            x0, y0 = max(x, cx), max(y, cy)
+            x1, y1 = min(x + w, cx + cw), min(y + h, cy + ch)
+            if x1 <= x0 or y1 <= y0:
+                self._release(col, row)
+                continue
+            if (col, row) not in self._chunks:
+                self._chunks[(col, row)] = (
+                    np.zeros((ch, cw, 3), dtype=np.uint8),
+                    np.zeros((ch, cw), dtype=np.float16),
+                )
+            acc, acc_weight = self._chunks[(col, row)]
+            src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+            dst = (slice(y0 - cy, y1 - cy), slice(x0 - cx, x1 - cx))
+            part_weight = weight[src]
+            total = acc_weight[dst] + part_weight
+            share = np.divide(
+                part_weight, total, out=np.zeros_like(total), where=total > 0
+            )
+            mean = acc[dst].astype(np.float32)
+            mean += (img[src] - mean) * share[..., None]
+            acc[dst] = mean + 0.5
+            acc_weight[dst] = total
+            self._release(col, row)
+
+    def _release(self, col, row):
+        self.pending[row, col] -= 1
+        if self.pending[row, col] == 0:
+            self._finish_chunk(col, row)
+
+    def _finish_chunk(self, col, row):
+        self.written[row, col] = True
+        _, _, cw, ch = self._tile_rect(self.max_level, col, row)
+        acc = self._chunks.pop((col, row), None)
+        if acc is None:
+            tile = np.zeros((ch, cw, 3), dtype=np.uint8)
+        else:
+            tile = acc[0]
+        self._write_tile(self.max_level, col, row, tile)
+
+    def _write_tile(self, level, col, row, tile):
+        level_dir = os.path.join(self.files_dir, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        path = os.path.join(level_dir, f"{col}_{row}.{self.tile_format}")
+        cv.imwrite(path, tile, self.params)
+        self.files.append(path)
+        if level == 0:
+            return
+
+        h, w = tile.shape[:2]
+        half = cv.resize(
+            tile, ((w + 1) // 2, (h + 1) // 2), interpolation=cv.INTER_AREA
+        )
+        parent = (level - 1, col // 2, row // 2)
+        siblings = self._children.setdefault(parent, {})
+        siblings[(col % 2, row % 2)] = half
+
+        cols, rows = self.grid_size(level)
+        n_cols = min(cols, 2 * parent[1] + 2) - 2 * parent[1]
+        n_rows = min(rows, 2 * parent[2] + 2) - 2 * parent[2]
+        if len(siblings) < n_cols * n_rows:
+            return
+        del self._children[parent]
+        _, _, pw, ph = self._tile_rect(*parent)
+        merged = np.zeros((ph, pw, 3), dtype=np.uint8)
+        offset = self.tile_size // 2
+        for (dx, dy), half in siblings.items():
+            hh, hw = half.shape[:2]
+            y0, x0 = dy * offset, dx * offset
+            merged[y0 : y0 + hh, x0 : x0 + hw] = half
+        self._write_tile(*parent, merged)
+
+    def close(self):
+        """Write the .dzi descriptor, returns all written files"""
+        missing = sorted(set(range(len(self.corners))) - self._added)
+        if missing:
+            raise StitchingError(f"Images {missing} were not added to the mosaic")
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+                f'Format="{self.tile_format}" Overlap="0" '
+                f'TileSize="{self.tile_size}">\n'
+                f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                "</Image>\n"
+            )
+        self.files.append(self.path)
+        return self.files
+
+    def read_level(self, level):
+        """Assemble a (small) pyramid level from the written tiles"""
+        width, height = self.level_size(level)
+        cols, rows = self.grid_size(level)
+        img = np.zeros((height, width, 3), dtype=np.uint8)
+        level_dir = os.path.join(self.files_dir, str(level))
+        for row in range(rows):
+            for col in range(cols):
+                x, y, w, h = self._tile_rect(level, col, row)
+                tile = cv.imread(
+                    os.path.join(level_dir, f"{col}_{row}.{self.tile_format}")
+                )
+                img[y : y + h, x : x + w] = tile[:h, :w]
+        return img
+
+    def preview(self, max_size=2048):
+        """The largest pyramid level that fits into max_size x max_size"""
+        level = self.max_level
+        while level > 0 and max(self.level_size(level)) > max_size:
+            level -= 1
+        return self.read_level(level)
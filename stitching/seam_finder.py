@@ -27,12 +27,15 @@ class SeamFinder:
 
     DEFAULT_SEAM_FINDER = list(SEAM_FINDER_CHOICES.keys())[0]
 
-    def __init__(self, finder=DEFAULT_SEAM_FINDER):
+    def __init__(self, finder=DEFAULT_SEAM_FINDER, low_memory=False):
         self.finder = SeamFinder.SEAM_FINDER_CHOICES[finder]
+        # only the graph cut finders need float images
+        self.float_images = not low_memory or finder.startswith("gc")
 
     def find(self, imgs, corners, masks):
-        imgs_float = [img.astype(np.float32) for img in imgs]
-        return self.finder.find(imgs_float, corners, masks)
+        if self.float_images:
+            imgs = [img.astype(np.float32) for img in imgs]
+        return self.finder.find(imgs, corners, masks)
 
     @staticmethod
     def resize(seam_mask, mask):
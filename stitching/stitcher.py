@@ -2,6 +2,7 @@ import warnings
 from types import SimpleNamespace
 
 from .blender import Blender
+from .calibration import StitchCalibration
 from .camera_adjuster import CameraAdjuster
 from .camera_estimator import CameraEstimator
 from .camera_wave_corrector import WaveCorrector
@@ -13,6 +14,7 @@ from .images import Images
 from .seam_finder import SeamFinder
 from .stitching_error import StitchingError, StitchingWarning
 from .subsetter import Subsetter
+from .tile_layout import TileLayout
 from .timelapser import Timelapser
 from .verbose import verbose_stitching
 from .warper import Warper
@@ -23,6 +25,9 @@ class Stitcher:
         "medium_megapix": Images.Resolution.MEDIUM.value,
         "detector": FeatureDetector.DEFAULT_DETECTOR,
         "nfeatures": 500,
+        "detector_workers": FeatureDetector.DEFAULT_WORKERS,
+        "feature_grid": FeatureDetector.DEFAULT_GRID,
+        "feature_cache": FeatureDetector.DEFAULT_CACHE,
         "matcher_type": FeatureMatcher.DEFAULT_MATCHER,
         "range_width": FeatureMatcher.DEFAULT_RANGE_WIDTH,
         "try_use_gpu": False,
@@ -43,6 +48,8 @@ class Stitcher:
         "final_megapix": Images.Resolution.FINAL.value,
         "blender_type": Blender.DEFAULT_BLENDER,
         "blend_strength": Blender.DEFAULT_BLEND_STRENGTH,
+        "low_memory": False,
+        "blend_workers": Blender.DEFAULT_WORKERS,
         "timelapse": Timelapser.DEFAULT_TIMELAPSE,
         "timelapse_prefix": Timelapser.DEFAULT_TIMELAPSE_PREFIX,
     }
@@ -60,10 +67,17 @@ class Stitcher:
         self.medium_megapix = args.medium_megapix
         self.low_megapix = args.low_megapix
         self.final_megapix = args.final_megapix
+        detector_kwargs = {
+            "workers": args.detector_workers,
+            "grid": args.feature_grid,
+            "cache": args.feature_cache,
+        }
         if args.detector in ("orb", "sift"):
-            self.detector = FeatureDetector(args.detector, nfeatures=args.nfeatures)
+            self.detector = FeatureDetector(
+                args.detector, nfeatures=args.nfeatures, **detector_kwargs
+            )
         else:
-            self.detector = FeatureDetector(args.detector)
+            self.detector = FeatureDetector(args.detector, **detector_kwargs)
         match_conf = FeatureMatcher.get_match_conf(args.match_conf, args.detector)
         self.matcher = FeatureMatcher(
             args.matcher_type,
@@ -84,26 +98,35 @@ class Stitcher:
         self.compensator = ExposureErrorCompensator(
             args.compensator, args.nr_feeds, args.block_size
         )
-        self.seam_finder = SeamFinder(args.finder)
-        self.blender = Blender(args.blender_type, args.blend_strength)
+        self.seam_finder = SeamFinder(args.finder, args.low_memory)
+        strip_height = Blender.LOW_MEMORY_STRIP_HEIGHT if args.low_memory else None
+        self.blender = Blender(
+            args.blender_type, args.blend_strength, strip_height, args.blend_workers
+        )
         self.timelapser = Timelapser(args.timelapse, args.timelapse_prefix)
+        self.cameras = None
 
     def stitch_verbose(self, images, feature_masks=[], verbose_dir=None):
         return verbose_stitching(self, images, feature_masks, verbose_dir)
 
-    def stitch(self, images, feature_masks=[]):
+    def stitch(self, images, feature_masks=[], positions=None, adjacency=None):
+        """positions: approximate (x, y) pixel position of each image's top left
+        corner, adjacency: (N, N) matrix or list of image index pairs.
+        If given, only overlapping / adjacent images are matched."""
         self.images = Images.of(
             images, self.medium_megapix, self.low_megapix, self.final_megapix
         )
 
         imgs = self.resize_medium_resolution()
         features = self.find_features(imgs, feature_masks)
-        matches = self.match_features(features)
+        matches_mask = self.get_matches_mask(positions, adjacency)
+        matches = self.match_features(features, matches_mask)
         imgs, features, matches = self.subset(imgs, features, matches)
         cameras = self.estimate_camera_parameters(features, matches)
         cameras = self.refine_camera_parameters(features, matches, cameras)
         cameras = self.perform_wave_correction(cameras)
         self.estimate_scale(cameras)
+        self.cameras = cameras
 
         imgs = self.resize_low_resolution(imgs)
         imgs, masks, corners, sizes = self.warp_low_resolution(imgs, cameras)
@@ -113,6 +136,7 @@ class Stitcher:
         )
         self.estimate_exposure_errors(corners, imgs, masks)
         seam_masks = self.find_seam_masks(imgs, corners, masks)
+        self.seam_masks = seam_masks
 
         imgs = self.resize_final_resolution()
         imgs, masks, corners, sizes = self.warp_final_resolution(imgs, cameras)
@@ -127,6 +151,57 @@ class Stitcher:
         self.blend_images(imgs, seam_masks, corners)
         return self.create_final_panorama()
 
+    def save_calibration(self, path):
+        """Save the registration of the last stitch() call to the directory
+        path, see StitchCalibration"""
+        if self.cameras is None:
+            raise StitchingError("No registration estimated, run stitch() first")
+        calibration = StitchCalibration.from_stitcher(self, path)
+        calibration.save()
+        return calibration
+
+    def stitch_calibrated(
+        self, images, calibration, feature_masks=[], positions=None, adjacency=None
+    ):
+        """Stitch images with the same geometry as a saved calibration (a
+        directory or StitchCalibration), only exposure compensation and blending
+        are computed. Falls back to stitch() if the images do not fit the
+        calibration."""
+        self.cameras = None
+        self.images = Images.of(
+            images, self.medium_megapix, self.low_megapix, self.final_megapix
+        )
+        try:
+            if not isinstance(calibration, StitchCalibration):
+                calibration = StitchCalibration.load(calibration)
+            calibration.check_settings(self)
+            imgs = self.resize_low_resolution()
+            self.images.subset(calibration.indices)
+            imgs = Subsetter.subset_list(imgs, calibration.indices)
+            calibration.check_sizes(self.images.sizes)
+            imgs = list(calibration.remap_images(imgs, "low"))
+            calibration.verify(imgs)
+        except StitchingError as e:
+            warnings.warn(
+                f"Calibration not used, estimating the registration: {e}",
+                StitchingWarning,
+            )
+            return self.stitch(images, feature_masks, positions, adjacency)
+
+        self.estimate_exposure_errors(
+            calibration.corners("low"), imgs, list(calibration.masks("low"))
+        )
+        imgs = self.resize_final_resolution()
+        imgs = calibration.remap_images(imgs, "final")
+        corners, sizes = calibration.corners("final"), calibration.sizes("final")
+        self.set_masks(calibration.masks("final"))
+        imgs = self.compensate_exposure_errors(corners, imgs)
+        seam_masks = self.resize_seam_masks(calibration.seam_masks())
+
+        self.initialize_composition(corners, sizes)
+        self.blend_images(imgs, seam_masks, corners)
+        return self.create_final_panorama()
+
     def resize_medium_resolution(self):
         return list(self.images.resize(Images.Resolution.MEDIUM))
 
@@ -141,11 +216,21 @@ class Stitcher:
             feature_masks = [Images.to_binary(mask) for mask in feature_masks]
             return self.detector.detect_with_masks(imgs, feature_masks)
 
-    def match_features(self, features):
-        return self.matcher.match_features(features)
+    def get_matches_mask(self, positions=None, adjacency=None):
+        if positions is not None:
+            adjacency = TileLayout(positions, self.images.sizes).adjacency()
+        if adjacency is None:
+            return None
+        return TileLayout.matches_mask(adjacency, len(self.images.names))
+
+    def match_features(self, features, matches_mask=None):
+        if matches_mask is None:
+            return self.matcher.match_features(features)
+        return self.matcher.match_features(features, matches_mask)
 
     def subset(self, imgs, features, matches):
         indices = self.subsetter.subset(self.images.names, features, matches)
+        self.n_images, self.indices = len(self.images.names), indices
         imgs = Subsetter.subset_list(imgs, indices)
         features = Subsetter.subset_list(features, indices)
         matches = Subsetter.subset_matches(matches, indices)
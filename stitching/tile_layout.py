@@ -0,0 +1,94 @@
+import numpy as np
+
+from .stitching_error import StitchingError
+
+
+class TileLayout:
+    """Approximate tile placement on a planar canvas, e.g. from stage positions.
+
+    positions are the (x, y) pixel coordinates of the top left corner of each tile,
+    sizes are (width, height). Two tiles are neighbours if their overlap covers at
+    least min_overlap of the smaller tile.
+    """
+
+    DEFAULT_MIN_OVERLAP = 0.05
+
+    def __init__(self, positions, sizes, min_overlap=DEFAULT_MIN_OVERLAP):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+        if len(self.positions) != len(self.sizes):
+            raise StitchingError(
+                f"{len(self.positions)} positions given for {len(self.sizes)} tiles"
+            )
+        self.min_overlap = min_overlap
+
+    def __len__(self):
+        return len(self.positions)
+
+    def overlap(self, i, j):
+        """Overlap rectangle x0, y0, x1, y1 of tiles i and j in canvas coordinates"""
+        lo = np.maximum(self.positions[i], self.positions[j])
+        hi = np.minimum(
+            self.positions[i] + self.sizes[i], self.positions[j] + self.sizes[j]
+        )
+        return (*lo, *hi)
+
+    def pairs(self):
+        """Neighbour pairs (i, j) with i < j"""
+        lo = self.positions
+        hi = self.positions + self.sizes
+        areas = self.sizes[:, 0] * self.sizes[:, 1]
+        # tiles are bucketed by the cell of their top left corner, overlapping
+        # tiles are always in the same or in adjacent cells
+        cell = np.maximum(self.sizes.max(axis=0), 1)
+        keys = [tuple(key) for key in np.floor(lo / cell).astype(int).tolist()]
+        buckets = {}
+        for idx, key in enumerate(keys):
+            buckets.setdefault(key, []).append(idx)
+
+        pairs = []
+        for i, (kx, ky) in enumerate(keys):
+            candidates = [
+                j
+                for dx in (-1, 0, 1)
+                for dy in (-1, 0, 1)
+                for j in buckets.get((kx + dx, ky + dy), ())
+                if j > i
+            ]
+            if not candidates:
+                continue
+            c = np.array(candidates)
+            width = np.minimum(hi[i, 0], hi[c, 0]) - np.maximum(lo[i, 0], lo[c, 0])
+            height = np.minimum(hi[i, 1], hi[c, 1]) - np.maximum(lo[i, 1], lo[c, 1])
+            smaller = np.minimum(areas[i], areas[c])
+            adjacent = (width > 0) & (height > 0)
+            adjacent &= width * height >= self.min_overlap * smaller
+            pairs.extend((i, j) for j in c[adjacent].tolist())
+        return sorted(pairs)
+
+    def neighbours(self):
+        """Sorted neighbour indices of each tile"""
+        neighbours = [[] for _ in range(len(self))]
+        for i, j in self.pairs():
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+        return [sorted(n) for n in neighbours]
+
+    def adjacency(self):
+        """Boolean (N, N) neighbour matrix, without self links"""
+        return self.matches_mask(self.pairs(), len(self)).astype(bool)
+
+    @staticmethod
+    def matches_mask(adjacency, n):
+        """Symmetric uint8 (N, N) mask for cv.detail.FeaturesMatcher.apply2,
+        from a boolean adjacency matrix or a list of neighbour pairs"""
+        adjacency = np.asarray(adjacency)
+        mask = np.zeros((n, n), dtype=np.uint8)
+        if adjacency.shape == (n, n):
+            mask[adjacency != 0] = 1
+        else:
+            for i, j in adjacency.reshape(-1, 2):
+                mask[i, j] = 1
+        mask |= mask.T
+        np.fill_diagonal(mask, 0)
+        return mask
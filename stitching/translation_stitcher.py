@@ -0,0 +1,307 @@
+from types import SimpleNamespace
+
+import cv2 as cv
+import numpy as np
+
+from .blender import Blender
+from .images import Images
+from .mosaic_writer import MosaicWriter
+from .stitching_error import StitchingError
+from .tile_layout import TileLayout
+
+
+class TranslationStitcher:
+    """Stitcher for tiles that differ by a pure XY translation, e.g. microscope
+    stage scans with known approximate tile positions.
+
+    Offsets are estimated only between neighbouring tiles by phase correlation
+    on the downscaled overlap predicted by the positions
+    (https://docs.opencv.org/4.x/d7/df3/group__imgproc__motion.html).
+    A weighted least squares fit of all offsets places the tiles, which are
+    blended on a planar canvas without warping.
+
+    The positions are only trusted as a guide. If fewer than min_registered
+    of the neighbour pairs register, or the registered offsets contradict the
+    scale or direction of the positions (e.g. a mirrored stage axis), a
+    StitchingError is raised instead of returning a mosaic placed from the
+    positions alone.
+    """
+
+    DEFAULT_REGISTRATION_SCALE = 0.25
+    DEFAULT_MAX_SHIFT = 0.3
+    DEFAULT_MIN_RESPONSE = 0.05
+    DEFAULT_MAX_RESIDUAL = 4.0
+    DEFAULT_PRIOR_WEIGHT = 0.01
+    DEFAULT_MIN_REGISTERED = 0.5
+    DEFAULT_MAX_SCALE_ERROR = 0.2
+
+    DEFAULT_SETTINGS = {
+        "registration_scale": DEFAULT_REGISTRATION_SCALE,
+        "min_overlap": TileLayout.DEFAULT_MIN_OVERLAP,
+        "max_shift": DEFAULT_MAX_SHIFT,
+        "min_response": DEFAULT_MIN_RESPONSE,
+        "max_residual": DEFAULT_MAX_RESIDUAL,
+        "prior_weight": DEFAULT_PRIOR_WEIGHT,
+        "min_registered": DEFAULT_MIN_REGISTERED,
+        "max_scale_error": DEFAULT_MAX_SCALE_ERROR,
+        "blender_type": Blender.DEFAULT_BLENDER,
+        "blend_strength": Blender.DEFAULT_BLEND_STRENGTH,
+    }
+
+    def __init__(self, **kwargs):
+        self.initialize_stitcher(**kwargs)
+
+    def initialize_stitcher(self, **kwargs):
+        self.settings = self.DEFAULT_SETTINGS.copy()
+        self.validate_kwargs(kwargs)
+        self.kwargs = kwargs
+        self.settings.update(kwargs)
+
+        args = SimpleNamespace(**self.settings)
+        self.registration_scale = args.registration_scale
+        self.min_overlap = args.min_overlap
+        self.max_shift = args.max_shift
+        self.min_response = args.min_response
+        self.max_residual = args.max_residual
+        self.prior_weight = args.prior_weight
+        self.min_registered = args.min_registered
+        self.max_scale_error = args.max_scale_error
+        self.blender = Blender(args.blender_type, args.blend_strength)
+
+    def stitch(self, images, positions):
+        """positions: approximate (x, y) pixel position of each tile's top left
+        corner"""
+        imgs = self.load_images(images)
+        sizes = [Images.get_image_size(img) for img in imgs]
+        small = [self._registration_image(img) for img in imgs]
+        corners = self.estimate_corners(small, sizes, positions)
+        return self.compose(imgs, corners, sizes)
+
+    def write_mosaic(self, images, positions, path, **kwargs):
+        """Like stitch, but the result is streamed to a DeepZoom pyramid at path.
+        Only one full resolution image is held at a time if images are filenames."""
+        small, sizes = [], []
+        for img in self.iter_images(images):
+            sizes.append(Images.get_image_size(img))
+            small.append(self._registration_image(img))
+        corners = self.estimate_corners(small, sizes, positions)
+        writer = MosaicWriter(path, corners, sizes, **kwargs)
+        # widen the seams by half the blend width, the writer feathers across them
+        kernel = cv.getStructuringElement(cv.MORPH_RECT, (writer.blend_width + 1,) * 2)
+        masks = self.seam_masks(corners, sizes)
+        for idx, (img, mask) in enumerate(zip(self.iter_images(images), masks)):
+            writer.add(idx, img, cv.dilate(mask, kernel))
+        writer.close()
+        return writer
+
+    def estimate_corners(self, small, sizes, positions):
+        self.layout = TileLayout(positions, sizes, self.min_overlap)
+        offsets = self.register(small, self.layout)
+        self.corners = self.place(self.layout, offsets)
+        self.check_registration(self.layout, self.offsets)
+        self.sizes = sizes
+        return self.corners
+
+    @staticmethod
+    def load_images(images):
+        return list(TranslationStitcher.iter_images(images))
+
+    @staticmethod
+    def iter_images(images):
+        if not isinstance(images, list) or len(images) < 2:
+            raise StitchingError("2 or more Images needed")
+        for img in images:
+            if isinstance(img, str):
+                img = Images.read_image(img)
+            if img.ndim == 2:
+                img = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
+            yield img
+
+    def register(self, small, layout):
+        """Measured offsets {(i, j): (dx, dy, weight)} of all neighbour pairs,
+        small are the images prepared for registration"""
+        pairs = layout.pairs()
+        if not pairs:
+            raise StitchingError("No overlapping tiles, check the tile positions")
+        offsets = {}
+        for i, j in pairs:
+            measured = self.estimate_offset(small, layout, i, j)
+            if measured is not None:
+                offsets[(i, j)] = measured
+        return offsets
+
+    def _registration_image(self, img):
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+        if self.registration_scale != 1:
+            gray = cv.resize(
+                gray,
+                None,
+                fx=self.registration_scale,
+                fy=self.registration_scale,
+                interpolation=cv.INTER_AREA,
+            )
+        return gray.astype(np.float32)
+
+    def estimate_offset(self, small, layout, i, j):
+        """Offset of tile j relative to tile i in full resolution pixels,
+        None if the overlap does not register reliably"""
+        prior = layout.positions[j] - layout.positions[i]
+        measured = self._correlate(small, layout, i, j, prior)
+        if measured is None:
+            return None
+        # phase correlation underestimates shifts that are large compared to
+        # the patch, correlate once more on the overlap the first estimate
+        # predicts
+        if np.hypot(*(np.array(measured[:2]) - prior)) * self.registration_scale > 1:
+            refined = self._correlate(small, layout, i, j, np.array(measured[:2]))
+            if refined is not None:
+                return refined
+        return measured
+
+    def _correlate(self, small, layout, i, j, offset):
+        """Offset of tile j relative to tile i, measured on the overlap that the
+        approximate offset predicts"""
+        scale = self.registration_scale
+        size_i, size_j = layout.sizes[i], layout.sizes[j]
+        # overlap in the coordinates of tile i
+        lo = np.maximum(0, offset)
+        hi = np.minimum(size_i, offset + size_j)
+        origin_i = np.round(lo * scale).astype(int)
+        origin_j = np.round((lo - offset) * scale).astype(int)
+        width, height = ((hi - lo) * scale).astype(int)
+        for origin, k in ((origin_i, i), (origin_j, j)):
+            h, w = small[k].shape
+            width = min(width, w - origin[0])
+            height = min(height, h - origin[1])
+        width, height = self._dft_size(width), self._dft_size(height)
+        if width < 8 or height < 8 or (origin_i < 0).any() or (origin_j < 0).any():
+            return None
+
+        patches = [
+            small[k][top : top + height, left : left + width]
+            for (left, top), k in ((origin_i, i), (origin_j, j))
+        ]
+        window = cv.createHanningWindow((width, height), cv.CV_32F)
+        (sx, sy), response = cv.phaseCorrelate(patches[0], patches[1], window)
+        if (
+            response < self.min_response
+            or abs(sx) > self.max_shift * width
+            or abs(sy) > self.max_shift * height
+        ):
+            return None
+
+        # the patches assume tile j at origin_i - origin_j, its content moved
+        # by (sx, sy), so tile j sits that much closer to tile i
+        dx, dy = (origin_i - origin_j - (sx, sy)) / scale
+        return dx, dy, response
+
+    @staticmethod
+    def _dft_size(n):
+        """Largest even n that needs no DFT padding, phaseCorrelate is biased by
+        half a pixel if the (padded) patch size is odd"""
+        while n > 0 and (n % 2 or cv.getOptimalDFTSize(n) != n):
+            n -= 1
+        return n
+
+    def place(self, layout, offsets):
+        """Weighted least squares tile placement, offsets disagreeing with the
+        solution by more than max_residual pixels are dropped one at a time"""
+        offsets = dict(offsets)
+        while True:
+            positions = self._solve(layout, offsets)
+            if not offsets:
+                break
+            residuals = {
+                pair: np.hypot(
+                    *(positions[pair[1]] - positions[pair[0]] - np.array(d[:2]))
+                )
+                for pair, d in offsets.items()
+            }
+            worst = max(residuals, key=residuals.get)
+            if residuals[worst] <= self.max_residual:
+                break
+            del offsets[worst]
+        self.offsets = offsets
+        corners = np.round(positions - positions.min(axis=0)).astype(int)
+        return [tuple(corner) for corner in corners.tolist()]
+
+    def check_registration(self, layout, offsets):
+        """Raise a StitchingError if too few neighbour pairs registered or the
+        kept offsets disagree with the scale or sign of the positions"""
+        n_pairs = len(layout.pairs())
+        if not offsets or len(offsets) < self.min_registered * n_pairs:
+            raise StitchingError(
+                f"Only {len(offsets)} of {n_pairs} neighbouring tiles registered, "
+                "check the tile positions and the stage axis directions"
+            )
+        prior = np.array(
+            [layout.positions[j] - layout.positions[i] for i, j in offsets]
+        )
+        measured = np.array([d[:2] for d in offsets.values()])
+        sizes = np.asarray(layout.sizes, dtype=np.float64)
+        for axis, name in enumerate("xy"):
+            # only pairs that are clearly apart along this axis tell its scale
+            apart = np.abs(prior[:, axis]) > 0.25 * sizes[:, axis].min()
+            if not apart.any():
+                continue
+            p, m = prior[apart, axis], measured[apart, axis]
+            scale = float(np.dot(p, m) / np.dot(p, p))
+            if abs(scale - 1) > self.max_scale_error:
+                raise StitchingError(
+                    f"Registered offsets contradict the tile positions along "
+                    f"{name} (scale {scale:.2f}), check the pixel size and the "
+                    "stage axis directions"
+                )
+
+    def _solve(self, layout, offsets):
+        n = len(layout)
+        rows = len(offsets) + n
+        A = np.zeros((rows, n))
+        b = np.zeros((rows, 2))
+        for row, ((i, j), (dx, dy, weight)) in enumerate(offsets.items()):
+            A[row, i], A[row, j] = -weight, weight
+            b[row] = dx * weight, dy * weight
+        # weak pull towards the given positions keeps the system determined,
+        # also for tiles without any registered neighbour
+        prior_rows = np.arange(len(offsets), rows)
+        A[prior_rows, np.arange(n)] = self.prior_weight
+        b[prior_rows] = layout.positions * self.prior_weight
+        positions, *_ = np.linalg.lstsq(A, b, rcond=None)
+        return positions
+
+    def compose(self, imgs, corners, sizes):
+        masks = self.seam_masks(corners, sizes)
+        self.blender.prepare(corners, sizes)
+        for img, mask, corner in zip(imgs, masks, corners):
+            self.blender.feed(img, mask, corner)
+        panorama, _ = self.blender.blend()
+        return panorama
+
+    def seam_masks(self, corners, sizes):
+        """Each canvas pixel belongs to the tile with the nearest center,
+        computed at registration scale and resized to full resolution"""
+        corners = np.asarray(corners, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.float64)
+        centers = corners + sizes / 2
+        neighbours = TileLayout(corners, sizes, 0).neighbours()
+        scale = self.registration_scale
+        for k, ((x, y), (w, h)) in enumerate(zip(corners, sizes)):
+            small_w, small_h = max(1, int(w * scale)), max(1, int(h * scale))
+            xs = x + (np.arange(small_w) + 0.5) * w / small_w
+            ys = y + (np.arange(small_h) + 0.5) * h / small_h
+            mask = np.ones((small_h, small_w), dtype=bool)
+            for j in neighbours[k]:
+                # half plane closer to center k than to center j
+                mid = (centers[k] + centers[j]) / 2
+                direction = centers[j] - centers[k]
+                mask &= (
+                    (xs[None, :] - mid[0]) * direction[0]
+                    + (ys[:, None] - mid[1]) * direction[1]
+                ) <= 0
+            mask = mask.astype(np.uint8) * 255
+            yield cv.resize(mask, (int(w), int(h)), interpolation=cv.INTER_NEAREST)
+
+    def validate_kwargs(self, kwargs):
+        for arg in kwargs:
+            if arg not in self.DEFAULT_SETTINGS:
+                raise StitchingError("Invalid Argument: " + arg)
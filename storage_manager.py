@@ -0,0 +1,407 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class StorageManager:
+    """
+    SAVE_DIR 存储配额管理
+
+    - 文件大小通过 register()/remove() 增量记账，索引持久化到 .storage_index.json，
+      启动时只读取索引，仅在索引不存在时做一次全目录扫描
+    - 占用超过配额时按LRU（最近访问）或按创建时间淘汰未固定(pin)的文件
+    - 只管理程序写入的文件：Flask静态资源目录（css、js、images）不登记、不淘汰
+    - 子目录（Zarr体数据、扫描目录、RAW子目录等）作为目录单元整体记账、整体淘汰和固定，
+      不会只删掉其中的部分文件；目录内文件的登记/访问/固定/删除都作用于整个目录
+    - 提供录像前和录像中的剩余空间检查，避免SD卡写满导致文件损坏
+    """
+
+    EVICTION_POLICIES = ('lru', 'age')
+    INDEX_NAME = '.storage_index.json'
+    EXCLUDED_DIRS = ('css', 'js', 'images')  # SAVE_DIR同时是Flask static目录，前端资源不能被淘汰
+    UNIT_CONTAINERS = ('scans',)  # 这些目录下的每个子目录各为一个单元，其他顶层目录本身为一个单元
+
+    def __init__(self, root, quota_bytes=8 * 1024**3, reserve_bytes=500 * 1024**2, policy='lru', on_evict=None):
+        """
+        参数:
+            root: 受管理的目录（SAVE_DIR）
+            quota_bytes: 目录允许占用的最大字节数
+            reserve_bytes: 磁盘上必须保留的空闲字节数（系统、日志等）
+            policy: 'lru' 按最近访问时间淘汰，'age' 按创建时间淘汰
+            on_evict: 文件被淘汰后的回调 on_evict(filename)，用于清理缩略图等派生数据
+        """
+        if policy not in self.EVICTION_POLICIES:
+            raise ValueError(f"未知的淘汰策略: {policy}")
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.reserve_bytes = reserve_bytes
+        self.policy = policy
+        self.on_evict = on_evict
+        self.index_path = os.path.join(root, self.INDEX_NAME)
+
+        self._lock = threading.RLock()
+        self._files = {}  # 相对路径 -> {'size', 'created', 'accessed', 'pinned'}
+        self._used_bytes = 0
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._files = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._files = self._scan()
+            self._save_index()
+        # 旧版本的索引可能包含前端资源
+        excluded = [name for name in self._files if self._is_excluded(name)]
+        for name in excluded:
+            del self._files[name]
+        # 旧版本的索引逐个登记了子目录中的文件，合并为目录单元
+        members = [name for name in self._files if self._unit(name) != name]
+        for name in members:
+            member = self._files.pop(name)
+            unit = self._files.setdefault(self._unit(name), dict(member, size=0, dir=True))
+            unit['size'] += member['size']
+            unit['created'] = min(unit['created'], member['created'])
+            unit['accessed'] = max(unit['accessed'], member['accessed'])
+            unit['pinned'] = unit['pinned'] or member['pinned']
+        if excluded or members:
+            self._save_index()
+        self._used_bytes = sum(info['size'] for info in self._files.values())
+
+    def _scan(self):
+        """索引缺失时的一次性全目录扫描，跳过以.开头的内部文件和目录（缩略图缓存、索引本身）"""
+        files = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            top = dirpath == self.root
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and not (top and d in self.EXCLUDED_DIRS)]
+            rel_dir = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            if top or (rel_dir in self.UNIT_CONTAINERS):
+                # 顶层目录（容器目录为其子目录）作为单元整体登记，不再逐个文件遍历
+                for d in list(dirnames):
+                    rel = d if top else f'{rel_dir}/{d}'
+                    if rel in self.UNIT_CONTAINERS:
+                        continue
+                    mtime = os.stat(os.path.join(dirpath, d)).st_mtime
+                    files[rel] = {'size': self._dir_size(os.path.join(dirpath, d)), 'created': mtime,
+                                  'accessed': mtime, 'pinned': False, 'dir': True}
+                    dirnames.remove(d)
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                rel = os.path.relpath(path, self.root).replace(os.sep, '/')
+                files[rel] = {'size': stat.st_size, 'created': stat.st_mtime, 'accessed': stat.st_mtime, 'pinned': False}
+        print(f"存储索引重建完成: {len(files)} 个文件")
+        return files
+
+    @staticmethod
+    def _dir_size(path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, name))
+                except OSError:
+                    pass
+        return total
+
+    def _unit(self, filename):
+        """
+        filename 所属的目录单元：子目录中的文件属于其顶层目录（UNIT_CONTAINERS 中为下一级目录），
+        SAVE_DIR 下的文件本身即为单元
+        """
+        parts = filename.strip('/').split('/')
+        depth = 2 if parts[0] in self.UNIT_CONTAINERS else 1
+        if len(parts) <= depth:
+            return filename
+        return '/'.join(parts[:depth])
+
+    def _is_excluded(self, filename):
+        return filename.split('/', 1)[0] in self.EXCLUDED_DIRS and '/' in filename
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._files, f)
+        os.replace(tmp_path, self.index_path)
+
+    def register(self, filename):
+        """
+        新文件写入（或文件增长）后登记其大小，并按需淘汰旧文件；
+        子目录中的新文件累加到所属目录单元（目录内容整体变化后用 register_dir 重新统计）
+        """
+        if self._is_excluded(filename):
+            return
+        unit = self._unit(filename)
+        try:
+            size = os.path.getsize(os.path.join(self.root, filename))
+        except OSError:
+            return
+        now = time.time()
+        with self._lock:
+            info = self._files.get(unit)
+            if unit != filename:
+                if info is None:
+                    # 目录单元首次出现时完整统计一次，之后新写入的文件直接累加
+                    self.register_dir(unit)
+                    return
+                self._used_bytes += size
+                info['size'] += size
+                info['accessed'] = now
+                self.enforce_quota()
+                self._save_index()
+                return
+            if info is None:
+                info = {'size': 0, 'created': now, 'accessed': now, 'pinned': False}
+                self._files[filename] = info
+            self._used_bytes += size - info['size']
+            info['size'] = size
+            info['accessed'] = now
+            self.enforce_quota()
+            self._save_index()
+
+    def register_dir(self, dirname, cover=None):
+        """
+        把目录作为一个单元登记（或在目录内容变化后重新计算大小）。
+        目录内此前单独登记的文件并入该单元；cover 为在图库中代表该目录的图片（相对SAVE_DIR的路径）
+        """
+        dirname = dirname.rstrip('/')
+        if self._is_excluded(dirname + '/'):
+            return
+        size = self._dir_size(os.path.join(self.root, dirname))
+        now = time.time()
+        with self._lock:
+            info = self._files.get(dirname)
+            if info is None or not info.get('dir'):
+                if info is not None:
+                    self._used_bytes -= info['size']
+                info = {'size': 0, 'created': now, 'accessed': now, 'pinned': False, 'dir': True}
+                self._files[dirname] = info
+            prefix = dirname + '/'
+            for name in [name for name in self._files if name.startswith(prefix)]:
+                member = self._files.pop(name)
+                self._used_bytes -= member['size']
+                info['pinned'] = info['pinned'] or member['pinned']
+            if cover is not None:
+                info['cover'] = cover
+            self._used_bytes += size - info['size']
+            info['size'] = size
+            info['accessed'] = now
+            self.enforce_quota()
+            self._save_index()
+
+    def register_many(self, filenames):
+        """批量登记（如拼接金字塔的大量小文件），只在最后写一次索引"""
+        now = time.time()
+        with self._lock:
+            units = set()
+            for filename in filenames:
+                if self._is_excluded(filename):
+                    continue
+                unit = self._unit(filename)
+                if unit != filename:
+                    units.add(unit)
+                    continue
+                try:
+                    size = os.path.getsize(os.path.join(self.root, filename))
+                except OSError:
+                    continue
+                info = self._files.setdefault(filename, {'size': 0, 'created': now, 'accessed': now, 'pinned': False})
+                self._used_bytes += size - info['size']
+                info['size'] = size
+                info['accessed'] = now
+            for unit in units:
+                self.register_dir(unit)
+            self.enforce_quota()
+            self._save_index()
+
+    def touch(self, filename):
+        """记录一次访问，用于LRU淘汰（只更新内存，下次写索引时一并持久化）"""
+        with self._lock:
+            info = self._files.get(self._unit(filename))
+            if info is not None:
+                info['accessed'] = time.time()
+
+    def pin(self, filename, pinned=True):
+        """固定的文件（或目录单元内的文件所在的整个单元）永远不会被自动淘汰"""
+        with self._lock:
+            info = self._files.get(self._unit(filename))
+            if info is None:
+                return False
+            info['pinned'] = bool(pinned)
+            self._save_index()
+            return True
+
+    def is_pinned(self, filename):
+        with self._lock:
+            info = self._files.get(self._unit(filename))
+            return info is not None and info['pinned']
+
+    def remove(self, filename):
+        """删除文件并更新记账；目录单元内的文件（如扫描的预览图）删除整个单元"""
+        with self._lock:
+            filename = self._unit(filename)
+            info = self._files.pop(filename, None)
+            if info is not None:
+                self._used_bytes -= info['size']
+            self._delete(filename, info)
+            self._save_index()
+        self._notify_evicted(filename, info)
+
+    def _delete(self, name, info):
+        path = os.path.join(self.root, name)
+        try:
+            if (info is not None and info.get('dir')) or os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+    def _notify_evicted(self, name, info):
+        if self.on_evict is None:
+            return
+        self.on_evict(name)
+        if info is not None and info.get('cover'):
+            self.on_evict(info['cover'])
+
+    def enforce_quota(self, extra_bytes=0, reserve=True):
+        """
+        淘汰未固定的文件，直到占用+extra_bytes不超过配额且磁盘保留空间充足
+        reserve=False 时只按配额淘汰（如启动时，磁盘空闲量不足不是淘汰采集文件的理由）；
+        磁盘被其他数据占满、淘汰全部可淘汰文件也无法满足保留空间时，不为保留空间淘汰
+        返回被淘汰的文件列表
+        """
+        evicted = []
+        with self._lock:
+            need = self._used_bytes + extra_bytes - self.quota_bytes
+            if reserve:
+                shortfall = self.reserve_bytes - (self.disk_free_bytes() - extra_bytes)
+                if shortfall > self.reclaimable_bytes():
+                    print(f"磁盘空闲空间不足，且无法通过淘汰采集文件恢复（缺少 {shortfall / 1024**2:.0f}MB）")
+                else:
+                    need = max(need, shortfall)
+            if need > 0:
+                sort_key = 'accessed' if self.policy == 'lru' else 'created'
+                candidates = sorted(
+                    (info[sort_key], name) for name, info in self._files.items() if not info['pinned']
+                )
+                freed = 0
+                for _, name in candidates:
+                    if freed >= need:
+                        break
+                    info = self._files.pop(name)
+                    self._used_bytes -= info['size']
+                    freed += info['size']
+                    self._delete(name, info)
+                    evicted.append((name, info))
+                if evicted:
+                    self._save_index()
+        for name, info in evicted:
+            print(f"存储配额淘汰: {name}")
+            self._notify_evicted(name, info)
+        return [name for name, _ in evicted]
+
+    def disk_free_bytes(self):
+        return shutil.disk_usage(self.root).free
+
+    def available_bytes(self, pending_bytes=0):
+        """
+        在不突破配额和磁盘保留空间的前提下还能写入的字节数
+        pending_bytes: 正在写入、尚未register的文件已占用的字节数（只计入配额，磁盘空闲量已包含它）
+        """
+        with self._lock:
+            by_quota = self.quota_bytes - self._used_bytes - pending_bytes
+        by_disk = self.disk_free_bytes() - self.reserve_bytes
+        return max(0, min(by_quota, by_disk))
+
+    def reclaimable_bytes(self):
+        with self._lock:
+            return sum(info['size'] for info in self._files.values() if not info['pinned'])
+
+    def ensure_space(self, needed_bytes):
+        """
+        录像/批量采集前调用：空间不足时先尝试淘汰旧文件
+        返回是否能够提供needed_bytes
+        """
+        if self.available_bytes() >= needed_bytes:
+            return True
+        self.enforce_quota(extra_bytes=needed_bytes)
+        return self.available_bytes() >= needed_bytes
+
+    def list_files(self, suffixes=None):
+        """按创建时间倒序返回索引中的文件，不访问磁盘；目录单元以其 cover 图片（如有）代表"""
+        with self._lock:
+            items = []
+            for name, info in self._files.items():
+                if info.get('dir') and info.get('cover'):
+                    name = info['cover']
+                if suffixes is None or name.lower().endswith(suffixes):
+                    items.append(dict(info, filename=name))
+        items.sort(key=lambda item: item['created'], reverse=True)
+        return items
+
+    def status(self):
+        with self._lock:
+            used = self._used_bytes
+            count = len(self._files)
+            pinned = sum(1 for info in self._files.values() if info['pinned'])
+        return {
+            'used_bytes': used,
+            'quota_bytes': self.quota_bytes,
+            'reserve_bytes': self.reserve_bytes,
+            'disk_free_bytes': self.disk_free_bytes(),
+            'available_bytes': self.available_bytes(),
+            'files': count,
+            'pinned': pinned,
+            'policy': self.policy,
+        }
+
+    def flush(self):
+        with self._lock:
+            self._save_index()
+
+
+class RecordingSpaceMonitor:
+    """
+    录像过程中的剩余空间估计：根据已写入的字节数估算每帧大小，
+    在剩余空间只够 warn_seconds 时提示，只够 stop_seconds 时要求停止录像
+    """
+
+    def __init__(self, storage, framerate, warn_seconds=60, stop_seconds=5):
+        self.storage = storage
+        self.framerate = framerate
+        self.warn_seconds = warn_seconds
+        self.stop_seconds = stop_seconds
+        self.warned = False
+
+    def remaining_seconds(self, file_path, frames_written):
+        """按当前码率估算剩余可录制秒数，尚无数据时返回None"""
+        if frames_written <= 0:
+            return None
+        try:
+            written = os.path.getsize(file_path)
+        except OSError:
+            return None
+        if written <= 0:
+            return None
+        bytes_per_second = written / frames_written * self.framerate
+        return self.storage.available_bytes(pending_bytes=written) / bytes_per_second
+
+    def check(self, file_path, frames_written):
+        """返回 'ok' / 'warn' / 'stop'；'warn' 只返回一次"""
+        remaining = self.remaining_seconds(file_path, frames_written)
+        if remaining is None:
+            return 'ok'
+        if remaining < self.stop_seconds:
+            return 'stop'
+        if remaining < self.warn_seconds and not self.warned:
+            self.warned = True
+            return 'warn'
+        return 'ok'
@@ -0,0 +1,207 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import cv2
+from PIL import Image
+
+
+class ThumbnailCache:
+    """
+    缩略图与预览图金字塔缓存
+
+    - 新拍摄的图片/拼接图由后台线程池生成 thumb 和 preview 两级缩放图
+    - 缩放图保存在磁盘缓存目录中，总容量受限，按LRU淘汰
+    - 被淘汰的条目在下次访问时按需重新生成
+    """
+
+    # 各级缩放图的长边像素，由大到小生成，小图从上一级结果继续缩放
+    LEVELS = OrderedDict([('preview', 1024), ('thumb', 256)])
+    IMAGE_EXTS = ('.jpeg', '.jpg', '.png', '.tif', '.tiff', '.bmp')
+
+    def __init__(self, source_dir, cache_dir=None, max_bytes=200 * 1024 * 1024, workers=2, quality=80):
+        """
+        参数:
+            source_dir: 原图所在目录（即SAVE_DIR）
+            cache_dir: 缓存目录，默认为 source_dir/.thumbs
+            max_bytes: 缓存容量上限（字节）
+            workers: 后台生成线程数，树莓派上建议不超过2
+            quality: 缓存JPEG的编码质量
+        """
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir or os.path.join(source_dir, '.thumbs')
+        self.max_bytes = max_bytes
+        self.quality = quality
+        for level in self.LEVELS:
+            os.makedirs(os.path.join(self.cache_dir, level), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (level, filename) -> 字节数，末尾为最近使用
+        self._total_bytes = 0
+        self._pending = {}  # filename -> Future
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self._load_index()
+
+    def _load_index(self):
+        """从缓存目录恢复LRU索引（缓存目录本身有容量上限，扫描代价很小），以mtime作为最近访问时间"""
+        found = []
+        for level in self.LEVELS:
+            level_dir = os.path.join(self.cache_dir, level)
+            for entry in os.scandir(level_dir):
+                if entry.is_file() and entry.name.endswith('.jpeg'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, level, self._source_name(entry.name), stat.st_size))
+        found.sort()
+        with self._lock:
+            for _, level, filename, size in found:
+                self._entries[(level, filename)] = size
+                self._total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def _cache_name(filename):
+        """原图相对路径 -> 缓存文件名（子目录分隔符做URL转义后展平）"""
+        return quote(filename.replace(os.sep, '/'), safe='') + '.jpeg'
+
+    @staticmethod
+    def _source_name(cache_name):
+        return unquote(cache_name[:-len('.jpeg')])
+
+    def _cache_path(self, level, filename):
+        return os.path.join(self.cache_dir, level, self._cache_name(filename))
+
+    def is_image(self, filename):
+        return filename.lower().endswith(self.IMAGE_EXTS)
+
+    def submit(self, filename):
+        """提交后台生成任务，filename 为相对于 source_dir 的路径"""
+        if not self.is_image(filename):
+            return None
+        with self._lock:
+            future = self._pending.get(filename)
+            if future is None:
+                future = self._executor.submit(self._generate, filename)
+                self._pending[filename] = future
+                future.add_done_callback(lambda _, name=filename: self._clear_pending(name))
+        return future
+
+    def _clear_pending(self, filename):
+        with self._lock:
+            self._pending.pop(filename, None)
+
+    def get(self, filename, level='thumb'):
+        """
+        返回缩放图的缓存路径；条目已被淘汰或尚未生成时同步生成
+        找不到原图时返回None
+        """
+        if level not in self.LEVELS:
+            raise ValueError(f"未知的缩放级别: {level}")
+        key = (level, filename)
+        path = self._cache_path(level, filename)
+        with self._lock:
+            cached = key in self._entries
+            future = self._pending.get(filename)
+            if cached:
+                self._entries.move_to_end(key)
+        if cached and os.path.exists(path):
+            os.utime(path, None)  # 刷新mtime，重启后仍能保持LRU顺序
+            return path
+        if future is not None:
+            future.result()
+        elif not self._generate(filename):
+            return None
+        return path if os.path.exists(path) else None
+
+    def _generate(self, filename):
+        """解码一次原图，逐级生成所有缩放图"""
+        source_path = os.path.join(self.source_dir, filename)
+        if not os.path.exists(source_path):
+            return False
+        try:
+            img = self._read_reduced(source_path, max(self.LEVELS.values()))
+            if img is None:
+                return False
+            for level, long_edge in self.LEVELS.items():
+                img = self._fit(img, long_edge)
+                ok, buffer = cv2.imencode('.jpeg', img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if ok:
+                    self._store(level, filename, buffer.tobytes())
+            return True
+        except Exception as e:
+            print(f"生成缩略图失败 {filename}: {e}")
+            return False
+
+    @staticmethod
+    def _read_reduced(path, long_edge):
+        """
+        利用JPEG的DCT降采样直接按1/2、1/4、1/8解码，
+        12MP照片生成预览图时无需解码全分辨率
+        """
+        try:
+            with Image.open(path) as header:  # 只读取文件头获取尺寸
+                width, height = header.size
+        except Exception:
+            return cv2.imread(path, cv2.IMREAD_COLOR)
+        flags = cv2.IMREAD_COLOR
+        for factor, reduced_flag in ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                                     (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                     (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if max(width, height) // factor >= long_edge:
+                flags = reduced_flag
+                break
+        return cv2.imread(path, flags)
+
+    @staticmethod
+    def _fit(img, long_edge):
+        h, w = img.shape[:2]
+        scale = long_edge / max(h, w)
+        if scale >= 1:
+            return img
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+    def _store(self, level, filename, data):
+        path = self._cache_path(level, filename)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # 原子替换，避免读到写了一半的文件
+        key = (level, filename)
+        with self._lock:
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+        self._evict()
+
+    def _evict(self):
+        """超出容量时淘汰最久未使用的条目"""
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or not self._entries:
+                    return
+                (level, filename), size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+            try:
+                os.remove(self._cache_path(level, filename))
+            except OSError:
+                pass
+
+    def invalidate(self, filename):
+        """原图被删除或覆盖时移除对应的全部缓存条目"""
+        for level in self.LEVELS:
+            with self._lock:
+                size = self._entries.pop((level, filename), None)
+                if size is not None:
+                    self._total_bytes -= size
+            try:
+                os.remove(self._cache_path(level, filename))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._total_bytes, 'max_bytes': self.max_bytes}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -3,22 +3,63 @@ import os
 import numpy as np
 import json
 from focus_stack_low_power import LowPowerFocusStack
-from stitching import Stitcher
+from stitching import Stitcher, TranslationStitcher
+from stitching.exposure_error_compensator import ExposureErrorCompensator
+from stitching.stitching_error import StitchingError
 from pathlib import Path
 
-def stitch_images(images, positions):
+def stitch_images(images, positions, pixels_per_step=None, calibration_dir=None, flat_field=False, translation=True):
     """
     拼接图像函数，支持3x3网格拼接实现400%画幅
     
     参数:
     - images: 要拼接的图像列表
-    - positions: 位置信息列表
+    - positions: 每张图像拍摄前的相对移动 (dx, dy)（电机步数）
+    - pixels_per_step: (x, y) 方向电机一步对应的图像像素数。给出时按纯平移拼接：
+      以平台位置为先验，只在相邻tile的重叠区做相位相关，全局最小二乘定位后平面融合；
+      失败时退回通用拼接（特征匹配+相机估计+投影变换），此时也只匹配相邻tile
+    - calibration_dir: 通用拼接的标定目录。已有标定时直接复用（只做曝光补偿和融合），
+      图像与标定不符时重新估计；每次重新估计后都更新该目录，供下一次相同网格的扫描使用
+    - flat_field: tile已做平场校正时没有渐晕接缝，通用拼接只做整图增益补偿（gain），不再分块补偿
+    - translation: 为False时跳过纯平移拼接（调用方已确认平移配准失败），平台位置只用于限定匹配的相邻tile
     """
-    stitcher = Stitcher()
-    panorama = stitcher.stitch(images)
+    tile_positions = None
+    if pixels_per_step is not None:
+        tile_positions = (np.cumsum(np.asarray(positions, dtype=np.float64), axis=0) * pixels_per_step).tolist()
+    if tile_positions is not None and translation:
+        try:
+            return TranslationStitcher().stitch(images, tile_positions)
+        except StitchingError as e:
+            print(f"平移拼接失败，改用通用拼接: {e}")
+    # 分条融合，融合金字塔只覆盖一个条带，避免大幅拼接时内存不足
+    compensator = 'gain' if flat_field else ExposureErrorCompensator.DEFAULT_COMPENSATOR
+    stitcher = Stitcher(low_memory=True, compensator=compensator)
+    # 已知tile位置时只匹配相邻（有重叠的）tile
+    if calibration_dir is None:
+        return stitcher.stitch(images, positions=tile_positions)
+    panorama = stitcher.stitch_calibrated(images, calibration_dir, positions=tile_positions)
+    if stitcher.cameras is not None:
+        stitcher.save_calibration(calibration_dir)
     return panorama
 
 
+def write_mosaic_pyramid(images, positions, pixels_per_step, dzi_path, **kwargs):
+    """
+    大面积拼接：结果不在内存中合成，而是按块融合后直接写成DeepZoom金字塔（.dzi + 瓦片目录），
+    内存占用只与正在融合的几张tile有关，与拼接总面积无关
+    
+    参数:
+    - images: 图像文件路径列表（也可以是图像数组列表）
+    - positions / pixels_per_step: 同 stitch_images
+    - dzi_path: 输出 .dzi 文件路径
+    - kwargs: 传给 MosaicWriter（tile_size、blend_width、tile_format、quality）
+    返回:
+    - MosaicWriter（.files 为写出的全部文件，.preview() 读取缩略图）
+    """
+    tile_positions = (np.cumsum(np.asarray(positions, dtype=np.float64), axis=0) * pixels_per_step).tolist()
+    return TranslationStitcher().write_mosaic(images, tile_positions, dzi_path, **kwargs)
+
+
 def crop_center_expanding_rect(image, target_ratio=4/3):
     """
     从图像中心最大区域开始，按照4:3比例逐渐缩小矩形，当遇到黑边时停止
@@ -110,9 +151,23 @@ def findHomography(image_1_kp, image_2_kp, matches):
     return homography
 
 
-def focus_stack(images):
+# 景深堆叠质量/速度选择 -> 融合引擎
+FOCUS_STACK_ENGINES = {'fast': 'argmax', 'quality': 'pyramid'}
+
+
+def focus_stack(images, quality='fast'):
+    """
+    景深堆叠
+
+    参数:
+    - images: 已按Z顺序排列的BGR图像列表
+    - quality: 'fast' 逐像素选择最清晰的切片；'quality' 拉普拉斯金字塔多尺度融合，无光晕和接缝但更慢
+    """
+    if quality not in FOCUS_STACK_ENGINES:
+        raise ValueError(f"未知的景深堆叠模式: {quality}")
     stack = LowPowerFocusStack(images)
     stack.set_verbose(False)
+    stack.fusion = FOCUS_STACK_ENGINES[quality]
     success = stack.run()
     if success:
         return stack.output_image, stack.depthmap_image
@@ -0,0 +1,201 @@
+"""
+Z堆栈体数据存储（Zarr v2 目录格式）
+
+- 不依赖zarr库：按Zarr v2规范直接写 .zgroup/.zattrs/.zarray 和 zlib 压缩的块文件，
+  可以用 zarr/napari/Fiji(N5/Zarr插件) 直接打开
+- 按OME-NGFF 0.4 存储为 c, z, y, x（通道轴必须在空间轴之前），.zattrs 中记录 multiscales 元数据
+  （轴名、单位和物理尺寸）以及各层的实际Z位置，ome-zarr-py / napari-ome-zarr 可直接读取
+- 块在通道和Z方向厚度为1，每拍一层就写一层，内存中最多只保留一层
+- ZarrVolumeReader 只解码与所请求子体积相交的块，按 (Z, Y, X, C) 返回；也能读取早期按 z, y, x, c 写出的体数据
+"""
+
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ARRAY_NAME = '0'
+
+
+class ZarrVolumeWriter:
+    """逐层写入体数据，输入每层为 (Y, X, C) 图像，按 (C, Z, Y, X) 存储"""
+
+    def __init__(self, path, n_slices, height, width, channels=3, dtype=np.uint8, chunk_size=512,
+                 pixel_size_um=1.0, z_positions_um=None, compression_level=1, workers=2):
+        """
+        参数:
+            path: 输出目录（通常以 .zarr 结尾）
+            n_slices, height, width, channels: 体数据尺寸
+            chunk_size: Y、X方向的块大小，Z方向每块1层
+            pixel_size_um: XY像素尺寸（μm）
+            z_positions_um: 各层的实际Z位置（μm），用于记录Z步长；为空时按1μm
+            compression_level: zlib压缩级别，1最快
+            workers: 块压缩线程数（zlib压缩时释放GIL）
+        """
+        self.path = path
+        self.shape = (channels, n_slices, height, width)
+        self.chunks = (1, 1, chunk_size, chunk_size)
+        self.dtype = np.dtype(dtype)
+        self.compression_level = compression_level
+        self.array_dir = os.path.join(path, ARRAY_NAME)
+        self.files = []
+        self.slices_written = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='zarr_writer')
+
+        z_positions_um = list(z_positions_um) if z_positions_um is not None else list(range(n_slices))
+        z_step = float(np.median(np.diff(z_positions_um))) if len(z_positions_um) > 1 else 1.0
+        os.makedirs(self.array_dir, exist_ok=True)
+        self._write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+        self._write_json(os.path.join(path, '.zattrs'), {
+            'multiscales': [{
+                'version': '0.4',
+                'name': os.path.basename(path.rstrip(os.sep)),
+                'axes': [
+                    {'name': 'c', 'type': 'channel'},
+                    {'name': 'z', 'type': 'space', 'unit': 'micrometer'},
+                    {'name': 'y', 'type': 'space', 'unit': 'micrometer'},
+                    {'name': 'x', 'type': 'space', 'unit': 'micrometer'},
+                ],
+                'datasets': [{
+                    'path': ARRAY_NAME,
+                    'coordinateTransformations': [
+                        {'type': 'scale', 'scale': [1.0, abs(z_step), pixel_size_um, pixel_size_um]}
+                    ],
+                }],
+            }],
+            'z_positions_um': [float(z) for z in z_positions_um],
+        })
+        self._write_zarray()
+
+    def _write_json(self, path, content):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=2)
+        self.files.append(path)
+
+    def _write_zarray(self):
+        path = os.path.join(self.array_dir, '.zarray')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'zarr_format': 2,
+                'shape': list(self.shape),
+                'chunks': list(self.chunks),
+                'dtype': self.dtype.str,
+                'compressor': {'id': 'zlib', 'level': self.compression_level},
+                'fill_value': 0,
+                'order': 'C',
+                'filters': None,
+                'dimension_separator': '.',
+            }, f, indent=2)
+        if path not in self.files:
+            self.files.append(path)
+
+    def _write_chunk(self, key, block):
+        path = os.path.join(self.array_dir, key)
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(block.tobytes(), self.compression_level))
+        return path
+
+    def write_slice(self, z, image):
+        """写入第 z 层 (Y, X, C) 图像，按通道和块切分后并行压缩写盘，返回时该层已全部落盘"""
+        channels, _, height, width = self.shape
+        image = image.reshape(height, width, channels)
+        cy, cx = self.chunks[2], self.chunks[3]
+        futures = []
+        for c in range(channels):
+            for yi, y0 in enumerate(range(0, height, cy)):
+                for xi, x0 in enumerate(range(0, width, cx)):
+                    block = image[y0:y0 + cy, x0:x0 + cx, c]
+                    if block.shape != (cy, cx):
+                        # Zarr v2 边缘块也按完整块大小存储，超出部分为fill_value
+                        padded = np.zeros((cy, cx), dtype=self.dtype)
+                        padded[:block.shape[0], :block.shape[1]] = block
+                        block = padded
+                    key = f'{c}.{z}.{yi}.{xi}'
+                    futures.append(self._executor.submit(self._write_chunk, key,
+                                                         np.ascontiguousarray(block, self.dtype)))
+        self.files.extend(f.result() for f in futures)
+        self.slices_written = max(self.slices_written, z + 1)
+
+    def close(self):
+        """结束写入；实际写入层数少于预期时（如中途停止）更新数组形状"""
+        if self.slices_written != self.shape[1]:
+            self.shape = (self.shape[0], self.slices_written) + self.shape[2:]
+            self._write_zarray()
+        self._executor.shutdown(wait=True)
+        return self.files
+
+
+class ZarrVolumeReader:
+    """
+    读取 ZarrVolumeWriter 写出的体数据，支持子体积读取
+
+    ZarrVolumeWriter 会写出每一个块，strict=True（默认）时缺失的块视为数据损坏并报错，
+    不按Zarr规范以fill_value补齐
+    """
+
+    def __init__(self, path, strict=True):
+        self.path = path
+        self.strict = strict
+        self.array_dir = os.path.join(path, ARRAY_NAME)
+        with open(os.path.join(self.array_dir, '.zarray'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.chunks = tuple(meta['chunks'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.fill_value = meta.get('fill_value') or 0
+        self.separator = meta.get('dimension_separator', '.')
+        with open(os.path.join(path, '.zattrs'), 'r', encoding='utf-8') as f:
+            self.attrs = json.load(f)
+        # 早期版本按 z, y, x, c 存储
+        axes = self.attrs.get('multiscales', [{}])[0].get('axes', [])
+        self.channel_first = bool(axes) and axes[0]['name'] == 'c'
+
+    def _read_chunk(self, index):
+        key = self.separator.join(str(i) for i in index)
+        try:
+            with open(os.path.join(self.array_dir, key), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except FileNotFoundError:
+            if self.strict:
+                raise FileNotFoundError(f"Zarr体数据缺少块 {key}，数据不完整: {self.path}")
+            return np.full(self.chunks, self.fill_value, dtype=self.dtype)
+        return np.frombuffer(data, dtype=self.dtype).reshape(self.chunks)
+
+    @property
+    def volume_shape(self):
+        """(Z, Y, X, C)"""
+        if self.channel_first:
+            return self.shape[1:] + self.shape[:1]
+        return self.shape
+
+    def read(self, z=slice(None), y=slice(None), x=slice(None)):
+        """读取子体积，参数为步长为1的slice，返回 (Z, Y, X, C) 数组"""
+        shape = self.volume_shape
+        chunks = self.chunks[1:] if self.channel_first else self.chunks[:3]
+        bounds = [s.indices(n)[:2] for s, n in zip((z, y, x), shape[:3])]
+        out = np.empty(tuple(b - a for a, b in bounds) + shape[3:], dtype=self.dtype)
+        ranges = [range(a // c, (b - 1) // c + 1) if b > a else range(0)
+                  for (a, b), c in zip(bounds, chunks)]
+        for zi in ranges[0]:
+            for yi in ranges[1]:
+                for xi in ranges[2]:
+                    src, dst = [], []
+                    for (a, b), c, i in zip(bounds, chunks, (zi, yi, xi)):
+                        lo, hi = max(a, i * c), min(b, (i + 1) * c)
+                        src.append(slice(lo - i * c, hi - i * c))
+                        dst.append(slice(lo - a, hi - a))
+                    if not self.channel_first:
+                        out[tuple(dst)] = self._read_chunk((zi, yi, xi, 0))[tuple(src)]
+                        continue
+                    for channel in range(shape[3]):
+                        chunk = self._read_chunk((channel, zi, yi, xi))[0]
+                        out[tuple(dst) + (channel,)] = chunk[tuple(src)]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = tuple(slice(k, k + 1) if isinstance(k, int) else k for k in key) + (slice(None),) * (3 - len(key))
+        return self.read(*key[:3])